@@ -0,0 +1,105 @@
+""" Deciding whether this worker should take on a job
+
+Before a job clones its repository, the repository's size from GitHub (or
+the disk and memory its last job actually used, if that's larger) is
+compared with the free disk and available memory on the node. A repository
+over AIDERBOT_BIG_REPO_SIZE_KB is sent to the big-repository queue, if
+AIDERBOT_BIG_REPO_QUEUE names one that workers on larger machines consume. A job that doesn't fit in the
+headroom left on this node is put back on its queue with a delay.
+
+ResourceAwareAutoscaler uses the same headroom, and the average usage per
+job on the node, to stop Celery's autoscaler adding pool processes the
+node can't support. Enable it with --autoscale=<max>,<min> on the worker.
+"""
+import os
+import logging
+from celery.worker.autoscale import Autoscaler
+from . import resources
+from .job_control import JobInterrupted
+from .pipeline import WORKSPACE_ROOT
+
+logger = logging.getLogger(__name__)
+
+# GitHub reports repository sizes in kilobytes
+BIG_REPO_SIZE_KB = int(os.getenv('AIDERBOT_BIG_REPO_SIZE_KB', 1024 * 1024))
+# Off by default, since a job sent to a queue that no worker consumes never runs
+BIG_REPO_QUEUE = os.getenv('AIDERBOT_BIG_REPO_QUEUE', '')
+# Headroom to leave free on the node after a job's estimated usage
+MIN_FREE_DISK_BYTES = int(os.getenv('AIDERBOT_MIN_FREE_DISK_BYTES', 512 * 1024 ** 2))
+MIN_FREE_MEMORY_BYTES = int(os.getenv('AIDERBOT_MIN_FREE_MEMORY_BYTES', 64 * 1024 ** 2))
+ADMISSION_DELAY_SECONDS = int(os.getenv('AIDERBOT_ADMISSION_DELAY_SECONDS', 60))
+# After this many delays a job runs anyway, rather than waiting forever
+MAX_ADMISSION_DELAYS = int(os.getenv('AIDERBOT_MAX_ADMISSION_DELAYS', 10))
+
+# A checkout with its history takes more space than GitHub's reported size
+CLONE_SIZE_FACTOR = 3
+# Memory assumed for a job before any job on the node has been measured
+DEFAULT_JOB_MEMORY_BYTES = 256 * 1024 ** 2
+
+class JobDeferred(JobInterrupted):
+    """ Raised when a job shouldn't run on this worker yet
+
+    If queue is set, the job should be sent to that queue, otherwise put back
+    on its own queue after a delay.
+    """
+
+    def __init__(self, message, queue=None):
+        super().__init__(message)
+        self.queue = queue
+
+def estimate_job_usage(repo, repo_size_kb):
+    """Return the estimated peak memory and disk, in bytes, of a job for repo."""
+    repo_usage = resources.get_repo_usage(repo) or {}
+    node_usage = resources.get_node_usage() or {}
+    disk_bytes = max((repo_size_kb or 0) * 1024 * CLONE_SIZE_FACTOR, repo_usage.get('disk_bytes', 0))
+    memory_bytes = repo_usage.get('rss_bytes') or node_usage.get('rss_bytes') or DEFAULT_JOB_MEMORY_BYTES
+    return memory_bytes, disk_bytes
+
+def check_admission(repo, repo_size_kb, queue=None):
+    """ Raise JobDeferred if a job for repo shouldn't run on this worker now
+
+    queue is the queue the job was taken from, so that jobs already on the
+    big-repository queue aren't sent to it again.
+    """
+    if BIG_REPO_QUEUE and repo_size_kb and repo_size_kb >= BIG_REPO_SIZE_KB and queue != BIG_REPO_QUEUE:
+        raise JobDeferred(f"{repo} is {repo_size_kb} KB, sending it to {BIG_REPO_QUEUE}", queue=BIG_REPO_QUEUE)
+
+    memory_bytes, disk_bytes = estimate_job_usage(repo, repo_size_kb)
+    free_disk_bytes = resources.get_free_disk_bytes(WORKSPACE_ROOT)
+    if free_disk_bytes - disk_bytes < MIN_FREE_DISK_BYTES:
+        raise JobDeferred(f"Not enough free disk for {repo}: needs {disk_bytes} bytes, {free_disk_bytes} free")
+
+    available_memory_bytes = resources.get_available_memory_bytes()
+    if available_memory_bytes is not None and available_memory_bytes - memory_bytes < MIN_FREE_MEMORY_BYTES:
+        raise JobDeferred(f"Not enough memory for {repo}: needs {memory_bytes} bytes, {available_memory_bytes} available")
+
+    logger.info(f"Admitted job for {repo}, estimated to need {memory_bytes} bytes of memory and {disk_bytes} bytes of disk")
+
+def get_headroom_jobs():
+    """Return how many more average jobs fit in the node's free memory and disk."""
+    node_usage = resources.get_node_usage() or {}
+    memory_per_job = node_usage.get('rss_bytes') or DEFAULT_JOB_MEMORY_BYTES
+    limits = [(resources.get_free_disk_bytes(WORKSPACE_ROOT) - MIN_FREE_DISK_BYTES) // max(node_usage.get('disk_bytes', 0), 1)]
+    available_memory_bytes = resources.get_available_memory_bytes()
+    if available_memory_bytes is not None:
+        limits.append((available_memory_bytes - MIN_FREE_MEMORY_BYTES) // memory_per_job)
+    return max(0, min(limits))
+
+class ResourceAwareAutoscaler(Autoscaler):
+    """ Celery autoscaler that only grows the pool while the node has headroom
+
+    Shrinking is left to Celery, which scales down idle processes.
+    """
+
+    def _maybe_scale(self, req=None):
+        procs = self.processes
+        wanted = min(self.qty, self.max_concurrency)
+        if wanted <= procs:
+            return super()._maybe_scale(req)
+
+        grow_by = min(wanted - procs, get_headroom_jobs())
+        if grow_by <= 0:
+            logger.debug(f"Not growing the pool past {procs} processes, the node is short of disk or memory")
+            return False
+        self.scale_up(grow_by)
+        return True
@@ -1,27 +1,93 @@
 from aider.repo import GitRepo
 import os
-import subprocess
 from aider.coders import Coder
 from aider.models import Model
 from aider.io import InputOutput
 import logging
+from . import git_commands, result_cache
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("debug.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-def do_coding_request(prompt, files_list, root_folder_path, conventions_file=None):
+class InterruptibleInputOutput(InputOutput):
+    """ InputOutput that gives the caller a chance to stop aider
+
+    aider reports progress through its io object throughout the chat loop, so
+    check_interrupt is called on every message and can raise to stop the run.
+    """
+
+    def __init__(self, check_interrupt=None, **kwargs):
+        super().__init__(**kwargs)
+        self.check_interrupt = check_interrupt
+
+    def _check_interrupt(self):
+        if self.check_interrupt:
+            self.check_interrupt()
+
+    def tool_output(self, *args, **kwargs):
+        self._check_interrupt()
+        return super().tool_output(*args, **kwargs)
+
+    def tool_warning(self, *args, **kwargs):
+        self._check_interrupt()
+        return super().tool_warning(*args, **kwargs)
+
+    def tool_error(self, *args, **kwargs):
+        self._check_interrupt()
+        return super().tool_error(*args, **kwargs)
+
+    def assistant_output(self, *args, **kwargs):
+        self._check_interrupt()
+        return super().assistant_output(*args, **kwargs)
+
+def _track_usage(coder):
+    """ Return a dict that accumulates the tokens and cost of coder's messages
+
+    aider resets its per-message token counts each time it shows the usage
+    report, so they're added up just before that happens.
+    """
+    usage = empty_usage()
+    show_usage_report = coder.show_usage_report
+
+    def show_and_track_usage_report():
+        usage['tokens_sent'] += coder.message_tokens_sent
+        usage['tokens_received'] += coder.message_tokens_received
+        show_usage_report()
+
+    coder.show_usage_report = show_and_track_usage_report
+    return usage
+
+def empty_usage():
+    return {'tokens_sent': 0, 'tokens_received': 0, 'cost': 0.0}
+
+def combine_usage(*usages):
+    """Add up usage dicts, ignoring any that are None."""
+    total = empty_usage()
+    for usage in usages:
+        for name in total:
+            total[name] += (usage or {}).get(name, 0)
+    return total
+
+def do_coding_request(prompt, files_list, root_folder_path, conventions_file=None, use_cache=True, check_interrupt=None, model_name=None, temperature=None):
     logger.info("Starting coding request")
     logger.info(f"Files List: {files_list}")
 
-    model_name = os.environ.get('AIDER_MODEL', 'claude-3-5-sonnet-20240620')
+    model_name = model_name or os.environ.get('AIDER_MODEL', 'claude-3-5-sonnet-20240620')
+
+    cache_key = None
+    if use_cache and result_cache.CACHE_ENABLED:
+        cache_key = result_cache.build_cache_key(
+            model_name=model_name if temperature is None else f"{model_name}@{temperature}",
+            prompt=prompt,
+            repo_dir=root_folder_path,
+            files_list=files_list,
+            conventions_file=conventions_file
+        )
+        cached_result = _replay_cached_result(cache_key, root_folder_path)
+        if cached_result:
+            return cached_result
+
+    initial_commit_hash = git_commands.get_current_commit_hash(root_folder_path)
+
     model = Model(model_name)
     full_file_paths = []
     for file in files_list:
@@ -29,7 +95,7 @@ def do_coding_request(prompt, files_list, root_folder_path, conventions_file=Non
             full_file_paths.append(os.path.join(root_folder_path, file[0]))
         else:
             full_file_paths.append(os.path.join(root_folder_path, file))
-    io = InputOutput(yes=True)
+    io = InterruptibleInputOutput(check_interrupt=check_interrupt, yes=True)
     git_repo = GitRepo(io, full_file_paths, root_folder_path, models=model.commit_message_models())
 
     read_only_fnames = []
@@ -38,25 +104,67 @@ def do_coding_request(prompt, files_list, root_folder_path, conventions_file=Non
         logger.info(f"Added conventions file to read-only files: {conventions_file}")
 
     coder = Coder.create(main_model=model, fnames=full_file_paths, io=io, repo=git_repo, stream=False, suggest_shell_commands=False, read_only_fnames=read_only_fnames)
+    if temperature is not None:
+        coder.temperature = temperature
+    usage = _track_usage(coder)
 
     logger.info("Running coder with prompt")
     coder.run(prompt)
 
+    if check_interrupt:
+        check_interrupt()
+
     summary_prompt = f"Thank you for making those changes. Can you please write a description of the changes that were made? This will be included in the pull request description. Do not include a message at the start of your response."
     summary_coder = Coder.create(edit_format="ask", main_model=model, fnames=full_file_paths, io=io, repo=git_repo, stream=False, suggest_shell_commands=False, from_coder=coder, read_only_fnames=read_only_fnames)
+    summary_usage = _track_usage(summary_coder)
     summary = summary_coder.run(summary_prompt)
+    # The summary coder carries on from the coder's total cost
+    usage = combine_usage(usage, summary_usage)
+    usage['cost'] = summary_coder.total_cost
 
     logger.info("Coding request completed")
 
     # Get the last commit message
-    commit_message = subprocess.check_output(['git', 'log', '-1', '--pretty=%B'], cwd=root_folder_path).decode('utf-8').strip()
+    commit_message = git_commands.get_last_commit_message(root_folder_path)
     if not commit_message:
         commit_message = "Update files based on the latest request"
     logger.info(f"Commit message: {commit_message}")
 
+    if cache_key:
+        result_cache.store_result(
+            cache_key=cache_key,
+            patch=git_commands.format_patch(root_folder_path, initial_commit_hash),
+            commit_message=commit_message,
+            summary=summary
+        )
+
     return {
         'commit_message': commit_message,
-        'summary': summary
+        'summary': summary,
+        'cached': False,
+        'usage': usage
+    }
+
+def _replay_cached_result(cache_key, root_folder_path):
+    """ Replay a cached result onto the repository
+
+    Returns the cached result if it was applied, or None if there was no
+    cached result or its patch no longer applies.
+    """
+    cached_result = result_cache.get_cached_result(cache_key)
+    if not cached_result:
+        return None
+
+    if cached_result['patch'] and not git_commands.apply_patch(root_folder_path, cached_result['patch']):
+        logger.warning("Cached patch did not apply, running the coding request instead")
+        return None
+
+    logger.info("Replayed cached coding result")
+    return {
+        'commit_message': cached_result['commit_message'],
+        'summary': cached_result['summary'],
+        'cached': True,
+        'usage': empty_usage()
     }
 
 
@@ -0,0 +1,289 @@
+""" Working through a repository's backlog of issues in one batch
+
+Instead of one task per @aiderbot mention, each with its own token, clone
+and worker, a batch mints one installation token, clones the repository
+once, and runs the issue pipeline for each selected issue in a worktree of
+that shared clone, a few at a time. Issues that already have an open pull
+request from aiderbot are skipped, so a batch can be run again to pick up
+where a previous one stopped.
+
+The token is replaced before it gets close to expiring, and the shared
+clone's remote is updated with it. Transient failures are retried in place,
+resuming from the failed stage.
+
+Run a batch from the command line:
+
+    python -m aiderbot.batch owner/repo --label aiderbot --concurrency 4 --output report.json
+
+or queue it on the workers with --enqueue, and read the report from
+GET /batches/<batch_id> when it's done.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from . import github_api, git_commands, pipeline, job_records, logging_config
+from .celery_tasks import app, run_issue_job, TASK_MAX_RETRIES, _retry_countdown
+from .job_control import TASK_TIME_LIMIT_SECONDS
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.getenv('AIDERBOT_BATCH_CONCURRENCY', 4))
+
+# Installation tokens last an hour. A job started with the token has to be
+# able to finish with it, so it's replaced once less than a job's time limit is left.
+TOKEN_LIFETIME_SECONDS = 60 * 60
+TOKEN_REFRESH_SECONDS = TOKEN_LIFETIME_SECONDS - TASK_TIME_LIMIT_SECONDS
+
+BATCH_REPORT_KEY_PREFIX = 'aiderbot:batch:'
+BATCH_JOB_KIND = 'batch'
+
+SKIPPED = 'skipped'
+
+class BacklogBatch:
+    """Runs the issue pipeline for many issues of one repository, sharing a token and a clone."""
+
+    def __init__(self, owner, repo_name, batch_id=None, concurrency=BATCH_CONCURRENCY):
+        self.owner = owner
+        self.repo_name = repo_name
+        self.batch_id = batch_id or uuid.uuid4().hex
+        self.concurrency = concurrency
+        self.shared_repo_dir = os.path.join(pipeline.WORKSPACE_ROOT, f"batch_{self.batch_id}")
+        self.base_branch = None
+        self.installation_id = None
+        self._token = None
+        self._token_minted_at = 0
+        self._token_lock = threading.Lock()
+        self._git_lock = threading.Lock()
+
+    @property
+    def repo(self):
+        return f"{self.owner}/{self.repo_name}"
+
+    def get_token(self):
+        """Return the batch's installation token, replacing it if it's close to expiring."""
+        with self._token_lock:
+            if self._token and time.time() - self._token_minted_at < TOKEN_REFRESH_SECONDS:
+                return self._token
+
+            if self.installation_id is None:
+                self.installation_id = github_api.get_installation_id_for_repository(self.owner, self.repo_name)
+                if self.installation_id is None:
+                    raise RuntimeError(f"The GitHub App isn't installed on {self.repo}")
+            token = github_api.get_github_token_for_installation(self.installation_id)
+            if not token:
+                raise RuntimeError(f"Failed to get an installation token for {self.repo}")
+
+            if self._token and os.path.exists(self.shared_repo_dir):
+                with self._git_lock:
+                    git_commands.set_remote_token(self.shared_repo_dir, token, self.owner, self.repo_name)
+            self._token = token
+            self._token_minted_at = time.time()
+            return token
+
+    def select_issues(self, labels=None, issue_numbers=None, state='open', limit=None):
+        """Return the issues to work on, either the numbered ones or those matching the filter."""
+        token = self.get_token()
+        if issue_numbers:
+            issues = [github_api.get_issue(token, self.owner, self.repo_name, number) for number in issue_numbers]
+            issues = [issue for issue in issues if issue and 'pull_request' not in issue]
+        else:
+            issues = github_api.list_issues(token, self.owner, self.repo_name, labels=labels, state=state, limit=limit)
+        return issues
+
+    def _clone(self):
+        token = self.get_token()
+        repository = github_api.get_repository(token, self.owner, self.repo_name)
+        self.base_branch = repository['default_branch'] if repository else 'main'
+        shutil.rmtree(self.shared_repo_dir, ignore_errors=True)
+        git_commands.clone_repository(
+            token=token,
+            temp_dir=self.shared_repo_dir,
+            owner=self.owner,
+            repo=self.repo_name,
+            branch=self.base_branch
+        )
+
+    def _has_open_pull_request(self, issue):
+        return github_api.get_pull_request_for_branch(
+            token=self.get_token(),
+            owner=self.owner,
+            repo=self.repo_name,
+            branch=f"fix-issue-{issue['number']}"
+        ) is not None
+
+    def _run_issue_job(self, issue, job_id, start_time):
+        """Run the issue pipeline, retrying transient failures from the failed stage."""
+        retries = 0
+        while True:
+            try:
+                return run_issue_job(
+                    self.get_token(),
+                    self.owner,
+                    self.repo_name,
+                    issue,
+                    start_time=start_time,
+                    job_id=job_id,
+                    can_retry=retries < TASK_MAX_RETRIES,
+                    shared_repo_dir=self.shared_repo_dir,
+                    base_branch=self.base_branch,
+                    git_lock=self._git_lock
+                )
+            except pipeline.StageFailed as e:
+                countdown = _retry_countdown(retries)
+                retries += 1
+                logger.info(f"Retrying issue #{issue['number']} from stage '{e.stage}' in {countdown} seconds")
+                job_records.save_job(job_id, retries=retries)
+                time.sleep(countdown)
+
+    def _process_issue(self, issue):
+        start_time = time.time()
+        job_id = f"{self.batch_id}-{issue['number']}"
+        correlation_id_token = logging_config.set_correlation_id(job_id)
+        try:
+            if self._has_open_pull_request(issue):
+                logger.info(f"Skipping issue #{issue['number']}, it already has an open pull request")
+                return {'issue': issue['number'], 'job_id': job_id, 'status': SKIPPED, 'duration_seconds': 0}
+
+            job_records.save_job(job_id, repo=self.repo, kind=BATCH_JOB_KIND, status=job_records.QUEUED)
+            response, status_code = self._run_issue_job(issue, job_id, start_time)
+        except Exception as e:
+            # One issue going wrong shouldn't stop the rest of the batch
+            logger.exception(f"Issue #{issue['number']} failed")
+            job_records.save_job(job_id, status=job_records.FAILED, error=e)
+            response, status_code = {"error": str(e)}, 500
+        finally:
+            logging_config.reset_correlation_id(correlation_id_token)
+
+        outcome = {'issue': issue['number'], 'job_id': job_id, 'duration_seconds': time.time() - start_time}
+        record = job_records.get_job(job_id)
+        if not record:
+            # Without Redis there's no job record, so go by the response
+            status = job_records.SUCCEEDED if status_code == 200 else job_records.FAILED
+            return {**outcome, 'status': status, 'error': response.get('error')}
+        return {
+            **outcome,
+            'status': record.status,
+            'pull_request_url': record.pull_request_url,
+            'retries': record.retries,
+            'timings': record.timings,
+            'tokens_sent': record.tokens_sent,
+            'tokens_received': record.tokens_received,
+            'cost': record.cost,
+            'error': record.error,
+        }
+
+    def run(self, issues):
+        """Work through issues and return a report of the outcomes and throughput."""
+        start_time = time.time()
+        logger.info(f"Starting batch {self.batch_id} for {len(issues)} issues of {self.repo}")
+        try:
+            self._clone()
+            setup_seconds = time.time() - start_time
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='batch') as executor:
+                outcomes = list(executor.map(self._process_issue, issues))
+        finally:
+            shutil.rmtree(self.shared_repo_dir, ignore_errors=True)
+
+        wall_time = time.time() - start_time
+        status_counts = {}
+        for outcome in outcomes:
+            status_counts[outcome['status']] = status_counts.get(outcome['status'], 0) + 1
+        processed = len(outcomes) - status_counts.get(SKIPPED, 0)
+        report = {
+            'batch_id': self.batch_id,
+            'repo': self.repo,
+            'concurrency': self.concurrency,
+            'issues': len(outcomes),
+            'statuses': status_counts,
+            'setup_seconds': setup_seconds,
+            'wall_time_seconds': wall_time,
+            'issues_per_hour': processed / wall_time * 3600 if wall_time else None,
+            'cost': sum(outcome.get('cost') or 0 for outcome in outcomes),
+            'outcomes': outcomes,
+        }
+        logger.info(f"Batch {self.batch_id} finished {len(outcomes)} issues in {wall_time:.0f} seconds: {status_counts}")
+        return report
+
+def save_report(report):
+    key = BATCH_REPORT_KEY_PREFIX + report['batch_id']
+    try:
+        get_redis_client().set(key, json.dumps(report), ex=job_records.JOB_RECORD_TTL_SECONDS)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to save the report for batch {report['batch_id']}: {e}")
+
+def get_report(batch_id):
+    """Return the report of a finished batch, or None if it isn't there."""
+    try:
+        report = get_redis_client().get(BATCH_REPORT_KEY_PREFIX + batch_id)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read the report for batch {batch_id}: {e}")
+        return None
+    return json.loads(report) if report else None
+
+def process_backlog(owner, repo_name, labels=None, issue_numbers=None, state='open', limit=None, concurrency=BATCH_CONCURRENCY, batch_id=None):
+    batch = BacklogBatch(owner, repo_name, batch_id=batch_id, concurrency=concurrency)
+    issues = batch.select_issues(labels=labels, issue_numbers=issue_numbers, state=state, limit=limit)
+    report = batch.run(issues)
+    save_report(report)
+    return report
+
+@app.task(bind=True)
+def task_process_backlog(self, owner, repo_name, labels=None, issue_numbers=None, state='open', limit=None, concurrency=BATCH_CONCURRENCY):
+    # The batch runs as long as its issues take, so it has no time limit of its
+    # own. Each issue's stages still have their time budgets.
+    process_backlog(
+        owner,
+        repo_name,
+        labels=labels,
+        issue_numbers=issue_numbers,
+        state=state,
+        limit=limit,
+        concurrency=concurrency,
+        batch_id=self.request.id
+    )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('repo', help="Repository as owner/name")
+    parser.add_argument('--label', action='append', dest='labels', help="Only issues with this label, can be repeated")
+    parser.add_argument('--issue', action='append', type=int, dest='issue_numbers', help="Work on this issue number, can be repeated, overrides the filter")
+    parser.add_argument('--state', default='open', choices=['open', 'closed', 'all'], help="Issue state to filter on")
+    parser.add_argument('--limit', type=int, help="Maximum number of issues, oldest first")
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY, help="Issues worked on at once")
+    parser.add_argument('--enqueue', action='store_true', help="Queue the batch for the Celery workers instead of running it here")
+    parser.add_argument('--output', help="Write the report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    owner, repo_name = args.repo.split('/', 1)
+    options = {
+        'labels': args.labels,
+        'issue_numbers': args.issue_numbers,
+        'state': args.state,
+        'limit': args.limit,
+        'concurrency': args.concurrency,
+    }
+    if args.enqueue:
+        result = task_process_backlog.delay(owner, repo_name, **options)
+        print(f"Queued batch {result.id}")
+        return
+
+    report = json.dumps(process_backlog(owner, repo_name, **options), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+""" Parallel candidate generation
+
+For hard issues, several aider attempts can run at once, each with its own
+model or temperature, in its own git worktree off the job's clone and in its
+own process. Every candidate that makes commits is run through a check
+command, and the first one to pass is checked out in the job's workspace
+while the others are cancelled.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import git_commands, aider_coder, isolation
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated models to try, each optionally followed by @temperature,
+# e.g. "claude-3-5-sonnet-20240620,claude-3-5-sonnet-20240620@0.7,gpt-4o"
+CANDIDATE_MODELS = os.getenv('AIDERBOT_CANDIDATE_MODELS', '')
+CANDIDATES_BY_DEFAULT = os.getenv('AIDERBOT_CANDIDATES_BY_DEFAULT', 'false').lower() == 'true'
+CHECK_COMMAND = os.getenv('AIDERBOT_CHECK_COMMAND', '')
+CHECK_TIMEOUT_SECONDS = int(os.getenv('AIDERBOT_CHECK_TIMEOUT_SECONDS', 300))
+
+# Mentioning this marker in an issue or comment runs candidates for that request
+CANDIDATES_MARKER = '--candidates'
+
+POLL_INTERVAL_SECONDS = 1
+
+def get_candidate_specs():
+    """Parse AIDERBOT_CANDIDATE_MODELS into a list of model and temperature specs."""
+    specs = []
+    for entry in CANDIDATE_MODELS.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        model_name, _, temperature = entry.partition('@')
+        specs.append({
+            'model_name': model_name,
+            'temperature': float(temperature) if temperature else None
+        })
+    return specs
+
+def is_candidates_requested(texts):
+    """Return True if candidates should be run for a request with these texts."""
+    if not get_candidate_specs():
+        return False
+    return CANDIDATES_BY_DEFAULT or any(CANDIDATES_MARKER in (text or '') for text in texts)
+
+class Candidate:
+    """ One aider attempt, running in its own worktree and process
+
+    cancel() can be called from another thread at any point and kills
+    whichever child process the candidate is running.
+    """
+
+    def __init__(self, index, spec, repo_dir, initial_commit_hash):
+        self.index = index
+        self.spec = spec
+        self.repo_dir = repo_dir
+        self.initial_commit_hash = initial_commit_hash
+        self.worktree_dir = f"{repo_dir}_candidate_{index}"
+        self.result = None
+        self.has_changes = False
+        self.passed = False
+        self.timings = {}
+        self._process = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def run(self, coding_kwargs, check_command):
+        """Run aider and then the check command, and return True if the candidate passed."""
+        start_time = time.time()
+        self.result = self._run_coding_request(coding_kwargs)
+        self.timings['coding'] = time.time() - start_time
+        if self.result is None:
+            return False
+
+        commit_hash = git_commands.get_current_commit_hash(self.worktree_dir)
+        self.result['commit_hash'] = commit_hash
+        self.has_changes = commit_hash != self.initial_commit_hash
+        if not self.has_changes:
+            logger.info(f"Candidate {self.index} made no changes")
+            return False
+
+        if not check_command:
+            self.passed = True
+            return True
+
+        start_time = time.time()
+        with tempfile.TemporaryFile(mode='w+') as check_output:
+            returncode = self._run_process(
+                check_command,
+                timeout=CHECK_TIMEOUT_SECONDS,
+                shell=True,
+                cwd=self.worktree_dir,
+                stdout=check_output,
+                stderr=subprocess.STDOUT
+            )
+            check_output.seek(0)
+            self.result['check_output'] = check_output.read()[-4000:]
+        self.timings['check'] = time.time() - start_time
+
+        self.passed = returncode == 0
+        logger.info(f"Candidate {self.index} check {'passed' if self.passed else 'failed'}")
+        return self.passed
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._process and self._process.poll() is None:
+                os.killpg(self._process.pid, signal.SIGKILL)
+
+    def report(self):
+        return {
+            'index': self.index,
+            'model_name': self.spec['model_name'],
+            'temperature': self.spec['temperature'],
+            'has_changes': self.has_changes,
+            'passed': self.passed,
+            'timings': self.timings
+        }
+
+    def _run_coding_request(self, coding_kwargs):
+        request_path = f"{self.worktree_dir}.request.json"
+        result_path = f"{self.worktree_dir}.result.json"
+        with open(request_path, 'w') as request_file:
+            json.dump({
+                'kwargs': {**coding_kwargs, **self.spec, 'root_folder_path': self.worktree_dir},
+                'result_path': result_path
+            }, request_file)
+
+        returncode = self._run_process(
+            [sys.executable, '-m', 'aiderbot.coding_worker', request_path],
+            env=isolation.get_child_env(),
+            stdout=subprocess.DEVNULL
+        )
+        if returncode != 0:
+            logger.info(f"Candidate {self.index} coding request exited with {returncode}")
+            return None
+
+        with open(result_path) as result_file:
+            return json.load(result_file)
+
+    def _run_process(self, args, timeout=None, **kwargs):
+        """Run a child process in its own process group and return its exit code."""
+        with self._lock:
+            if self._cancelled:
+                return None
+            self._process = subprocess.Popen(args, start_new_session=True, **kwargs)
+
+        try:
+            return self._process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.info(f"Candidate {self.index} process timed out after {timeout} seconds")
+            self.cancel()
+            self._process.wait()
+            return None
+
+def _remove_candidate_files(candidate):
+    git_commands.remove_worktree(candidate.repo_dir, candidate.worktree_dir)
+    for suffix in ['.request.json', '.result.json']:
+        if os.path.exists(candidate.worktree_dir + suffix):
+            os.remove(candidate.worktree_dir + suffix)
+
+def run_candidates(specs, prompt, files_list, root_folder_path, initial_commit_hash, conventions_file=None, use_cache=True, check_interrupt=None, check_command=CHECK_COMMAND):
+    """ Run a candidate per spec and check out the first one to pass
+
+    If no candidate passes the check, the first candidate that made changes
+    is used instead, with a note in its summary. Returns a coding result like
+    aider_coder.do_coding_request's, with a report on every candidate.
+    """
+    logger.info(f"Running {len(specs)} candidates")
+    candidates = [Candidate(index, spec, root_folder_path, initial_commit_hash) for index, spec in enumerate(specs)]
+    coding_kwargs = {
+        'prompt': prompt,
+        'files_list': files_list,
+        'use_cache': use_cache
+    }
+    # Each candidate reads the conventions file from its own worktree
+    conventions_file_relative = os.path.relpath(conventions_file, root_folder_path) if conventions_file else None
+
+    winner = None
+    chosen = None
+    finished = []
+    try:
+        for candidate in candidates:
+            git_commands.add_worktree(root_folder_path, candidate.worktree_dir, initial_commit_hash)
+
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            futures = {
+                # Each thread runs in a copy of this context to keep the job's correlation id
+                executor.submit(
+                    contextvars.copy_context().run,
+                    candidate.run,
+                    _kwargs_for_candidate(coding_kwargs, candidate, conventions_file_relative),
+                    check_command
+                ): candidate
+                for candidate in candidates
+            }
+            pending = set(futures)
+            try:
+                while pending and not winner:
+                    if check_interrupt:
+                        check_interrupt()
+                    done, pending = wait(pending, timeout=POLL_INTERVAL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        candidate = futures[future]
+                        finished.append(candidate)
+                        try:
+                            passed = future.result()
+                        except Exception as e:
+                            logger.error(f"Candidate {candidate.index} failed: {str(e)}")
+                            continue
+                        if passed and not winner:
+                            winner = candidate
+            finally:
+                for candidate in candidates:
+                    candidate.cancel()
+
+        chosen = winner or next((candidate for candidate in finished if candidate.has_changes), None)
+        if chosen:
+            logger.info(f"Using candidate {chosen.index} ({chosen.spec['model_name']})")
+            git_commands.reset_to_commit(repo_dir=root_folder_path, commit_hash=chosen.result['commit_hash'])
+    finally:
+        for candidate in candidates:
+            _remove_candidate_files(candidate)
+
+    reports = [candidate.report() for candidate in candidates]
+    logger.info(f"Candidate reports: {reports}")
+    # Cancelled candidates don't report what they used before they were stopped
+    usage = aider_coder.combine_usage(*(candidate.result.get('usage') for candidate in finished if candidate.result))
+
+    if not chosen:
+        summaries = [candidate.result['summary'] for candidate in finished if candidate.result]
+        return {
+            'commit_message': "Update files based on the latest request",
+            'summary': summaries[0] if summaries else "None of the candidates made any changes.",
+            'cached': False,
+            'usage': usage,
+            'candidates': reports
+        }
+
+    summary = chosen.result['summary']
+    if not chosen.passed:
+        summary += f"\n\nNote: none of the {len(candidates)} candidates passed the check command `{check_command}`."
+        check_output = chosen.result.get('check_output', '').strip()
+        if check_output:
+            summary += f" Its output for the changes used here ended with:\n\n```\n{check_output}\n```"
+
+    return {
+        'commit_message': chosen.result['commit_message'],
+        'summary': summary,
+        'cached': chosen.result.get('cached', False),
+        'usage': usage,
+        'candidates': reports
+    }
+
+def _kwargs_for_candidate(coding_kwargs, candidate, conventions_file_relative):
+    conventions_file = os.path.join(candidate.worktree_dir, conventions_file_relative) if conventions_file_relative else None
+    return {**coding_kwargs, 'conventions_file': conventions_file}
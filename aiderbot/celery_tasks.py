@@ -3,23 +3,17 @@ load_dotenv()
 
 import os
 import logging
-import tempfile
 import shutil
-import subprocess
 import re
 import git
 import time
+import traceback
+import uuid
+import contextlib
 from pathlib import Path
+from .logging_config import setup_logging
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("debug.log"),
-        logging.StreamHandler()
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Explicitly set the Git executable path
@@ -27,206 +21,777 @@ git_executable = "/usr/bin/git"
 git.refresh(git_executable)
 logger.info(f"Git executable set to: {git_executable}")
 
-from celery import Celery
-from . import github_api, git_commands, aider_coder
+from celery import Celery, signals
+from celery.utils.log import current_process_index
+from . import github_api, git_commands, aider_coder, result_cache, pipeline, job_control, candidates, verification, logging_config, job_records, routing, resources, admission, isolation, model_routing
 
 REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
-app = Celery('tasks', broker=REDIS_URL, backend=REDIS_URL)
+app = Celery('tasks', broker=REDIS_URL, backend=REDIS_URL, include=['aiderbot.batch'])
+app.conf.update(
+    # Nothing reads the task results, job status is kept in job_records instead
+    task_ignore_result=True,
+    result_expires=int(os.getenv('AIDERBOT_RESULT_TTL_SECONDS', 24 * 60 * 60)),
+    # Only used when the worker is started with --autoscale
+    worker_autoscaler='aiderbot.admission:ResourceAwareAutoscaler',
+    # A pool process whose memory has grown past this (in KB) is replaced
+    # after its current task. Set AIDERBOT_WORKER_MAX_MEMORY_MB to 0 to turn it off.
+    worker_max_memory_per_child=int(os.getenv('AIDERBOT_WORKER_MAX_MEMORY_MB', 768)) * 1024 or None
+)
+
+@signals.setup_logging.connect
+def _setup_celery_logging(**kwargs):
+    # Connecting to this signal stops Celery from configuring logging itself
+    setup_logging(force=True, name='worker')
+
+@signals.worker_process_init.connect
+def _setup_worker_process_logging(**kwargs):
+    # Named by pool index, so a replacement process reuses its predecessor's file
+    setup_logging(force=True, name=f'worker-{current_process_index()}')
+
+@signals.celeryd_after_setup.connect
+def _consume_node_queue(sender, instance, **kwargs):
+    if routing.ROUTING_ENABLED:
+        instance.app.amqp.queues.select_add(routing.get_node_queue(routing.NODE_NAME))
+
+@signals.worker_ready.connect
+def _start_workspace_sweeper(**kwargs):
+    pipeline.start_workspace_sweeper()
+
+@signals.worker_ready.connect
+def _join_routing_ring(**kwargs):
+    if routing.ROUTING_ENABLED:
+        routing.join()
+
+@signals.worker_shutdown.connect
+def _leave_routing_ring(**kwargs):
+    if routing.ROUTING_ENABLED:
+        routing.leave()
+
+@signals.task_prerun.connect
+def _set_task_correlation_id(task_id=None, task=None, **kwargs):
+    task.request.correlation_id_token = logging_config.set_correlation_id(task_id)
+
+@signals.task_postrun.connect
+def _reset_task_correlation_id(task=None, **kwargs):
+    token = getattr(task.request, 'correlation_id_token', None)
+    if token:
+        logging_config.reset_correlation_id(token)
 
 APP_USER_NAME = os.getenv('GITHUB_APP_USER_NAME', 'larryhudson-aider-github[bot]')
+# Author associations of users that aiderbot takes requests from
+AUTHORIZED_ASSOCIATIONS = ['OWNER', 'MEMBER', 'COLLABORATOR']
+
+TASK_MAX_RETRIES = int(os.getenv('AIDERBOT_TASK_MAX_RETRIES', 3))
+RETRY_BACKOFF_SECONDS = int(os.getenv('AIDERBOT_RETRY_BACKOFF_SECONDS', 30))
+RETRY_BACKOFF_MAX_SECONDS = int(os.getenv('AIDERBOT_RETRY_BACKOFF_MAX_SECONDS', 600))
 
 def _is_aiderbot_mentioned(text):
     return "@aiderbot" in text.lower()
 
-def _create_pull_request_for_issue(token, owner, repo_name, issue, comments=None, start_time=None):
-    logger.info(f"Processing issue #{issue['number']} for {owner}/{repo_name}")
-
-    if not comments:
-        if not _is_aiderbot_mentioned(issue['title']) and not _is_aiderbot_mentioned(issue['body']):
-            logger.info(f"Ignoring issue #{issue['number']} as @aiderbot was not mentioned")
-            return {"message": "Issue ignored as @aiderbot was not mentioned"}, 200
-
-        author_association = issue['author_association']
-        if author_association not in ['OWNER', 'MEMBER', 'COLLABORATOR']:
-            logger.info(f"Ignoring issue from user without sufficient permissions: {issue['user']['login']} (association: {author_association})")
-            return {"message": "Issue from user without sufficient permissions ignored"}, 200
+def _retry_countdown(retries):
+    """Return the exponential backoff before the next retry, in seconds."""
+    return min(RETRY_BACKOFF_SECONDS * 2 ** retries, RETRY_BACKOFF_MAX_SECONDS)
 
-    # Create a temporary directory within the current working directory
-    temp_dir = tempfile.mkdtemp(dir=os.getcwd(), prefix='repo_')
-    logger.info(f"Created temporary directory: {temp_dir}")
+def _run_job(context, stages, initial_state, can_retry, report_error):
+    """ Run a job's stages, handling failures and cleaning up the workspace
 
+    If a stage fails with a transient error and the task can still be
+    retried, StageFailed is raised so that the Celery task can retry it, and
+    the workspace and checkpoint are kept for the retry to resume from.
+    Otherwise the failure is reported with report_error. A cancelled job
+    stops quietly, since a newer job has taken its place. A job that isn't
+    admitted raises JobDeferred for the Celery task to requeue it.
+    """
+    job_id = context['job_id']
+    repo = f"{context['owner']}/{context['repo_name']}"
+    keep_workspace = False
+    job_records.save_job(
+        job_id,
+        repo=repo,
+        target=context['control'].target,
+        status=job_records.RUNNING
+    )
+    monitor = resources.JobResourceMonitor(pipeline.get_workspace_dir(job_id)).start()
     try:
-        eyes_reaction_id = github_api.create_issue_reaction(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            issue_number=issue['number'],
-            reaction="eyes"
+        state = pipeline.run_pipeline(
+            job_id,
+            stages,
+            context,
+            initial_state,
+            control=context['control'],
+            on_stage_start=lambda stage: job_records.save_job(job_id, phase=stage)
         )
+        pipeline.clear_checkpoint(job_id)
+        logger.info(f"Job {job_id} finished, stage timings: {state['timings']}")
+        _save_job_outcome(job_id, state, job_records.SUCCEEDED, pull_request_url=state.get('pull_request_url'))
+        return {**state['result'], 'timings': state['timings']}, 200
+
+    except admission.JobDeferred as e:
+        logger.info(f"Job {job_id} deferred: {str(e)}")
+        job_records.save_job(job_id, status=job_records.QUEUED, phase='admission', error=e)
+        raise
+
+    except job_control.JobCancelled as e:
+        logger.info(f"Job {job_id} cancelled: {str(e)}")
+        _save_job_outcome(job_id, pipeline.load_checkpoint(job_id)['state'], job_records.CANCELLED)
+        pipeline.clear_checkpoint(job_id)
+        return {"message": f"Job cancelled: {str(e)}"}, 200
+
+    except job_control.StageTimedOut as e:
+        logger.error(f"Job {job_id} timed out: {str(e)}")
+        checkpoint_state = pipeline.load_checkpoint(job_id)['state']
+        _save_job_outcome(job_id, checkpoint_state, job_records.FAILED, error=e)
+        start_time = checkpoint_state.get('start_time') or initial_state.get('start_time')
+        elapsed_time = time.time() - start_time if start_time else None
+        pipeline.clear_checkpoint(job_id)
+        # The message says everything, there's no traceback worth posting
+        return report_error(context, e, None, elapsed_time)
+
+    except pipeline.StageFailed as e:
+        logger.error(f"An error occurred: {str(e)}")
+        checkpoint_state = pipeline.load_checkpoint(job_id)['state']
+        if e.transient and can_retry:
+            logger.info(f"Job {job_id} will be retried from stage '{e.stage}'")
+            _save_job_outcome(job_id, checkpoint_state, job_records.RETRYING, error=e)
+            keep_workspace = True
+            raise
+
+        error_traceback = ''.join(traceback.format_exception(e.original))
+        logger.error(f"Full traceback:\n{error_traceback}")
+        _save_job_outcome(job_id, checkpoint_state, job_records.FAILED, error=e)
 
-        repo_dir, initial_commit_hash = git_commands.clone_repository(
-            token=token,
-            temp_dir=temp_dir,
-            owner=owner,
-            repo=repo_name
-        )
+        start_time = checkpoint_state.get('start_time') or initial_state.get('start_time')
+        elapsed_time = time.time() - start_time if start_time else None
+        pipeline.clear_checkpoint(job_id)
+
+        return report_error(context, e.original, error_traceback, elapsed_time)
+
+    finally:
+        monitor.stop()
+        job_records.save_job(job_id, peak_rss_bytes=monitor.peak_rss_bytes, peak_disk_bytes=monitor.peak_disk_bytes)
+        if monitor.peak_disk_bytes:
+            resources.record_job_usage(repo, monitor.peak_rss_bytes, monitor.peak_disk_bytes)
+        if not keep_workspace:
+            pipeline.remove_workspace_dir(job_id)
+
+def _save_job_outcome(job_id, state, status, pull_request_url=None, error=None):
+    """Record how a job ended, with the timings and usage of the stages it completed."""
+    usage = aider_coder.combine_usage(state.get('usage'))
+    job_records.save_job(
+        job_id,
+        status=status,
+        timings=state.get('timings', {}),
+        pull_request_url=pull_request_url,
+        tokens_sent=usage['tokens_sent'],
+        tokens_received=usage['tokens_received'],
+        cost=usage['cost'],
+        coding_peak_rss_bytes=state.get('coding_peak_rss_bytes'),
+        model_route=state.get('model_route'),
+        escalated=state.get('escalated'),
+        error=error
+    )
+
+def _ensure_workspace(context, state):
+    """ Make sure the job's workspace holds the repository as the last stage left it
 
-        files_list = _extract_files_list_from_issue(issue['body'])
-
-        # Check for conventions file
-        conventions_file_path = os.getenv('CONVENTIONS_FILE_PATH')
-        conventions_file = None
-        if conventions_file_path:
-            full_conventions_path = Path(repo_dir) / conventions_file_path
-            if full_conventions_path.exists():
-                conventions_file = str(full_conventions_path)
-                logger.info(f"Found conventions file: {conventions_file}")
-
-        # Prepare the prompt
-        issue_pr_prompt = f"Please help me resolve this issue.\n\nIssue Title: {issue['title']}\n\nIssue Body: {issue['body']}"
-        
-        if comments:
-            issue_pr_prompt += "\n\nComments:\n"
-            for comment in comments:
-                issue_pr_prompt += f"\n- {comment['body']}"
-
-        coding_result = aider_coder.do_coding_request(
-            prompt=issue_pr_prompt,
-            files_list=files_list,
+    A retry can run on a different worker from the one that ran the earlier
+    stages. In that case the repository is cloned again and any edit is
+    replayed from the patch saved in the checkpoint.
+    """
+    if os.path.exists(state['repo_dir']):
+        return
+
+    logger.info(f"Workspace {state['repo_dir']} is missing, restoring it from the checkpoint")
+    git_commands.clone_repository(
+        token=context['token'],
+        temp_dir=state['repo_dir'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        branch=state['clone_branch']
+    )
+    git_commands.reset_to_commit(
+        repo_dir=state['repo_dir'],
+        commit_hash=state['initial_commit_hash']
+    )
+    if state.get('patch') and not git_commands.apply_patch(state['repo_dir'], state['patch']):
+        raise RuntimeError("Failed to replay the edit onto a fresh clone of the repository")
+
+def _check_admission(context):
+    """Raise JobDeferred if the repository is too big for this worker to clone now."""
+    if not context.get('check_admission'):
+        return
+    repository = github_api.get_repository(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name']
+    )
+    admission.check_admission(
+        repo=f"{context['owner']}/{context['repo_name']}",
+        repo_size_kb=repository.get('size') if repository else None,
+        queue=context.get('queue')
+    )
+
+def _clone_into_workspace(context, branch):
+    """ Check out the repository into the job's workspace
+
+    Jobs in a batch check out a worktree of the batch's shared clone
+    (context['shared_repo_dir']) instead of cloning the repository again.
+    """
+    workspace_dir = pipeline.get_workspace_dir(context['job_id'])
+    # A previous attempt at this stage may have left a partial clone behind
+    shutil.rmtree(workspace_dir, ignore_errors=True)
+
+    shared_repo_dir = context.get('shared_repo_dir')
+    if shared_repo_dir:
+        initial_commit_hash = git_commands.get_current_commit_hash(shared_repo_dir)
+        with context['git_lock']:
+            git_commands.prune_worktrees(shared_repo_dir)
+            git_commands.add_worktree(shared_repo_dir, workspace_dir, initial_commit_hash)
+        logger.info(f"Checked out worktree of {shared_repo_dir} into workspace: {workspace_dir}")
+        return {
+            'repo_dir': workspace_dir,
+            'clone_branch': branch,
+            'initial_commit_hash': initial_commit_hash
+        }
+
+    repo_dir, initial_commit_hash = git_commands.clone_repository(
+        token=context['token'],
+        temp_dir=workspace_dir,
+        owner=context['owner'],
+        repo=context['repo_name'],
+        branch=branch
+    )
+    logger.info(f"Cloned repository into workspace: {repo_dir}")
+    return {
+        'repo_dir': repo_dir,
+        'clone_branch': branch,
+        'initial_commit_hash': initial_commit_hash
+    }
+
+def _run_routed_coding_request(context, state, coding_request, route, size):
+    """ Run a coding request on a route's model, starting from the initial commit
+
+    Returns the coding result and a description of the attempt for
+    model_routing.record_attempt.
+    """
+    git_commands.reset_to_commit(repo_dir=state['repo_dir'], commit_hash=state['initial_commit_hash'])
+    start_time = time.time()
+    coding_result = isolation.do_coding_request(
+        **coding_request,
+        root_folder_path=state['repo_dir'],
+        model_name=model_routing.get_model_name(route),
+        check_interrupt=context['control'].check
+    )
+    attempt = {
+        'route': route,
+        'size': size,
+        'latency_seconds': time.time() - start_time,
+        'cost': (coding_result.get('usage') or {}).get('cost', 0.0),
+        'cached': coding_result.get('cached', False)
+    }
+    return coding_result, attempt
+
+def _max_peak_rss(*values):
+    values = [value for value in values if value]
+    return max(values) if values else None
+
+def _run_coding_request(context, state, prompt, files_list, conventions_file=None, use_cache=True, use_candidates=False, request_text=None, diff_lines=0):
+    """ Run aider on the workspace and describe the commits it made
+
+    The workspace is reset to the initial commit first, so that a retried
+    edit stage doesn't build on the commits of a failed attempt. Unless
+    candidates are used, the model is chosen by model_routing from the size
+    of request_text, files_list and diff_lines, and a request the fast model
+    makes no commits for is run again on the strong model. When the fast
+    model's changes still have to be verified, the request is kept in the
+    state so the escalate stage can run it again if they fail.
+    """
+    repo_dir = state['repo_dir']
+    initial_commit_hash = state['initial_commit_hash']
+    coding_request = {
+        'prompt': prompt,
+        'files_list': files_list,
+        'conventions_file': conventions_file,
+        'use_cache': use_cache
+    }
+    route = None
+    size = None
+    escalated = False
+
+    if use_candidates:
+        git_commands.reset_to_commit(repo_dir=repo_dir, commit_hash=initial_commit_hash)
+        coding_result = candidates.run_candidates(
+            specs=candidates.get_candidate_specs(),
             root_folder_path=repo_dir,
-            conventions_file=conventions_file
+            initial_commit_hash=initial_commit_hash,
+            check_interrupt=context['control'].check,
+            **coding_request
         )
+        usage = coding_result.get('usage')
+        peak_rss_bytes = None
+    else:
+        size = model_routing.estimate_request_size(request_text or prompt, files_list, diff_lines)
+        route = model_routing.choose_route(size)
+        coding_result, attempt = _run_routed_coding_request(context, state, coding_request, route, size)
+        usage = coding_result.get('usage')
+        peak_rss_bytes = coding_result.get('peak_rss_bytes')
+
+        if route == model_routing.FAST and git_commands.get_current_commit_hash(repo_dir) == initial_commit_hash:
+            model_routing.record_attempt(attempt, model_routing.NO_CHANGES)
+            logger.info("The fast model made no changes, escalating to the strong model")
+            route = model_routing.STRONG
+            escalated = True
+            coding_result, attempt = _run_routed_coding_request(context, state, coding_request, route, size)
+            usage = aider_coder.combine_usage(usage, coding_result.get('usage'))
+            peak_rss_bytes = _max_peak_rss(peak_rss_bytes, coding_result.get('peak_rss_bytes'))
+
+    # Check if any changes were made
+    current_commit_hash = git_commands.get_current_commit_hash(
+        repo_dir_path=repo_dir
+    )
+    has_changes = current_commit_hash != initial_commit_hash
+    if not has_changes:
+        logger.info("No changes were made by Aider")
+
+    # The outcome of an attempt whose changes are verified is recorded by the verify stage
+    pending_model_attempt = None
+    if route and not has_changes:
+        model_routing.record_attempt(attempt, model_routing.NO_CHANGES)
+    elif route and not verification.is_enabled():
+        model_routing.record_attempt(attempt, model_routing.SUCCEEDED)
+    elif route:
+        pending_model_attempt = attempt
+
+    return {
+        'commit_message': coding_result['commit_message'],
+        'summary': coding_result['summary'],
+        'has_changes': has_changes,
+        'edited_commit_hash': current_commit_hash,
+        'patch': git_commands.format_patch(repo_dir, initial_commit_hash) if has_changes else '',
+        'candidates': coding_result.get('candidates'),
+        'usage': usage,
+        'coding_peak_rss_bytes': peak_rss_bytes,
+        'model_route': route,
+        'escalated': escalated,
+        'pending_model_attempt': pending_model_attempt,
+        # Kept so the escalate stage can run the request again on the strong model
+        'coding_request': coding_request if route == model_routing.FAST and pending_model_attempt else None,
+        'request_size': size
+    }
+
+def _restore_edited_commit(state):
+    """Put the workspace back at the checkpointed edit, in case a retried stage left commits behind."""
+    repo_dir = state['repo_dir']
+    if git_commands.get_current_commit_hash(repo_dir) != state['edited_commit_hash']:
+        git_commands.reset_to_commit(repo_dir=repo_dir, commit_hash=state['initial_commit_hash'])
+        if not git_commands.apply_patch(repo_dir, state['patch']):
+            # Carrying on would check, and push, the base commit without the edit
+            raise RuntimeError("Failed to restore the checkpointed edit in the workspace")
+
+def _verification_updates(results):
+    return {
+        'verification': _compact_verification_results(results),
+        # Kept with their output for the fix-up prompt
+        'verification_failures': verification.get_failures(results)
+    }
+
+def _verify_stage(context, state):
+    """ Check the edited files with the configured linters and tests
+
+    The outcome of a routed model attempt is recorded here, and the attempt
+    is cleared in the same checkpoint, so a retried later stage can't count
+    it again.
+    """
+    if not state['has_changes'] or not verification.is_enabled():
+        return {}
+
+    _ensure_workspace(context, state)
+    _restore_edited_commit(state)
+    results = verification.verify_changes(state['repo_dir'], state['initial_commit_hash'], check_interrupt=context['control'].check)
+    model_attempt = state.get('pending_model_attempt')
+    if model_attempt:
+        failed = bool(verification.get_failures(results))
+        model_routing.record_attempt(model_attempt, model_routing.VERIFICATION_FAILED if failed else model_routing.SUCCEEDED)
+    return {**_verification_updates(results), 'pending_model_attempt': None}
+
+def _escalate_stage(context, state):
+    """ Run the request again on the strong model after the fast model's changes failed verification
+
+    If the strong model makes no changes, the fast model's changes are put
+    back and go on to the fix-up pass.
+    """
+    if not state.get('verification_failures') or not state.get('coding_request'):
+        return {}
+
+    _ensure_workspace(context, state)
+    logger.info("The fast model's changes failed verification, escalating to the strong model")
+    repo_dir = state['repo_dir']
+    initial_commit_hash = state['initial_commit_hash']
+    coding_result, attempt = _run_routed_coding_request(
+        context,
+        state,
+        state['coding_request'],
+        model_routing.STRONG,
+        state['request_size']
+    )
+    updates = {
+        'model_route': model_routing.STRONG,
+        'escalated': True,
+        'coding_request': None,
+        'usage': aider_coder.combine_usage(state.get('usage'), coding_result.get('usage')),
+        'coding_peak_rss_bytes': _max_peak_rss(state.get('coding_peak_rss_bytes'), coding_result.get('peak_rss_bytes'))
+    }
+    if git_commands.get_current_commit_hash(repo_dir) == initial_commit_hash:
+        model_routing.record_attempt(attempt, model_routing.NO_CHANGES)
+        if not git_commands.apply_patch(repo_dir, state['patch']):
+            raise RuntimeError("Failed to put the fast model's edit back after the strong model made no changes")
+        return updates
+
+    results = verification.verify_changes(repo_dir, initial_commit_hash, check_interrupt=context['control'].check)
+    failed = bool(verification.get_failures(results))
+    model_routing.record_attempt(attempt, model_routing.VERIFICATION_FAILED if failed else model_routing.SUCCEEDED)
+    return {
+        **updates,
+        **_verification_updates(results),
+        'commit_message': coding_result['commit_message'],
+        'summary': coding_result['summary'],
+        'edited_commit_hash': git_commands.get_current_commit_hash(repo_dir),
+        'patch': git_commands.format_patch(repo_dir, initial_commit_hash)
+    }
+
+def _fix_stage(context, state):
+    """Give aider one pass at fixing any failing checks before the changes are pushed."""
+    failures = state.get('verification_failures')
+    if not failures:
+        return {}
+
+    _ensure_workspace(context, state)
+    _restore_edited_commit(state)
+    repo_dir = state['repo_dir']
+    initial_commit_hash = state['initial_commit_hash']
+    check_interrupt = context['control'].check
+    logger.info(f"{len(failures)} verification checks failed, asking Aider to fix them")
+    fix_result = isolation.do_coding_request(
+        prompt=verification.build_fix_prompt(failures),
+        files_list=git_commands.get_changed_files(repo_dir, initial_commit_hash),
+        root_folder_path=repo_dir,
+        check_interrupt=check_interrupt
+    )
 
-        # Check if any changes were made
-        current_commit_hash = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
-
-        if current_commit_hash == initial_commit_hash:
-            logger.info("No changes were made by Aider")
-            comment_body = f"I've analyzed the issue, but no changes were necessary. Here's a summary of my findings:\n\n{coding_result['summary']}"
-            github_api.create_issue_comment(
-                token=token,
-                owner=owner,
-                repo=repo_name,
-                issue_number=issue['number'],
-                body=comment_body
-            )
-            github_api.delete_issue_reaction(
-                token=token,
-                owner=owner,
-                repo=repo_name,
-                issue_number=issue['number'],
-                reaction_id=eyes_reaction_id
-            )
-            return {"message": "No changes made, comment added to issue"}, 200
-
-        # Changes were made, proceed with creating a PR
-        branch_name = f"fix-issue-{issue['number']}"
-        git_commands.checkout_new_branch(
-            repo_dir=repo_dir,
-            branch_name=branch_name
-        )
+    results = verification.verify_changes(repo_dir, initial_commit_hash, check_interrupt=check_interrupt)
+    summary = state['summary']
+    if verification.get_failures(results):
+        summary += f"\n\nSome checks were still failing after an attempt to fix them:\n{verification.describe_results(verification.get_failures(results))}"
+
+    return {
+        **_verification_updates(results),
+        'summary': summary,
+        'edited_commit_hash': git_commands.get_current_commit_hash(repo_dir),
+        'patch': git_commands.format_patch(repo_dir, initial_commit_hash),
+        'usage': aider_coder.combine_usage(state.get('usage'), fix_result.get('usage')),
+        'coding_peak_rss_bytes': _max_peak_rss(state.get('coding_peak_rss_bytes'), fix_result.get('peak_rss_bytes'))
+    }
+
+def _describe_changes(state):
+    """Return the summary of the changes, noting any checks that didn't get to finish."""
+    summary = state['summary']
+    unfinished = verification.get_unfinished(state.get('verification') or [])
+    if unfinished:
+        summary += f"\n\nSome checks didn't finish within the time budget, so these weren't verified:\n{verification.describe_results(unfinished)}"
+    return summary
+
+def _compact_verification_results(results):
+    return [{'command': result['command'], 'status': result['status']} for result in results]
+
+def _issue_prepare_stage(context, state):
+    _check_admission(context)
+    issue = context['issue']
+    eyes_reaction_id = github_api.create_issue_reaction(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        issue_number=issue['number'],
+        reaction="eyes"
+    )
 
-        main_branch = github_api.get_default_branch(
-            token=token,
-            owner=owner,
-            repo=repo_name
-        )
+    return {
+        'eyes_reaction_id': eyes_reaction_id,
+        **_clone_into_workspace(context, branch=context.get('base_branch') or 'main')
+    }
+
+def _issue_edit_stage(context, state):
+    _ensure_workspace(context, state)
+    issue = context['issue']
+    comments = context['comments']
+    repo_dir = state['repo_dir']
+
+    files_list = _extract_files_list_from_issue(issue['body'])
+
+    # Check for conventions file
+    conventions_file_path = os.getenv('CONVENTIONS_FILE_PATH')
+    conventions_file = None
+    if conventions_file_path:
+        full_conventions_path = Path(repo_dir) / conventions_file_path
+        if full_conventions_path.exists():
+            conventions_file = str(full_conventions_path)
+            logger.info(f"Found conventions file: {conventions_file}")
+
+    # Prepare the prompt
+    issue_pr_prompt = f"Please help me resolve this issue.\n\nIssue Title: {issue['title']}\n\nIssue Body: {issue['body']}"
+
+    if comments:
+        issue_pr_prompt += "\n\nComments:\n"
+        for comment in comments:
+            issue_pr_prompt += f"\n- {comment['body']}"
+
+    request_texts = [issue['body']] + [comment['body'] for comment in comments]
+    use_cache = not any(result_cache.is_cache_opt_out(text) for text in request_texts)
+
+    return _run_coding_request(
+        context,
+        state,
+        prompt=issue_pr_prompt,
+        files_list=files_list,
+        conventions_file=conventions_file,
+        use_cache=use_cache,
+        use_candidates=candidates.is_candidates_requested(request_texts),
+        request_text="\n\n".join([issue['title']] + request_texts)
+    )
 
-        git_commands.push_changes_to_repository(
-            temp_dir=temp_dir,
+def _issue_push_stage(context, state):
+    if not state['has_changes']:
+        return {}
+
+    _ensure_workspace(context, state)
+    branch_name = f"fix-issue-{context['issue']['number']}"
+    git_commands.checkout_new_branch(
+        repo_dir=state['repo_dir'],
+        branch_name=branch_name
+    )
+
+    # Worktrees of a batch's shared clone share its refs, so they fetch and push one at a time
+    with context.get('git_lock') or contextlib.nullcontext():
+        pushed = git_commands.push_changes_to_repository(
+            temp_dir=state['repo_dir'],
             branch=branch_name
         )
+    if not pushed:
+        raise pipeline.TransientError(f"Failed to push changes to branch {branch_name}")
 
-        created_pull_request = github_api.create_pull_request(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            title=f"Fix issue #{issue['number']}: {coding_result['commit_message']}",
-            body=f"This PR addresses the changes requested in issue #{issue['number']}\n\n{coding_result['summary']}",
-            head=branch_name,
-            base=main_branch
-        )
+    return {'branch_name': branch_name}
 
-        if not created_pull_request:
-            logger.error("Failed to create pull request")
-            return {"error": "Failed to create pull request"}, 500
+def _create_issue_comment_once(context, issue_number, body, marker):
+    """ Comment on an issue, unless a comment containing marker is already there
 
-        logger.info(f"Pull request created: {created_pull_request['html_url']}")
+    A retried publish stage may have posted the comment before it failed.
+    """
+    comments = github_api.list_issue_comments(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        issue_number=issue_number
+    )
+    if any(marker in (comment.get('body') or '') for comment in comments):
+        logger.info(f"Issue #{issue_number} already has this comment, not posting it again")
+        return
+    github_api.create_issue_comment(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        issue_number=issue_number,
+        body=body
+    )
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time if start_time else None
-        time_info = f"\n\nTime taken to create this PR: {elapsed_time:.2f} seconds" if elapsed_time else ""
-        
-        comment_body = f"I've created a pull request to address this issue: {created_pull_request['html_url']}{time_info}"
-        logger.info("Adding comment to the issue")
-        github_api.create_issue_comment(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            issue_number=issue['number'],
-            body=comment_body
-        )
+def _reply_to_pr_review_comment_once(context, body, marker):
+    """Reply to the job's review comment, unless a reply containing marker is already there."""
+    pull_request = context['pull_request']
+    pr_review_comment = context['pr_review_comment']
+    replies = github_api.list_pr_review_comments(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        pr_number=pull_request['number']
+    )
+    if any(reply.get('in_reply_to_id') == pr_review_comment['id'] and marker in (reply.get('body') or '') for reply in replies):
+        logger.info(f"Review comment {pr_review_comment['id']} already has this reply, not posting it again")
+        return
+    github_api.reply_to_pr_review_comment(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        pr_number=pull_request['number'],
+        pr_review_comment_id=pr_review_comment['id'],
+        body=body
+    )
+
+def _issue_publish_stage(context, state):
+    token = context['token']
+    owner = context['owner']
+    repo_name = context['repo_name']
+    issue = context['issue']
+
+    if not state['has_changes']:
+        comment_body = f"I've analyzed the issue, but no changes were necessary. Here's a summary of my findings:\n\n{state['summary']}"
+        _create_issue_comment_once(context, issue['number'], comment_body, marker=comment_body)
         github_api.delete_issue_reaction(
             token=token,
             owner=owner,
             repo=repo_name,
             issue_number=issue['number'],
-            reaction_id=eyes_reaction_id
-        )
-        github_api.create_issue_reaction(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            issue_number=issue['number'],
-            reaction="rocket"
+            reaction_id=state['eyes_reaction_id']
         )
+        return {'result': {"message": "No changes made, comment added to issue"}}
 
-        return {"message": f"Pull request created and issue commented: {created_pull_request['html_url']}", "elapsed_time": elapsed_time}, 200
+    branch_name = state['branch_name']
+    main_branch = github_api.get_default_branch(
+        token=token,
+        owner=owner,
+        repo=repo_name
+    )
 
-    except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        import traceback
-        error_traceback = traceback.format_exc()
-        logger.error(f"Full traceback:\n{error_traceback}")
-        
-        # Post a comment about the error
-        error_comment = f"An error occurred while processing this issue:\n\n```\n{str(e)}\n\n{error_traceback}\n```"
-        github_api.create_issue_comment(
+    # A retried publish stage may already have opened the pull request
+    created_pull_request = github_api.get_pull_request_for_branch(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        branch=branch_name
+    )
+    if not created_pull_request:
+        created_pull_request = github_api.create_pull_request(
             token=token,
             owner=owner,
             repo=repo_name,
-            issue_number=issue['number'],
-            body=error_comment
+            title=f"Fix issue #{issue['number']}: {state['commit_message']}",
+            body=f"This PR addresses the changes requested in issue #{issue['number']}\n\n{_describe_changes(state)}",
+            head=branch_name,
+            base=main_branch
         )
-        
-        return {"error": "An internal error occurred"}, 500
 
-    finally:
-        # Clean up the temporary directory
-        shutil.rmtree(temp_dir)
-        logger.info(f"Cleaned up temporary directory: {temp_dir}")
+    if not created_pull_request:
+        raise pipeline.TransientError("Failed to create pull request")
 
-def _handle_pr_review_comment(token, owner, repo_name, pull_request, pr_review_comment):
-    logger.info(f"Processing PR review comment for PR #{pull_request['number']} in {owner}/{repo_name}")
-    start_time = time.time()
+    logger.info(f"Pull request created: {created_pull_request['html_url']}")
 
-    if not _is_aiderbot_mentioned(pr_review_comment['body']):
-        not_mentioned_message = "PR review comment ignored as @aiderbot was not mentioned"
-        logger.info(not_mentioned_message)
-        return {"message": not_mentioned_message}, 200
+    start_time = state.get('start_time')
+    elapsed_time = time.time() - start_time if start_time else None
+    time_info = f"\n\nTime taken to create this PR: {elapsed_time:.2f} seconds" if elapsed_time else ""
 
-    # Check if the comment is from the app user
-    if pr_review_comment['user']['login'] == APP_USER_NAME:
-        app_user_message = f"Comment from {APP_USER_NAME} ignored"
-        logger.info(app_user_message)
-        return {"message": app_user_message}, 200
+    comment_body = f"I've created a pull request to address this issue: {created_pull_request['html_url']}{time_info}"
+    logger.info("Adding comment to the issue")
+    _create_issue_comment_once(context, issue['number'], comment_body, marker=created_pull_request['html_url'])
+    github_api.delete_issue_reaction(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        issue_number=issue['number'],
+        reaction_id=state['eyes_reaction_id']
+    )
+    github_api.create_issue_reaction(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        issue_number=issue['number'],
+        reaction="rocket"
+    )
 
-    # Check if the user has sufficient permissions
-    author_association = pr_review_comment['author_association']
-    if author_association not in ['OWNER', 'MEMBER', 'COLLABORATOR']:
-        not_associated_message = f"Comment from user without sufficient permissions ignored: {pr_review_comment['user']['login']} (association: {author_association})"
-        logger.info(not_associated_message)
-        return {"message": not_associated_message}, 200
+    return {
+        'pull_request_url': created_pull_request['html_url'],
+        'result': {"message": f"Pull request created and issue commented: {created_pull_request['html_url']}", "elapsed_time": elapsed_time}
+    }
+
+ISSUE_STAGES = [
+    ('prepare', _issue_prepare_stage),
+    ('edit', _issue_edit_stage),
+    ('verify', _verify_stage),
+    ('escalate', _escalate_stage),
+    ('fix', _fix_stage),
+    ('push', _issue_push_stage),
+    ('publish', _issue_publish_stage),
+]
+
+def _describe_error(error, error_traceback):
+    return f"{str(error)}\n\n{error_traceback}" if error_traceback else str(error)
+
+def _report_issue_error(context, error, error_traceback, elapsed_time):
+    # Post a comment about the error
+    error_comment = f"An error occurred while processing this issue:\n\n```\n{_describe_error(error, error_traceback)}\n```"
+    github_api.create_issue_comment(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        issue_number=context['issue']['number'],
+        body=error_comment
+    )
+
+    return {"error": "An internal error occurred"}, 500
+
+def _create_pull_request_for_issue(token, owner, repo_name, issue, comments=None, start_time=None, job_id=None, can_retry=False, generation=None, queue=None, check_admission=False):
+    logger.info(f"Processing issue #{issue['number']} for {owner}/{repo_name}")
+
+    if not comments:
+        if not _is_aiderbot_mentioned(issue['title']) and not _is_aiderbot_mentioned(issue['body']):
+            logger.info(f"Ignoring issue #{issue['number']} as @aiderbot was not mentioned")
+            return {"message": "Issue ignored as @aiderbot was not mentioned"}, 200
+
+        author_association = issue['author_association']
+        if author_association not in AUTHORIZED_ASSOCIATIONS:
+            logger.info(f"Ignoring issue from user without sufficient permissions: {issue['user']['login']} (association: {author_association})")
+            return {"message": "Issue from user without sufficient permissions ignored"}, 200
+
+    return run_issue_job(
+        token,
+        owner,
+        repo_name,
+        issue,
+        comments=comments,
+        start_time=start_time,
+        job_id=job_id,
+        can_retry=can_retry,
+        generation=generation,
+        queue=queue,
+        check_admission=check_admission
+    )
+
+def run_issue_job(token, owner, repo_name, issue, comments=None, start_time=None, job_id=None, can_retry=False, generation=None, queue=None, check_admission=False, shared_repo_dir=None, base_branch=None, git_lock=None):
+    """ Run the pipeline that opens a pull request for an issue
+
+    Unlike the webhook tasks, this doesn't check who asked for it. The batch
+    runner calls it directly, with shared_repo_dir set to its shared clone of
+    the repository checked out at base_branch, and a git_lock shared by the
+    jobs using the clone.
+    """
+    context = {
+        'job_id': job_id or uuid.uuid4().hex,
+        'token': token,
+        'owner': owner,
+        'repo_name': repo_name,
+        'issue': issue,
+        'comments': comments or [],
+        'control': job_control.JobControl(
+            target=job_control.get_job_target(owner, repo_name, issue['number']),
+            generation=generation
+        ),
+        'queue': queue,
+        'check_admission': check_admission,
+        'shared_repo_dir': shared_repo_dir,
+        'base_branch': base_branch,
+        'git_lock': git_lock
+    }
+    return _run_job(
+        context,
+        stages=ISSUE_STAGES,
+        initial_state={'start_time': start_time},
+        can_retry=can_retry,
+        report_error=_report_issue_error
+    )
+
+def _pr_review_prepare_stage(context, state):
+    _check_admission(context)
+    token = context['token']
+    owner = context['owner']
+    repo_name = context['repo_name']
+    pull_request = context['pull_request']
+    pr_review_comment = context['pr_review_comment']
 
     eyes_reaction_id = github_api.create_pr_review_comment_reaction(
         token=token,
@@ -236,159 +801,210 @@ def _handle_pr_review_comment(token, owner, repo_name, pull_request, pr_review_c
         reaction="eyes"
     )
 
-    if 'LGTM' in pr_review_comment['body']:
-        logger.info("Comment contains 'LGTM', no action needed")
-        return {"message": "Comment acknowledged, no action needed"}, 200
+    # Get the original issue
+    issue_number = _extract_issue_number_from_pr_title(pull_request['title'])
+    logger.info(f"Extracted issue number: {issue_number}")
 
-    try:
-        # Get the original issue
-        issue_number = _extract_issue_number_from_pr_title(pull_request['title'])
-        logger.info(f"Extracted issue number: {issue_number}")
+    issue = github_api.get_issue(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        issue_number=issue_number
+    )
 
-        issue = github_api.get_issue(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            issue_number=issue_number
-        )
+    # Get the PR diff
+    pr_diff = github_api.get_pr_diff(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        pr_number=pull_request['number']
+    )
 
-        # Get the PR diff
-        pr_diff = github_api.get_pr_diff(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            pr_number=pull_request['number']
-        )
+    # Build the prompt
+    prompt = aider_coder.build_pr_review_prompt(
+        issue=issue,
+        pr_diff=pr_diff,
+        review_comment=pr_review_comment['body']
+    )
 
-        # Build the prompt
-        prompt = aider_coder.build_pr_review_prompt(
-            issue=issue,
-            pr_diff=pr_diff,
-            review_comment=pr_review_comment['body']
-        )
+    workspace = _clone_into_workspace(context, branch=pull_request['head']['ref'])
 
-        # Create a temporary directory
-        temp_dir = tempfile.mkdtemp(dir=os.getcwd(), prefix='repo_')
-        repo_dir, initial_commit_hash = git_commands.clone_repository(
-            token=token,
-            temp_dir=temp_dir,
-            owner=owner,
-            repo=repo_name,
-            branch=pull_request['head']['ref']
-        )
+    # Get the list of files changed in the PR
+    changed_pr_files = github_api.get_pr_changed_files(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        pr_number=pull_request['number']
+    )
+
+    files_mentioned_in_pr_review_comment = _extract_files_list_from_issue(pr_review_comment['body'])
+
+    return {
+        'eyes_reaction_id': eyes_reaction_id,
+        'prompt': prompt,
+        'files_list': list(set(changed_pr_files + files_mentioned_in_pr_review_comment)),
+        'pr_diff_lines': len(pr_diff.splitlines()) if pr_diff else 0,
+        **workspace
+    }
+
+def _pr_review_edit_stage(context, state):
+    _ensure_workspace(context, state)
+    return _run_coding_request(
+        context,
+        state,
+        prompt=state['prompt'],
+        files_list=state['files_list'],
+        use_cache=not result_cache.is_cache_opt_out(context['pr_review_comment']['body']),
+        use_candidates=candidates.is_candidates_requested([context['pr_review_comment']['body']]),
+        request_text=context['pr_review_comment']['body'],
+        diff_lines=state.get('pr_diff_lines', 0)
+    )
 
-        # Get the list of files changed in the PR
-        changed_pr_files = github_api.get_pr_changed_files(
+def _pr_review_push_stage(context, state):
+    if not state['has_changes']:
+        return {}
+
+    _ensure_workspace(context, state)
+    branch = context['pull_request']['head']['ref']
+    pushed = git_commands.push_changes_to_repository(
+        temp_dir=state['repo_dir'],
+        branch=branch
+    )
+    if not pushed:
+        raise pipeline.TransientError(f"Failed to push changes to branch {branch}")
+    return {}
+
+def _pr_review_publish_stage(context, state):
+    token = context['token']
+    owner = context['owner']
+    repo_name = context['repo_name']
+    pull_request = context['pull_request']
+    pr_review_comment = context['pr_review_comment']
+
+    if not state['has_changes']:
+        comment_body = f"I've analyzed the issue, but no changes were necessary. Here's a summary of my findings:\n\n{state['summary']}"
+        _reply_to_pr_review_comment_once(context, comment_body, marker=comment_body)
+        github_api.delete_pr_review_comment_reaction(
             token=token,
             owner=owner,
             repo=repo_name,
-            pr_number=pull_request['number']
+            pr_review_comment_id=pr_review_comment['id'],
+            reaction_id=state['eyes_reaction_id']
         )
+        return {'result': {"message": "No changes made, comment added to PR review comment"}}
 
-        files_mentioned_in_pr_review_comment = _extract_files_list_from_issue(pr_review_comment['body'])
+    elapsed_time = time.time() - state['start_time']
+    time_info = f"Time taken to process this PR review comment: {elapsed_time:.2f} seconds"
 
-        files_list = list(set(changed_pr_files + files_mentioned_in_pr_review_comment))
+    changes_message = f"I've updated the PR based on the review comment.\n\n{_describe_changes(state)}"
+    pr_comment_body = f"{changes_message}\n\n{time_info}"
 
-        coding_result = aider_coder.do_coding_request(
-            prompt=prompt,
-            files_list=files_list,
-            root_folder_path=repo_dir
-        )
+    # The time taken changes if the stage is retried, so look for the summary
+    _reply_to_pr_review_comment_once(context, pr_comment_body, marker=changes_message)
 
-        # Check if any changes were made
-        current_commit_hash = git_commands.get_current_commit_hash(
-            repo_dir_path=repo_dir
-        )
+    github_api.delete_pr_review_comment_reaction(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        pr_review_comment_id=pr_review_comment['id'],
+        reaction_id=state['eyes_reaction_id']
+    )
 
-        if current_commit_hash == initial_commit_hash:
-            logger.info("No changes were made by Aider")
-            comment_body = f"I've analyzed the issue, but no changes were necessary. Here's a summary of my findings:\n\n{coding_result['summary']}"
-            github_api.reply_to_pr_review_comment(
-                token=token,
-                owner=owner,
-                repo=repo_name,
-                pr_number=pull_request['number'],
-                pr_review_comment_id=pr_review_comment['id'],
-                body=comment_body
-            )
-            github_api.delete_pr_review_comment_reaction(
-                token=token,
-                owner=owner,
-                repo=repo_name,
-                pr_review_comment_id=pr_review_comment['id'],
-                reaction_id=eyes_reaction_id
-            )
-            return {"message": "No changes made, comment added to PR review comment"}, 200
-
-        git_commands.push_changes_to_repository(
-            temp_dir=temp_dir,
-            branch=pull_request['head']['ref']
-        )
+    github_api.create_pr_review_comment_reaction(
+        token=token,
+        owner=owner,
+        repo=repo_name,
+        pr_review_comment_id=pr_review_comment['id'],
+        reaction="rocket")
+
+    return {
+        'pull_request_url': pull_request.get('html_url'),
+        'result': {"message": "PR updated based on review comment", "commit_message": state['commit_message'], "elapsed_time": elapsed_time}
+    }
+
+PR_REVIEW_STAGES = [
+    ('prepare', _pr_review_prepare_stage),
+    ('edit', _pr_review_edit_stage),
+    ('verify', _verify_stage),
+    ('escalate', _escalate_stage),
+    ('fix', _fix_stage),
+    ('push', _pr_review_push_stage),
+    ('publish', _pr_review_publish_stage),
+]
+
+def _report_pr_review_error(context, error, error_traceback, elapsed_time):
+    time_info = f"Time taken before error occurred: {elapsed_time:.2f} seconds" if elapsed_time else ""
+
+    # Reply to the PR review comment about the error
+    error_comment = f"An error occurred while processing this PR review comment:\n\n```\n{_describe_error(error, error_traceback)}\n```\n\n{time_info}"
+
+    github_api.reply_to_pr_review_comment(
+        token=context['token'],
+        owner=context['owner'],
+        repo=context['repo_name'],
+        pr_number=context['pull_request']['number'],
+        pr_review_comment_id=context['pr_review_comment']['id'],
+        body=error_comment
+    )
 
+    return {"error": f"An internal error occurred: {str(error)}", "elapsed_time": elapsed_time}, 500
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        time_info = f"Time taken to process this PR review comment: {elapsed_time:.2f} seconds"
+def _handle_pr_review_comment(token, owner, repo_name, pull_request, pr_review_comment, job_id=None, can_retry=False, generation=None, queue=None, check_admission=False):
+    logger.info(f"Processing PR review comment for PR #{pull_request['number']} in {owner}/{repo_name}")
+    start_time = time.time()
 
-        pr_comment_body = f"I've updated the PR based on the review comment.\n\n{coding_result['summary']}\n\n{time_info}"
+    if not _is_aiderbot_mentioned(pr_review_comment['body']):
+        not_mentioned_message = "PR review comment ignored as @aiderbot was not mentioned"
+        logger.info(not_mentioned_message)
+        return {"message": not_mentioned_message}, 200
 
-        github_api.reply_to_pr_review_comment(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            pr_number=pull_request['number'],
-            pr_review_comment_id=pr_review_comment['id'],
-            body=pr_comment_body
-        )
+    # Check if the comment is from the app user
+    if pr_review_comment['user']['login'] == APP_USER_NAME:
+        app_user_message = f"Comment from {APP_USER_NAME} ignored"
+        logger.info(app_user_message)
+        return {"message": app_user_message}, 200
 
-        github_api.delete_pr_review_comment_reaction(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            pr_review_comment_id=pr_review_comment['id'],
-            reaction_id=eyes_reaction_id
-        )
+    # Check if the user has sufficient permissions
+    author_association = pr_review_comment['author_association']
+    if author_association not in AUTHORIZED_ASSOCIATIONS:
+        not_associated_message = f"Comment from user without sufficient permissions ignored: {pr_review_comment['user']['login']} (association: {author_association})"
+        logger.info(not_associated_message)
+        return {"message": not_associated_message}, 200
 
+    if 'LGTM' in pr_review_comment['body']:
         github_api.create_pr_review_comment_reaction(
             token=token,
             owner=owner,
             repo=repo_name,
             pr_review_comment_id=pr_review_comment['id'],
-            reaction="rocket")
-
-        return {"message": "PR updated based on review comment", "commit_message": coding_result['commit_message'], "elapsed_time": elapsed_time}, 200
-
-    except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        import traceback
-        error_traceback = traceback.format_exc()
-        logger.error(f"Full traceback:\n{error_traceback}")
-        
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        time_info = f"Time taken before error occurred: {elapsed_time:.2f} seconds"
-        
-        # Reply to the PR review comment about the error
-        error_comment = f"An error occurred while processing this PR review comment:\n\n```\n{str(e)}\n\n{error_traceback}\n```\n\n{time_info}"
-
-        github_api.reply_to_pr_review_comment(
-            token=token,
-            owner=owner,
-            repo=repo_name,
-            pr_number=pull_request['number'],
-            pr_review_comment_id=pr_review_comment['id'],
-            body=error_comment
+            reaction="eyes"
         )
-        
-        return {"error": f"An internal error occurred: {str(e)}", "elapsed_time": elapsed_time}, 500
+        logger.info("Comment contains 'LGTM', no action needed")
+        return {"message": "Comment acknowledged, no action needed"}, 200
 
-    finally:
-        # Clean up the temporary directory
-        if temp_dir:
-            shutil.rmtree(temp_dir)
-            logger.info(f"Cleaned up temporary directory: {temp_dir}")
+    context = {
+        'job_id': job_id or uuid.uuid4().hex,
+        'token': token,
+        'owner': owner,
+        'repo_name': repo_name,
+        'pull_request': pull_request,
+        'pr_review_comment': pr_review_comment,
+        'control': job_control.JobControl(
+            target=job_control.get_job_target(owner, repo_name, pull_request['number']),
+            generation=generation
+        ),
+        'queue': queue,
+        'check_admission': check_admission
+    }
+    return _run_job(
+        context,
+        stages=PR_REVIEW_STAGES,
+        initial_state={'start_time': start_time},
+        can_retry=can_retry,
+        report_error=_report_pr_review_error
+    )
 
-def _handle_issue_comment(token, owner, repo_name, issue, comment):
+def _handle_issue_comment(token, owner, repo_name, issue, comment, job_id=None, can_retry=False, generation=None, queue=None, check_admission=False):
     """ Handle an issue comment event
 
     This function 
@@ -408,13 +1024,14 @@ def _handle_issue_comment(token, owner, repo_name, issue, comment):
 
     # Check if the user has sufficient permissions
     author_association = comment['author_association']
-    if author_association not in ['OWNER', 'MEMBER', 'COLLABORATOR']:
+    if author_association not in AUTHORIZED_ASSOCIATIONS:
         not_associated_message = f"Ignoring comment from user without sufficient permissions: {comment['user']['login']} (association: {author_association})"
         logger.info(not_associated_message)
         return {"message": not_associated_message}, 204
 
-    # Check if there's already a pull request for this issue
-    existing_prs = github_api.get_pull_requests_for_issue(
+    # Check if there's already a pull request for this issue. A retry of this
+    # job may have opened it itself before failing, so it carries on instead.
+    existing_prs = not pipeline.has_checkpoint(job_id) and github_api.get_pull_requests_for_issue(
         token=token,
         owner=owner,
         repo=repo_name,
@@ -430,7 +1047,12 @@ def _handle_issue_comment(token, owner, repo_name, issue, comment):
         owner=owner,
         repo_name=repo_name,
         issue=issue,
-        comments=[comment]
+        comments=[comment],
+        job_id=job_id,
+        can_retry=can_retry,
+        generation=generation,
+        queue=queue,
+        check_admission=check_admission
     )
 
 def _extract_issue_number_from_pr_title(title):
@@ -459,32 +1081,100 @@ def _extract_files_list_from_issue(issue_body):
                 break
     return files_list
 
-@app.task
-def task_create_pull_request_for_issue(payload):
-    return _create_pull_request_for_issue(
+def _run_task_with_retries(task, handler, admission_delays=0, **kwargs):
+    """ Run a job handler, retrying from the failed stage on transient errors
+
+    A job that isn't admitted is published again under the same task id,
+    either to the big-repository queue or to its own queue after a delay.
+    This doesn't use Celery's retry, so it doesn't use up the job's retries.
+    After MAX_ADMISSION_DELAYS delays the job runs anyway.
+    """
+    job_id = task.request.id
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    if task.request.retries:
+        job_records.save_job(job_id, retries=task.request.retries)
+    try:
+        response = handler(
+            job_id=job_id,
+            can_retry=task.request.retries < task.max_retries,
+            queue=queue,
+            check_admission=admission_delays < admission.MAX_ADMISSION_DELAYS,
+            **kwargs
+        )
+    except pipeline.StageFailed as e:
+        countdown = _retry_countdown(task.request.retries)
+        logger.info(f"Retrying task {job_id} in {countdown} seconds")
+        raise task.retry(exc=e, countdown=countdown)
+    except admission.JobDeferred as e:
+        countdown = 0 if e.queue else admission.ADMISSION_DELAY_SECONDS
+        task.apply_async(
+            args=task.request.args,
+            kwargs={**task.request.kwargs, 'admission_delays': admission_delays + (0 if e.queue else 1)},
+            task_id=job_id,
+            queue=e.queue or queue,
+            countdown=countdown
+        )
+        logger.info(f"Requeued task {job_id} on {e.queue or queue} in {countdown} seconds")
+        return {"message": f"Job deferred: {str(e)}"}, 200
+
+    # Handlers that decide there's nothing to do return before the job runs
+    if job_records.get_job_status(job_id) == job_records.QUEUED:
+        job_records.save_job(job_id, status=job_records.IGNORED)
+    return response
+
+@app.task(
+    bind=True,
+    max_retries=TASK_MAX_RETRIES,
+    soft_time_limit=job_control.TASK_SOFT_TIME_LIMIT_SECONDS,
+    time_limit=job_control.TASK_TIME_LIMIT_SECONDS
+)
+def task_create_pull_request_for_issue(self, payload, generation=None, admission_delays=0):
+    return _run_task_with_retries(
+        self,
+        _create_pull_request_for_issue,
         token=github_api.get_github_token_for_installation(payload['installation']['id']),
         owner=payload['repository']['owner']['login'],
         repo_name=payload['repository']['name'],
         issue=payload['issue'],
-        start_time=time.time()
+        start_time=time.time(),
+        generation=generation,
+        admission_delays=admission_delays
     )
 
-@app.task
-def task_handle_pr_review_comment(payload):
-    return _handle_pr_review_comment(
+@app.task(
+    bind=True,
+    max_retries=TASK_MAX_RETRIES,
+    soft_time_limit=job_control.TASK_SOFT_TIME_LIMIT_SECONDS,
+    time_limit=job_control.TASK_TIME_LIMIT_SECONDS
+)
+def task_handle_pr_review_comment(self, payload, generation=None, admission_delays=0):
+    return _run_task_with_retries(
+        self,
+        _handle_pr_review_comment,
         token=github_api.get_github_token_for_installation(payload['installation']['id']),
         owner=payload['repository']['owner']['login'],
         repo_name=payload['repository']['name'],
         pull_request=payload['pull_request'],
-        pr_review_comment=payload['comment']
+        pr_review_comment=payload['comment'],
+        generation=generation,
+        admission_delays=admission_delays
     )
 
-@app.task
-def task_handle_issue_comment(payload):
-    return _handle_issue_comment(
+@app.task(
+    bind=True,
+    max_retries=TASK_MAX_RETRIES,
+    soft_time_limit=job_control.TASK_SOFT_TIME_LIMIT_SECONDS,
+    time_limit=job_control.TASK_TIME_LIMIT_SECONDS
+)
+def task_handle_issue_comment(self, payload, generation=None, admission_delays=0):
+    return _run_task_with_retries(
+        self,
+        _handle_issue_comment,
         token=github_api.get_github_token_for_installation(payload['installation']['id']),
         owner=payload['repository']['owner']['login'],
         repo_name=payload['repository']['name'],
         issue=payload['issue'],
-        comment=payload['comment']
+        comment=payload['comment'],
+        generation=generation,
+        admission_delays=admission_delays
     )
@@ -0,0 +1,52 @@
+""" Run a single coding request in its own process
+
+Usage: python -m aiderbot.coding_worker <request.json>
+
+The request file holds the keyword arguments for
+aider_coder.do_coding_request and the path that the result is written to as
+JSON. aider writes its own output to stdout, so the result goes to a file.
+If the request fails, the error is written there instead and the process
+exits with 1. The result includes the process's peak RSS, with that of any
+processes it ran. The parent passes its correlation id in
+AIDERBOT_CORRELATION_ID so that this process's logs are attributed to the
+same job.
+"""
+import os
+import sys
+import json
+import logging
+import resource
+import traceback
+from . import aider_coder
+from .logging_config import setup_logging, set_correlation_id
+
+logger = logging.getLogger(__name__)
+
+def _get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    ) * 1024
+
+def main(request_path):
+    setup_logging()
+    set_correlation_id(os.getenv('AIDERBOT_CORRELATION_ID'))
+
+    with open(request_path) as request_file:
+        request = json.load(request_file)
+
+    try:
+        result = aider_coder.do_coding_request(**request['kwargs'])
+        exit_code = 0
+    except Exception as e:
+        logger.error(f"Coding request failed:\n{traceback.format_exc()}")
+        result = {'error': str(e)}
+        exit_code = 1
+
+    with open(request['result_path'], 'w') as result_file:
+        json.dump({**result, 'peak_rss_bytes': _get_peak_rss_bytes()}, result_file)
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
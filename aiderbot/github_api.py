@@ -4,45 +4,44 @@ import jwt
 import time
 import logging
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("debug.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 # GitHub App configuration
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
 GITHUB_APP_ID = os.getenv('GITHUB_APP_ID')
 GITHUB_PRIVATE_KEY_CONTENTS = os.getenv('GITHUB_PRIVATE_KEY_CONTENTS')
 
-def get_github_token_for_installation(installation_id):
+def _create_app_jwt():
+    """Create a JWT that authenticates as the GitHub App itself."""
     if not GITHUB_APP_ID:
         raise ValueError("GITHUB_APP_ID environment variable not set")
     if not GITHUB_PRIVATE_KEY_CONTENTS:
         raise ValueError("GITHUB_PRIVATE_KEY_CONTENTS environment variable not set")
 
-    try:
+    jwt_payload = {
+        'iat': int(time.time()),
+        'exp': int(time.time()) + 600,  # JWT expiration time (10 minutes maximum)
+        'iss': GITHUB_APP_ID
+    }
+    return jwt.encode(jwt_payload, GITHUB_PRIVATE_KEY_CONTENTS, algorithm='RS256')
 
-        jwt_payload = {
-            'iat': int(time.time()),
-            'exp': int(time.time()) + 600,  # JWT expiration time (10 minutes maximum)
-            'iss': GITHUB_APP_ID
-        }
+def _get_headers_with_app_jwt():
+    return {
+        'Authorization': f'Bearer {_create_app_jwt()}',
+        'Accept': 'application/vnd.github.v3+json'
+    }
 
-        # Create JWT
-        jwt_token = jwt.encode(jwt_payload, GITHUB_PRIVATE_KEY_CONTENTS, algorithm='RS256')
+def get_github_token_for_installation(installation_id):
+    if not GITHUB_APP_ID:
+        raise ValueError("GITHUB_APP_ID environment variable not set")
+    if not GITHUB_PRIVATE_KEY_CONTENTS:
+        raise ValueError("GITHUB_PRIVATE_KEY_CONTENTS environment variable not set")
 
+    try:
         # Get an installation access token
         token_response = requests.post(
-            f'https://api.github.com/app/installations/{installation_id}/access_tokens',
-            headers={
-                'Authorization': f'Bearer {jwt_token}',
-                'Accept': 'application/vnd.github.v3+json'
-            },
+            f'{GITHUB_API_URL}/app/installations/{installation_id}/access_tokens',
+            headers=_get_headers_with_app_jwt(),
         )
 
         token_response.raise_for_status()
@@ -61,6 +60,17 @@ def get_github_token_for_installation(installation_id):
 
     return None
 
+def get_installation_id_for_repository(owner, repo):
+    response = requests.get(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/installation",
+        headers=_get_headers_with_app_jwt()
+    )
+    if response.status_code == 200:
+        return response.json()['id']
+    else:
+        logger.error(f"Failed to get installation for repository: {response.text}")
+        return None
+
 def _get_headers_with_token(token, accept="application/vnd.github.v3+json"):
     return {
         "Authorization": f"token {token}",
@@ -70,7 +80,7 @@ def _get_headers_with_token(token, accept="application/vnd.github.v3+json"):
 
 def create_branch(token, owner, repo, branch_name, sha):
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/git/refs",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/refs",
         headers=_get_headers_with_token(token),
         json={
             "ref": f"refs/heads/{branch_name}",
@@ -85,7 +95,7 @@ def create_branch(token, owner, repo, branch_name, sha):
 
 def create_pull_request(token, owner, repo, title, body, head, base):
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls",
         headers=_get_headers_with_token(token),
         json={
             "title": title,
@@ -102,7 +112,7 @@ def create_pull_request(token, owner, repo, title, body, head, base):
 
 def create_issue_comment(token, owner, repo, issue_number, body):
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/issues/{issue_number}/comments",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{issue_number}/comments",
         headers=_get_headers_with_token(token),
         json={
             "body": body
@@ -114,10 +124,44 @@ def create_issue_comment(token, owner, repo, issue_number, body):
         logger.error(f"Failed to create issue comment: {response.text}")
         return None
 
+def _list_all_pages(token, url, description):
+    """ Return the items from every page of a list endpoint
+
+    Unlike the other helpers this raises on an HTTP error, since callers use
+    the whole list to decide whether something has already been posted, and
+    a partial list would look like it hadn't.
+    """
+    items = []
+    params = {"per_page": 100}
+    while url:
+        response = requests.get(url, headers=_get_headers_with_token(token), params=params)
+        if response.status_code != 200:
+            logger.error(f"Failed to list {description}: {response.text}")
+            response.raise_for_status()
+        items.extend(response.json())
+        # The next page's URL already includes the query parameters
+        url = response.links.get('next', {}).get('url')
+        params = None
+    return items
+
+def list_issue_comments(token, owner, repo, issue_number):
+    return _list_all_pages(
+        token,
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{issue_number}/comments",
+        "issue comments"
+    )
+
+def list_pr_review_comments(token, owner, repo, pr_number):
+    return _list_all_pages(
+        token,
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}/comments",
+        "PR review comments"
+    )
+
 def create_issue_reaction(token, owner, repo, issue_number, reaction):
 
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/issues/{issue_number}/reactions",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{issue_number}/reactions",
         headers=_get_headers_with_token(token),
         json={
         "content": reaction
@@ -137,7 +181,7 @@ def create_issue_reaction(token, owner, repo, issue_number, reaction):
 def delete_issue_reaction(token, owner, repo, issue_number, reaction_id):
 
     response = requests.delete(
-        f"https://api.github.com/repos/{owner}/{repo}/issues/{issue_number}/reactions/{reaction_id}",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{issue_number}/reactions/{reaction_id}",
         headers=_get_headers_with_token(token)
     )
     if response.status_code == 204:
@@ -148,7 +192,7 @@ def delete_issue_reaction(token, owner, repo, issue_number, reaction_id):
 
 def create_pr_review_comment_reaction(token, owner, repo, pr_review_comment_id, reaction):
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls/comments/{pr_review_comment_id}/reactions",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/comments/{pr_review_comment_id}/reactions",
         headers=_get_headers_with_token(token),
         json={
         "content": reaction
@@ -164,7 +208,7 @@ def create_pr_review_comment_reaction(token, owner, repo, pr_review_comment_id,
 def delete_pr_review_comment_reaction(token, owner, repo, pr_review_comment_id, reaction_id):
 
     response = requests.delete(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls/comments/{pr_review_comment_id}/reactions/{reaction_id}",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/comments/{pr_review_comment_id}/reactions/{reaction_id}",
         headers=_get_headers_with_token(token)
     )
     if response.status_code == 204:
@@ -176,7 +220,7 @@ def delete_pr_review_comment_reaction(token, owner, repo, pr_review_comment_id,
 
 def get_pull_requests_for_issue(token, owner, repo, issue_number):
     response = requests.get(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls",
         headers=_get_headers_with_token(token),
         params={
             "state": "open",
@@ -192,9 +236,53 @@ def get_pull_requests_for_issue(token, owner, repo, issue_number):
         logger.error(f"Failed to get pull requests: {response.text}")
         return []
 
+def get_pull_request_for_branch(token, owner, repo, branch):
+    response = requests.get(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls",
+        headers=_get_headers_with_token(token),
+        params={
+            "head": f"{owner}:{branch}",
+            "state": "open"
+        }
+    )
+    if response.status_code == 200:
+        prs = response.json()
+        return prs[0] if prs else None
+    else:
+        logger.error(f"Failed to get pull requests for branch: {response.text}")
+        return None
+
+def list_issues(token, owner, repo, labels=None, state='open', limit=None):
+    """ List a repository's issues, oldest first, following pagination
+
+    Pull requests, which the issues endpoint also returns, are left out.
+    """
+    issues = []
+    url = f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues"
+    params = {
+        "state": state,
+        "sort": "created",
+        "direction": "asc",
+        "per_page": 100
+    }
+    if labels:
+        params["labels"] = ",".join(labels)
+
+    while url and (limit is None or len(issues) < limit):
+        response = requests.get(url, headers=_get_headers_with_token(token), params=params)
+        if response.status_code != 200:
+            logger.error(f"Failed to list issues: {response.text}")
+            break
+        issues.extend(issue for issue in response.json() if 'pull_request' not in issue)
+        # The next page's URL already includes the query parameters
+        url = response.links.get('next', {}).get('url')
+        params = None
+
+    return issues[:limit] if limit is not None else issues
+
 def get_issue(token, owner, repo, issue_number):
     response = requests.get(
-        f"https://api.github.com/repos/{owner}/{repo}/issues/{issue_number}",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{issue_number}",
         headers=_get_headers_with_token(token)
     )
     if response.status_code == 200:
@@ -205,7 +293,7 @@ def get_issue(token, owner, repo, issue_number):
 
 def get_pr_diff(token, owner, repo, pr_number):
     response = requests.get(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}",
         headers=_get_headers_with_token(
             token,
             accept="application/vnd.github.v3.diff"
@@ -219,7 +307,7 @@ def get_pr_diff(token, owner, repo, pr_number):
 
 def get_pr_changed_files(token, owner, repo, pr_number):
     response = requests.get(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}/files",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}/files",
         headers=_get_headers_with_token(token),
     )
     if response.status_code == 200:
@@ -230,7 +318,7 @@ def get_pr_changed_files(token, owner, repo, pr_number):
 
 def create_pr_comment(token, owner, repo, pr_number, body):
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/issues/{pr_number}/comments",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/issues/{pr_number}/comments",
         headers=_get_headers_with_token(token),
         json={
             "body": body
@@ -244,7 +332,7 @@ def create_pr_comment(token, owner, repo, pr_number, body):
 
 def reply_to_pr_review_comment(token, owner, repo, pr_number, pr_review_comment_id, body):
     response = requests.post(
-        f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}/comments",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/pulls/{pr_number}/comments",
         headers=_get_headers_with_token(token),
         json={
             "body": body,
@@ -258,14 +346,18 @@ def reply_to_pr_review_comment(token, owner, repo, pr_number, pr_review_comment_
         logger.error(f"Failed to reply to PR review comment: {response.text}")
         return None
 
-def get_default_branch(token, owner, repo):
+def get_repository(token, owner, repo):
     response = requests.get(
-        f"https://api.github.com/repos/{owner}/{repo}",
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}",
         headers=_get_headers_with_token(token)
     )
 
     if response.status_code == 200:
-        return response.json()['default_branch']
+        return response.json()
     else:
-        logger.error(f"Failed to get default branch: {response.text}")
+        logger.error(f"Failed to get repository: {response.text}")
         return None
+
+def get_default_branch(token, owner, repo):
+    repository = get_repository(token, owner, repo)
+    return repository['default_branch'] if repository else None
@@ -0,0 +1,215 @@
+""" Handing webhook deliveries over to Celery
+
+In the default sync mode the webhook publishes each task to the broker
+before responding. In buffered mode (AIDERBOT_INGEST_MODE=buffered) the
+webhook only puts the task on a bounded in-process queue and responds
+straight away, and a background thread publishes queued tasks through one
+pooled broker connection. If the queue is full because the broker is slow
+or down, the delivery is handled synchronously rather than dropped.
+
+A buffered delivery that fails to publish because the broker or Redis is
+unavailable stays at the front of the queue and is retried with backoff, so
+later deliveries can't overtake it. It's only dropped if the queue fills up
+while it's being retried.
+
+Buffered tasks that haven't been published yet are lost if the process is
+killed, so flush() is called when a gunicorn worker exits.
+"""
+import os
+import time
+import uuid
+import queue
+import atexit
+import logging
+import threading
+import redis
+import kombu.exceptions
+from . import job_control, job_records, routing
+from .celery_tasks import app, APP_USER_NAME, AUTHORIZED_ASSOCIATIONS
+from .logging_config import correlation_id, get_correlation_id
+
+logger = logging.getLogger(__name__)
+
+INGEST_MODE = os.getenv('AIDERBOT_INGEST_MODE', 'sync')
+INGEST_BUFFER_SIZE = int(os.getenv('AIDERBOT_INGEST_BUFFER_SIZE', 1000))
+# How long a worker that's shutting down waits for the buffer to drain
+INGEST_FLUSH_TIMEOUT_SECONDS = int(os.getenv('AIDERBOT_INGEST_FLUSH_TIMEOUT_SECONDS', 10))
+INGEST_RETRY_BACKOFF_SECONDS = float(os.getenv('AIDERBOT_INGEST_RETRY_BACKOFF_SECONDS', 1))
+INGEST_RETRY_BACKOFF_MAX_SECONDS = float(os.getenv('AIDERBOT_INGEST_RETRY_BACKOFF_MAX_SECONDS', 30))
+
+# Failures that are worth retrying a buffered delivery for
+RETRYABLE_EXCEPTIONS = (kombu.exceptions.OperationalError, redis.exceptions.RedisError, OSError)
+
+_buffer = None
+_publisher_thread = None
+_publisher_lock = threading.Lock()
+# Lets the publisher thread started before a fork be told apart from this process's own
+_publisher_pid = None
+# Buffered deliveries dropped by this process
+dropped_deliveries = 0
+
+def _is_new_aiderbot_request(payload):
+    """ Return True if the payload is an @aiderbot request that should supersede older jobs
+
+    This makes the same checks as the task handlers, so that a delivery the
+    handler would ignore can't cancel a job that's already running.
+    """
+    source = payload.get('comment') or payload.get('issue') or {}
+    if source.get('user', {}).get('login') == APP_USER_NAME:
+        return False
+    if source.get('author_association') not in AUTHORIZED_ASSOCIATIONS:
+        return False
+    # An LGTM review comment only gets a reaction
+    if 'pull_request' in payload and 'LGTM' in (source.get('body') or ''):
+        return False
+    text = f"{source.get('title') or ''}\n{source.get('body') or ''}"
+    return "@aiderbot" in text.lower()
+
+def _get_generation(task, payload, task_id):
+    """ Return the generation to publish the task with
+
+    For a new @aiderbot request this supersedes older jobs for the payload's
+    target and creates the job's record, so it's done once per delivery,
+    however many times publishing it is tried.
+    """
+    job_target = job_control.get_job_target_for_payload(payload)
+    if not _is_new_aiderbot_request(payload):
+        return job_control.get_current_generation(job_target)
+
+    generation = job_control.supersede_jobs(job_target)
+    # The record is created first so that it exists whenever the worker picks the task up
+    job_records.save_job(
+        task_id,
+        repo=f"{payload['repository']['owner']['login']}/{payload['repository']['name']}",
+        target=job_target,
+        kind=task.name,
+        status=job_records.QUEUED
+    )
+    return generation
+
+def _publish(task, payload, generation, task_id, producer=None):
+    """Publish the task to its repository's queue."""
+    job_target = job_control.get_job_target_for_payload(payload)
+    repo = f"{payload['repository']['owner']['login']}/{payload['repository']['name']}"
+    queue = routing.get_queue_for_repo(repo)
+    scheduled_task = task.apply_async(
+        args=[payload],
+        kwargs={'generation': generation},
+        task_id=task_id,
+        queue=queue,
+        producer=producer
+    )
+    logger.info(f"Scheduled task {scheduled_task.id} for {job_target} on queue {queue or routing.SHARED_QUEUE}")
+    return scheduled_task
+
+def _publish_now(task, payload):
+    task_id = str(uuid.uuid4())
+    return _publish(task, payload, _get_generation(task, payload, task_id), task_id)
+
+def _handle_buffered(item, producer=None):
+    with correlation_id(item['delivery_id']):
+        if not item['task']:
+            _cancel(item['payload'])
+            return
+        if 'generation' not in item:
+            # Kept on the item, so a retry publishes with the generation of the
+            # first attempt instead of superseding the jobs again
+            item['generation'] = _get_generation(item['task'], item['payload'], item['task_id'])
+        _publish(item['task'], item['payload'], item['generation'], item['task_id'], producer=producer)
+
+def _drop_buffered(item, reason):
+    global dropped_deliveries
+    dropped_deliveries += 1
+    with correlation_id(item['delivery_id']):
+        logger.error(f"Dropped buffered delivery ({reason}), {dropped_deliveries} dropped so far")
+
+def _publish_buffered():
+    item = None
+    backoff = INGEST_RETRY_BACKOFF_SECONDS
+    while True:
+        if item is None:
+            item = _buffer.get()
+        try:
+            # Reuse one broker connection for as long as there are queued deliveries
+            with app.producer_or_acquire() as producer:
+                while item:
+                    _handle_buffered(item, producer)
+                    _buffer.task_done()
+                    backoff = INGEST_RETRY_BACKOFF_SECONDS
+                    try:
+                        item = _buffer.get_nowait()
+                    except queue.Empty:
+                        item = None
+        except RETRYABLE_EXCEPTIONS as e:
+            if _buffer.full():
+                _drop_buffered(item, f"the buffer is full and publishing failed: {e}")
+                _buffer.task_done()
+                item = None
+                continue
+            logger.warning(f"Failed to publish buffered delivery, retrying in {backoff:.0f} seconds: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, INGEST_RETRY_BACKOFF_MAX_SECONDS)
+        except Exception as e:
+            # Retrying won't help, and would hold up the deliveries behind it
+            logger.exception("Failed to handle buffered delivery")
+            _drop_buffered(item, str(e))
+            _buffer.task_done()
+            item = None
+
+def _ensure_publisher():
+    global _buffer, _publisher_thread, _publisher_pid
+    with _publisher_lock:
+        if _publisher_pid == os.getpid():
+            return
+        _buffer = queue.Queue(INGEST_BUFFER_SIZE)
+        _publisher_thread = threading.Thread(target=_publish_buffered, name='ingest-publisher', daemon=True)
+        _publisher_thread.start()
+        _publisher_pid = os.getpid()
+        atexit.register(flush)
+
+def _cancel(payload):
+    """Cancel running jobs for the payload's issue or pull request."""
+    job_control.supersede_jobs(job_control.get_job_target_for_payload(payload))
+
+def _enqueue(task, payload):
+    """Buffer a delivery, or handle it synchronously if buffering is off or the buffer is full."""
+    if INGEST_MODE == 'buffered':
+        _ensure_publisher()
+        try:
+            _buffer.put_nowait({
+                'task': task,
+                'payload': payload,
+                'delivery_id': get_correlation_id(),
+                # A retry keeps the task ID, so it doesn't leave a second job record behind
+                'task_id': str(uuid.uuid4())
+            })
+            return
+        except queue.Full:
+            logger.warning("Ingest buffer is full, handling delivery synchronously")
+
+    if task:
+        _publish_now(task, payload)
+    else:
+        _cancel(payload)
+
+def dispatch(task, payload):
+    """Schedule task for a webhook payload, in the background when in buffered mode."""
+    _enqueue(task, payload)
+
+def cancel_jobs(payload):
+    """ Cancel running jobs for the payload's issue or pull request
+
+    This goes through the buffer like dispatch(), so that it can't overtake
+    a request that arrived before it.
+    """
+    _enqueue(None, payload)
+
+def flush(timeout=INGEST_FLUSH_TIMEOUT_SECONDS):
+    """Wait up to timeout seconds for buffered tasks to be published."""
+    if _buffer is None or _publisher_pid != os.getpid():
+        return
+    with _buffer.all_tasks_done:
+        if _buffer.unfinished_tasks:
+            _buffer.all_tasks_done.wait_for(lambda: not _buffer.unfinished_tasks, timeout=timeout)
+        if _buffer.unfinished_tasks:
+            logger.error(f"{_buffer.unfinished_tasks} buffered tasks weren't published before shutdown")
@@ -0,0 +1,136 @@
+""" Running coding requests in a supervised child process
+
+aider, litellm and the chat history hold on to memory, and in a long-lived
+worker process that memory builds up from one job to the next. With
+AIDERBOT_ISOLATE_CODING=true, each coding request runs in its own child
+process (aiderbot.coding_worker) instead, and the memory goes away with it.
+The child is killed if its memory passes AIDERBOT_CODING_MEMORY_LIMIT_MB
+(by default half the machine's memory, so it's stopped before the kernel
+runs out), or if the job is cancelled or runs out of time. Cloning, pushing, GitHub calls
+and checkpoints stay in the worker, so losing the child only loses the edit
+in progress.
+
+The worker itself is replaced by Celery once its own memory passes
+AIDERBOT_WORKER_MAX_MEMORY_MB (see celery_tasks).
+"""
+import os
+import sys
+import json
+import signal
+import logging
+import tempfile
+import subprocess
+from . import aider_coder, resources
+from .logging_config import get_correlation_id
+
+logger = logging.getLogger(__name__)
+
+ISOLATE_CODING = os.getenv('AIDERBOT_ISOLATE_CODING', 'false').lower() == 'true'
+def _get_default_memory_limit_bytes():
+    total_memory_bytes = resources.get_total_memory_bytes()
+    return total_memory_bytes // 2 if total_memory_bytes else 2048 * 1024 ** 2
+
+# Set to 0 to run the child without a memory limit
+CODING_MEMORY_LIMIT_BYTES = (
+    int(os.environ['AIDERBOT_CODING_MEMORY_LIMIT_MB']) * 1024 ** 2
+    if os.getenv('AIDERBOT_CODING_MEMORY_LIMIT_MB') else _get_default_memory_limit_bytes()
+)
+
+POLL_INTERVAL_SECONDS = 1
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class CodingMemoryExceeded(Exception):
+    """Raised when a coding request's child process uses more memory than it's allowed."""
+
+def get_child_env():
+    """ Return the environment for a coding_worker child of the current job
+
+    Children only log to stderr, which they share with the worker, rather
+    than each leaving a log file behind.
+    """
+    return {
+        **os.environ,
+        'PYTHONPATH': PACKAGE_ROOT,
+        'AIDERBOT_CORRELATION_ID': get_correlation_id() or '',
+        'AIDERBOT_LOG_DIR': '',
+    }
+
+def do_coding_request(check_interrupt=None, **kwargs):
+    """ Run aider_coder.do_coding_request, in a child process if ISOLATE_CODING is set
+
+    The result has the same keys either way, plus peak_rss_bytes for the
+    child when it runs in one.
+    """
+    if not ISOLATE_CODING:
+        return aider_coder.do_coding_request(check_interrupt=check_interrupt, **kwargs)
+    return run_in_child_process(check_interrupt=check_interrupt, **kwargs)
+
+def _kill(process):
+    """Kill the child's whole process group, which includes any commands aider ran."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+def run_in_child_process(check_interrupt=None, memory_limit_bytes=CODING_MEMORY_LIMIT_BYTES, **kwargs):
+    """ Run a coding request in a coding_worker child process and return its result
+
+    While the child runs, its memory (with any processes it starts) is
+    sampled, and check_interrupt is called, every POLL_INTERVAL_SECONDS. The
+    child is killed if it goes over memory_limit_bytes, raising
+    CodingMemoryExceeded, or if check_interrupt raises.
+    """
+    with tempfile.TemporaryDirectory(prefix='aiderbot_coding_') as request_dir:
+        request_path = os.path.join(request_dir, 'request.json')
+        result_path = os.path.join(request_dir, 'result.json')
+        with open(request_path, 'w') as request_file:
+            json.dump({'kwargs': kwargs, 'result_path': result_path}, request_file)
+
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'aiderbot.coding_worker', request_path],
+            env=get_child_env(),
+            stdout=subprocess.DEVNULL,
+            start_new_session=True
+        )
+        peak_rss_bytes = 0
+        try:
+            while True:
+                try:
+                    process.wait(timeout=POLL_INTERVAL_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                rss_bytes = resources.get_process_tree_rss_bytes(process.pid)
+                peak_rss_bytes = max(peak_rss_bytes, rss_bytes)
+                if memory_limit_bytes and rss_bytes > memory_limit_bytes:
+                    raise CodingMemoryExceeded(
+                        f"The coding request used {rss_bytes // 1024 ** 2} MB, over its limit of "
+                        f"{memory_limit_bytes // 1024 ** 2} MB, and was stopped"
+                    )
+                if check_interrupt:
+                    check_interrupt()
+        finally:
+            # Also reached when the job is cancelled or times out
+            _kill(process)
+
+        result = None
+        if os.path.exists(result_path):
+            with open(result_path) as result_file:
+                result = json.load(result_file)
+        # The child's own figure catches peaks between samples
+        peak_rss_bytes = max(peak_rss_bytes, (result or {}).get('peak_rss_bytes', 0))
+        logger.info(f"Coding request process exited with {process.returncode}, peak RSS {peak_rss_bytes} bytes")
+
+        if process.returncode < 0:
+            # Most likely the kernel's OOM killer, which would only kill it again on a retry
+            raise CodingMemoryExceeded(
+                f"The coding request process was killed by signal {-process.returncode}, "
+                f"most likely for running out of memory"
+            )
+        if process.returncode != 0 or result is None:
+            error = (result or {}).get('error') or f"exited with {process.returncode}"
+            raise RuntimeError(f"The coding request process failed: {error}")
+
+        return {**result, 'peak_rss_bytes': peak_rss_bytes}
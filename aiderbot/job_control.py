@@ -0,0 +1,123 @@
+""" Time budgets and cancellation for running jobs
+
+Every issue or pull request a job works on has a generation counter in
+Redis. The webhook bumps the counter when the issue is closed or when a newer
+@aiderbot request arrives for it, and a running job that sees the counter
+move past the generation it was started with stops at its next check. Each
+stage of a job also has a time budget, checked at the same points.
+"""
+import os
+import time
+import logging
+import redis
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+STAGE_BUDGETS_SECONDS = {
+    'prepare': int(os.getenv('AIDERBOT_PREPARE_BUDGET_SECONDS', 300)),
+    'edit': int(os.getenv('AIDERBOT_EDIT_BUDGET_SECONDS', 1200)),
+    'verify': int(os.getenv('AIDERBOT_VERIFY_BUDGET_SECONDS', 300)),
+    # Only used when the fast model's changes fail verification. Covers the
+    # strong model's edit and checking it again, for a request small enough
+    # to have been routed to the fast model.
+    'escalate': int(os.getenv('AIDERBOT_ESCALATE_BUDGET_SECONDS', 600)),
+    # Covers aider's fix-up pass and running the checks again
+    'fix': int(os.getenv('AIDERBOT_FIX_BUDGET_SECONDS', 600)),
+    'push': int(os.getenv('AIDERBOT_PUSH_BUDGET_SECONDS', 120)),
+    'publish': int(os.getenv('AIDERBOT_PUBLISH_BUDGET_SECONDS', 120)),
+}
+
+# Celery's limits are a backstop for stages that can't check their budget,
+# such as a git clone that hangs
+TASK_SOFT_TIME_LIMIT_SECONDS = sum(STAGE_BUDGETS_SECONDS.values()) + 60
+TASK_TIME_LIMIT_SECONDS = TASK_SOFT_TIME_LIMIT_SECONDS + 60
+
+# How often a running job reads its generation from Redis
+CANCELLATION_CHECK_INTERVAL_SECONDS = 2
+
+GENERATION_KEY_PREFIX = 'aiderbot:generation:'
+GENERATION_TTL_SECONDS = 30 * 24 * 60 * 60
+
+class JobInterrupted(BaseException):
+    """ Base class for stopping a job part way through
+
+    These derive from BaseException so that they pass through aider, which
+    catches Exception while it talks to the model.
+    """
+
+class JobCancelled(JobInterrupted):
+    """Raised when a job has been superseded or its issue closed."""
+
+class StageTimedOut(JobInterrupted):
+    """Raised when a stage runs past its time budget."""
+
+def get_job_target(owner, repo_name, number):
+    """Return the key identifying the issue or pull request a job works on."""
+    return f"{owner}/{repo_name}#{number}"
+
+def get_job_target_for_payload(payload):
+    number = payload['pull_request']['number'] if 'pull_request' in payload else payload['issue']['number']
+    return get_job_target(payload['repository']['owner']['login'], payload['repository']['name'], number)
+
+def get_current_generation(target):
+    try:
+        generation = get_redis_client().get(GENERATION_KEY_PREFIX + target)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read generation for {target}: {e}")
+        return None
+    return int(generation) if generation else 0
+
+def supersede_jobs(target):
+    """ Cancel any running jobs for target and return the new generation
+
+    Returns None if Redis is unavailable, in which case running jobs carry on.
+    """
+    try:
+        client = get_redis_client()
+        pipe = client.pipeline()
+        pipe.incr(GENERATION_KEY_PREFIX + target)
+        pipe.expire(GENERATION_KEY_PREFIX + target, GENERATION_TTL_SECONDS)
+        generation, _ = pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to supersede jobs for {target}: {e}")
+        return None
+    logger.info(f"Jobs for {target} superseded, generation is now {generation}")
+    return generation
+
+class JobControl:
+    """ Tracks the time budget and cancellation signal for one job
+
+    check() is called between stages and from inside the aider loop, and
+    raises JobCancelled or StageTimedOut when the job should stop.
+    """
+
+    def __init__(self, target, generation=None, budgets=None):
+        self.target = target
+        # Jobs queued before this feature, or while Redis was down, start at
+        # whatever the current generation is
+        self.generation = generation if generation is not None else get_current_generation(target)
+        self.budgets = budgets or STAGE_BUDGETS_SECONDS
+        self.stage = None
+        self.deadline = None
+        self._last_cancellation_check = 0
+
+    def start_stage(self, stage):
+        self.stage = stage
+        budget = self.budgets.get(stage)
+        self.deadline = time.time() + budget if budget else None
+        self._last_cancellation_check = 0
+        self.check()
+
+    def check(self):
+        now = time.time()
+        if self.deadline and now > self.deadline:
+            raise StageTimedOut(f"Stage '{self.stage}' ran past its time budget of {self.budgets[self.stage]} seconds")
+
+        if self.generation is None or now - self._last_cancellation_check < CANCELLATION_CHECK_INTERVAL_SECONDS:
+            return
+        self._last_cancellation_check = now
+
+        current_generation = get_current_generation(self.target)
+        if current_generation is not None and current_generation > self.generation:
+            raise JobCancelled(f"Job for {self.target} was superseded by a newer request or the issue was closed")
@@ -0,0 +1,168 @@
+""" Compact status records for jobs
+
+Each job has a small Redis hash holding its status, current stage, stage
+timings, pull request URL, token usage and peak memory and disk use, which
+expires after AIDERBOT_JOB_RECORD_TTL_SECONDS. When coding requests run in
+their own process, that process's peak memory is recorded separately. A
+sorted set per repository indexes its most recent jobs by creation time, so
+a repository's jobs can be listed without scanning keys. Celery's own task
+results aren't stored at all.
+
+Records are only kept for @aiderbot requests and backlog batches: the
+webhook or batch creates one when it queues a request, and a job creates
+one when it starts if there isn't one.
+"""
+import os
+import json
+import time
+import logging
+import dataclasses
+from dataclasses import dataclass, field
+from typing import Optional
+import redis
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+JOB_RECORD_TTL_SECONDS = int(os.getenv('AIDERBOT_JOB_RECORD_TTL_SECONDS', 7 * 24 * 60 * 60))
+# Only the newest jobs for each repository are kept in its index
+REPO_INDEX_MAX_JOBS = int(os.getenv('AIDERBOT_REPO_INDEX_MAX_JOBS', 200))
+
+JOB_RECORD_KEY_PREFIX = 'aiderbot:job:'
+REPO_INDEX_KEY_PREFIX = 'aiderbot:jobs_by_repo:'
+
+# Errors are kept short, the full traceback is in the logs and the GitHub comment
+MAX_ERROR_CHARS = 500
+
+QUEUED = 'queued'
+RUNNING = 'running'
+RETRYING = 'retrying'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+IGNORED = 'ignored'
+
+@dataclass
+class JobRecord:
+    job_id: str
+    repo: Optional[str] = None
+    target: Optional[str] = None
+    kind: Optional[str] = None
+    status: Optional[str] = None
+    phase: Optional[str] = None
+    created_at: Optional[float] = None
+    updated_at: Optional[float] = None
+    retries: int = 0
+    timings: dict = field(default_factory=dict)
+    pull_request_url: Optional[str] = None
+    tokens_sent: int = 0
+    tokens_received: int = 0
+    cost: float = 0.0
+    peak_rss_bytes: int = 0
+    peak_disk_bytes: int = 0
+    # Only measured when coding requests run in their own process
+    coding_peak_rss_bytes: Optional[int] = None
+    # The model route that made the changes, and whether it was escalated from the fast model
+    model_route: Optional[str] = None
+    escalated: bool = False
+    error: Optional[str] = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+# How each field is parsed from the string stored in the hash
+_FIELD_PARSERS = {
+    'created_at': float,
+    'updated_at': float,
+    'retries': int,
+    'timings': json.loads,
+    'tokens_sent': int,
+    'tokens_received': int,
+    'cost': float,
+    'peak_rss_bytes': int,
+    'peak_disk_bytes': int,
+    'coding_peak_rss_bytes': int,
+    'escalated': lambda value: value == 'True',
+}
+_FIELD_NAMES = {record_field.name for record_field in dataclasses.fields(JobRecord)}
+
+def _serialize(name, value):
+    if name == 'timings':
+        return json.dumps(value)
+    if name == 'error':
+        return str(value)[:MAX_ERROR_CHARS]
+    return str(value)
+
+def _parse(record_hash):
+    fields = {
+        name: _FIELD_PARSERS.get(name, str)(value)
+        for name, value in record_hash.items()
+        if name in _FIELD_NAMES
+    }
+    return JobRecord(**fields)
+
+def save_job(job_id, **fields):
+    """ Create or update the record for a job
+
+    Only the given fields are changed. Fields set to None are left out. When
+    repo is given, the job is added to that repository's index.
+    """
+    unknown_fields = set(fields) - _FIELD_NAMES
+    if unknown_fields:
+        raise ValueError(f"Unknown job record fields: {', '.join(sorted(unknown_fields))}")
+
+    now = time.time()
+    key = JOB_RECORD_KEY_PREFIX + job_id
+    mapping = {name: _serialize(name, value) for name, value in fields.items() if value is not None}
+    mapping['job_id'] = job_id
+    mapping['updated_at'] = now
+    try:
+        pipe = get_redis_client().pipeline()
+        pipe.hsetnx(key, 'created_at', now)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, JOB_RECORD_TTL_SECONDS)
+        if fields.get('repo'):
+            index_key = REPO_INDEX_KEY_PREFIX + fields['repo']
+            # nx keeps the original position when a job is saved again
+            pipe.zadd(index_key, {job_id: now}, nx=True)
+            pipe.zremrangebyrank(index_key, 0, -REPO_INDEX_MAX_JOBS - 1)
+            pipe.expire(index_key, JOB_RECORD_TTL_SECONDS)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to save job record for {job_id}: {e}")
+
+def get_job(job_id):
+    """Return the JobRecord for a job, or None if there isn't one."""
+    try:
+        record_hash = get_redis_client().hgetall(JOB_RECORD_KEY_PREFIX + job_id)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read job record for {job_id}: {e}")
+        return None
+    return _parse(record_hash) if record_hash else None
+
+def get_job_status(job_id):
+    try:
+        return get_redis_client().hget(JOB_RECORD_KEY_PREFIX + job_id, 'status')
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read job status for {job_id}: {e}")
+        return None
+
+def list_jobs_for_repo(repo, limit=50):
+    """Return the most recent JobRecords for a repository, newest first."""
+    index_key = REPO_INDEX_KEY_PREFIX + repo
+    try:
+        client = get_redis_client()
+        job_ids = client.zrevrange(index_key, 0, limit - 1)
+        pipe = client.pipeline()
+        for job_id in job_ids:
+            pipe.hgetall(JOB_RECORD_KEY_PREFIX + job_id)
+        record_hashes = pipe.execute()
+
+        # Records expire on their own, so drop them from the index as they're found
+        expired_job_ids = [job_id for job_id, record_hash in zip(job_ids, record_hashes) if not record_hash]
+        if expired_job_ids:
+            client.zrem(index_key, *expired_job_ids)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to list job records for {repo}: {e}")
+        return []
+    return [_parse(record_hash) for record_hash in record_hashes if record_hash]
@@ -0,0 +1,166 @@
+""" Logging setup shared by the web app, the Celery workers and child processes
+
+Records are written as JSON lines that carry the correlation id of the job
+or webhook delivery they belong to. The thread that logs only puts the record
+on a bounded queue; a QueueListener thread writes it to stderr and to a
+size-capped rotating file. Each process writes its own file, since rotation
+isn't safe with several processes sharing one. Celery's processes use stable
+names, so a recycled pool process carries on with its predecessor's file;
+other processes' files are named by pid, and are removed once the process
+has exited and the file is older than AIDERBOT_LOG_RETENTION_DAYS.
+"""
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_LEVEL = os.getenv('AIDERBOT_LOG_LEVEL', 'INFO')
+# Set to an empty string to only log to stderr
+LOG_DIR = os.getenv('AIDERBOT_LOG_DIR', 'logs')
+LOG_MAX_BYTES = int(os.getenv('AIDERBOT_LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('AIDERBOT_LOG_BACKUP_COUNT', 3))
+LOG_QUEUE_SIZE = int(os.getenv('AIDERBOT_LOG_QUEUE_SIZE', 10000))
+LOG_RETENTION_DAYS = float(os.getenv('AIDERBOT_LOG_RETENTION_DAYS', 7))
+
+_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+_queue_handler = None
+_listener = None
+_listener_pid = None
+
+def get_correlation_id():
+    return _correlation_id.get()
+
+def set_correlation_id(correlation_id):
+    """Set the correlation id for the current context and return a token to reset it with."""
+    return _correlation_id.set(correlation_id)
+
+def reset_correlation_id(token):
+    _correlation_id.reset(token)
+
+@contextmanager
+def correlation_id(value):
+    token = set_correlation_id(value)
+    try:
+        yield
+    finally:
+        reset_correlation_id(token)
+
+class CorrelationIdFilter(logging.Filter):
+    """Stamps records with the correlation id of the context they were logged in."""
+
+    def filter(self, record):
+        record.correlation_id = _correlation_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'timestamp': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'correlation_id': getattr(record, 'correlation_id', None),
+            'process': record.process,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class DroppingQueueHandler(QueueHandler):
+    """ QueueHandler that drops records when the queue is full
+
+    A full queue means the listener can't keep up, and blocking the caller
+    would defeat the point of logging off-thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_records = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_records += 1
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _prune_log_files():
+    """Remove the log files of exited processes that are older than LOG_RETENTION_DAYS."""
+    cutoff = time.time() - LOG_RETENTION_DAYS * 24 * 60 * 60
+    for file_name in os.listdir(LOG_DIR):
+        match = re.fullmatch(r'aiderbot-(\d+)\.log(\.\d+)?', file_name)
+        if not match or _is_running(int(match[1])):
+            continue
+        path = os.path.join(LOG_DIR, file_name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Another process got to it first
+            pass
+
+def _build_handlers(name):
+    formatter = JsonFormatter()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    handlers = [stream_handler]
+
+    if LOG_DIR:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        _prune_log_files()
+        file_handler = RotatingFileHandler(
+            os.path.join(LOG_DIR, f'aiderbot-{name or os.getpid()}.log'),
+            maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT,
+            # Not created until something is logged, so replaced handlers don't leave empty files
+            delay=True
+        )
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    return handlers
+
+def setup_logging(force=False, name=None):
+    """ Route the root logger through a queue to a background listener
+
+    name is used for the process's log file instead of its pid. Calling
+    this again does nothing unless force is set. Forked processes must call
+    it with force=True, because the listener thread doesn't survive the fork.
+    """
+    global _queue_handler, _listener, _listener_pid
+    if _listener and not force:
+        return
+
+    root_logger = logging.getLogger()
+    if _queue_handler:
+        root_logger.removeHandler(_queue_handler)
+    if _listener:
+        atexit.unregister(_listener.stop)
+        if _listener_pid == os.getpid():
+            _listener.stop()
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(CorrelationIdFilter())
+    _listener = QueueListener(log_queue, *_build_handlers(name), respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(LOG_LEVEL)
+    atexit.register(_listener.stop)
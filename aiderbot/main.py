@@ -4,26 +4,31 @@ load_dotenv()
 from flask import Flask, request, jsonify
 import hmac
 import hashlib
+import json
 import os
 import logging
 from .celery_tasks import task_create_pull_request_for_issue, task_handle_pr_review_comment, task_handle_issue_comment
+from . import ingest, job_records, batch, model_routing
+from .logging_config import setup_logging, correlation_id
 
 app = Flask(__name__)
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("debug.log"),
-        logging.StreamHandler()
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # GitHub App configuration
 GITHUB_WEBHOOK_SECRET = os.getenv('GITHUB_WEBHOOK_SECRET', 'your_webhook_secret_here')
 
+# If set, the /jobs endpoints require this as a bearer token
+JOBS_API_TOKEN = os.getenv('AIDERBOT_JOBS_API_TOKEN')
+JOBS_API_MAX_LIMIT = 200
+
+EVENT_ACTION_TASK_MAP = {
+    ('issues', 'opened'): task_create_pull_request_for_issue,
+    ('issue_comment', 'created'): task_handle_issue_comment,
+    ('pull_request_review_comment', 'created'): task_handle_pr_review_comment
+}
+
 def verify_webhook_signature(payload_body, signature_header):
     """Verify that the payload was sent from GitHub by validating SHA256."""
     if not signature_header:
@@ -38,21 +43,77 @@ def verify_webhook_signature(payload_body, signature_header):
 def index():
     return jsonify({"message": "Hello, World!"})
 
+def _check_jobs_api_access():
+    """Return an error response if the request may not use the jobs API, otherwise None."""
+    if not JOBS_API_TOKEN:
+        # Job records include repository names and errors, so they're never served unauthenticated
+        return jsonify({"error": "The jobs API is disabled, set AIDERBOT_JOBS_API_TOKEN to enable it"}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {JOBS_API_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    access_error = _check_jobs_api_access()
+    if access_error:
+        return access_error
+    job = job_records.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    access_error = _check_jobs_api_access()
+    if access_error:
+        return access_error
+    repo = request.args.get('repo')
+    if not repo:
+        return jsonify({"error": "The repo parameter is required, as owner/name"}), 400
+    limit = min(request.args.get('limit', 50, type=int), JOBS_API_MAX_LIMIT)
+    jobs = job_records.list_jobs_for_repo(repo, limit=limit)
+    return jsonify({"jobs": [job.to_dict() for job in jobs]})
+
+@app.route('/model_routes', methods=['GET'])
+def get_model_route_stats():
+    access_error = _check_jobs_api_access()
+    if access_error:
+        return access_error
+    recent = min(request.args.get('recent', 50, type=int), model_routing.MAX_RECORDED_ATTEMPTS)
+    stats = model_routing.get_route_stats(recent_attempts=recent)
+    if stats is None:
+        return jsonify({"error": "Model route stats are unavailable"}), 503
+    return jsonify(stats)
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def get_batch_report(batch_id):
+    access_error = _check_jobs_api_access()
+    if access_error:
+        return access_error
+    report = batch.get_report(batch_id)
+    if not report:
+        return jsonify({"error": "Batch not found or not finished"}), 404
+    return jsonify(report)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    # Logs for a delivery are correlated by GitHub's delivery id, and the
+    # scheduled task's id is logged to link them to the job's own logs
+    with correlation_id(request.headers.get('X-GitHub-Delivery')):
+        return _handle_webhook()
+
+def _handle_webhook():
     try:
 
         signature = request.headers.get('X-Hub-Signature-256')
-        payload = request.data
+        payload_body = request.get_data()
 
-        if not verify_webhook_signature(payload, signature):
+        if not verify_webhook_signature(payload_body, signature):
             logger.warning("Webhook signature verification failed")
             return jsonify({"error": "Request signatures didn't match!"}), 403
 
-        logger.info("Webhook signature verified successfully")
-
         event = request.headers.get('X-GitHub-Event')
-        payload = request.json
+        payload = json.loads(payload_body) if payload_body else None
 
         if not event or not payload:
             return jsonify({"error": "Invalid payload"}), 400
@@ -61,15 +122,13 @@ def webhook():
 
         logger.info(f"Handling webhook:\nEvent: {event}\nAction: {action}")
 
-        EVENT_ACTION_TASK_MAP = {
-            ('issues', 'opened'): task_create_pull_request_for_issue,
-            ('issue_comment', 'created'): task_handle_issue_comment,
-            ('pull_request_review_comment', 'created'): task_handle_pr_review_comment
-        }
+        if (event, action) == ('issues', 'closed'):
+            ingest.cancel_jobs(payload)
+            return jsonify({"message": "Running jobs for the closed issue cancelled"}), 200
 
         matching_task = EVENT_ACTION_TASK_MAP.get((event, action))
         if matching_task:
-            matching_task.delay(payload)
+            ingest.dispatch(matching_task, payload)
             return jsonify({"message": f"Task scheduled for event {event} with action {action}"}), 200
         else:
             logger.info(f"Event {event} with action {action} is not handled, ignoring")
@@ -0,0 +1,119 @@
+""" Choosing a model for each coding request
+
+With AIDERBOT_FAST_MODEL set, requests that look small go to that model
+first, and everything else goes to the strong model, AIDER_MODEL. A request
+is small when its text, the number of files it names (or that the pull
+request changes) and the pull request's diff are all within the
+AIDERBOT_FAST_MAX_* thresholds. If the fast model makes no commits, or its
+changes fail verification, they're thrown away and the request is run
+again on the strong model.
+
+Each attempt's route, request size, latency, cost and outcome is recorded
+in Redis, both as running totals per route and as a list of the most recent
+attempts, so the thresholds can be tuned from what actually happened.
+Cached results aren't recorded.
+"""
+import os
+import json
+import time
+import logging
+import redis
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+FAST_MODEL = os.getenv('AIDERBOT_FAST_MODEL', '')
+FAST_MAX_REQUEST_CHARS = int(os.getenv('AIDERBOT_FAST_MAX_REQUEST_CHARS', 1500))
+FAST_MAX_FILES = int(os.getenv('AIDERBOT_FAST_MAX_FILES', 2))
+FAST_MAX_DIFF_LINES = int(os.getenv('AIDERBOT_FAST_MAX_DIFF_LINES', 200))
+
+FAST = 'fast'
+STRONG = 'strong'
+ROUTES = [FAST, STRONG]
+
+# Outcomes of an attempt
+SUCCEEDED = 'succeeded'
+NO_CHANGES = 'no_changes'
+VERIFICATION_FAILED = 'verification_failed'
+OUTCOMES = [SUCCEEDED, NO_CHANGES, VERIFICATION_FAILED]
+
+ROUTE_STATS_KEY_PREFIX = 'aiderbot:model_route:'
+ROUTE_ATTEMPTS_KEY = 'aiderbot:model_route_attempts'
+MAX_RECORDED_ATTEMPTS = 1000
+
+def estimate_request_size(request_text, files_list, diff_lines=0):
+    return {
+        'request_chars': len(request_text or ''),
+        'files': len(files_list or []),
+        'diff_lines': diff_lines or 0,
+    }
+
+def choose_route(size):
+    """Return FAST if the fast model is configured and the request is small, otherwise STRONG."""
+    if not FAST_MODEL:
+        return STRONG
+    if (size['request_chars'] <= FAST_MAX_REQUEST_CHARS
+            and size['files'] <= FAST_MAX_FILES
+            and size['diff_lines'] <= FAST_MAX_DIFF_LINES):
+        return FAST
+    return STRONG
+
+def get_model_name(route):
+    """Return the model for a route, or None for aider_coder's default, AIDER_MODEL."""
+    return FAST_MODEL if route == FAST else None
+
+def record_attempt(attempt, outcome):
+    """ Record how an attempt on a route turned out
+
+    attempt is the dict describing the attempt, with its route, size,
+    latency_seconds, cost and whether the result was cached.
+    """
+    if attempt.get('cached'):
+        return
+    logger.info(f"Model route {attempt['route']} attempt {outcome} in {attempt['latency_seconds']:.1f} seconds")
+    stats_key = ROUTE_STATS_KEY_PREFIX + attempt['route']
+    try:
+        pipe = get_redis_client().pipeline()
+        pipe.hincrby(stats_key, 'attempts', 1)
+        pipe.hincrby(stats_key, outcome, 1)
+        pipe.hincrbyfloat(stats_key, 'latency_seconds_total', attempt['latency_seconds'])
+        pipe.hincrbyfloat(stats_key, 'cost_total', attempt['cost'])
+        pipe.lpush(ROUTE_ATTEMPTS_KEY, json.dumps({**attempt, 'outcome': outcome, 'recorded_at': time.time()}))
+        pipe.ltrim(ROUTE_ATTEMPTS_KEY, 0, MAX_RECORDED_ATTEMPTS - 1)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to record model route attempt: {e}")
+
+def get_route_stats(recent_attempts=50):
+    """Return the totals and rates for each route, and the most recent attempts."""
+    try:
+        client = get_redis_client()
+        pipe = client.pipeline()
+        for route in ROUTES:
+            pipe.hgetall(ROUTE_STATS_KEY_PREFIX + route)
+        pipe.lrange(ROUTE_ATTEMPTS_KEY, 0, recent_attempts - 1)
+        *route_hashes, attempts = pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read model route stats: {e}")
+        return None
+
+    routes = {}
+    for route, route_hash in zip(ROUTES, route_hashes):
+        count = int(route_hash.get('attempts', 0))
+        routes[route] = {
+            'attempts': count,
+            **{outcome: int(route_hash.get(outcome, 0)) for outcome in OUTCOMES},
+            'success_rate': int(route_hash.get(SUCCEEDED, 0)) / count if count else None,
+            'mean_latency_seconds': float(route_hash.get('latency_seconds_total', 0)) / count if count else None,
+            'mean_cost': float(route_hash.get('cost_total', 0)) / count if count else None,
+        }
+    return {
+        'fast_model': FAST_MODEL or None,
+        'thresholds': {
+            'request_chars': FAST_MAX_REQUEST_CHARS,
+            'files': FAST_MAX_FILES,
+            'diff_lines': FAST_MAX_DIFF_LINES,
+        },
+        'routes': routes,
+        'recent_attempts': [json.loads(attempt) for attempt in attempts],
+    }
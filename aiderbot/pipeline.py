@@ -0,0 +1,167 @@
+""" Staged job pipeline with checkpoints
+
+A job runs as a list of named stages (prepare, edit, push, publish). Each
+stage takes the job's context, which holds things that must not be persisted
+such as the installation token, and the job's state, and returns a dict that
+is merged into the state. After every stage the state is checkpointed to
+Redis, so when Celery retries a job it resumes at the stage that failed
+rather than cloning the repository and calling the model again.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import subprocess
+import requests
+import redis
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_TTL_SECONDS = int(os.getenv('AIDERBOT_CHECKPOINT_TTL_SECONDS', 24 * 60 * 60))
+CHECKPOINT_KEY_PREFIX = 'aiderbot:checkpoint:'
+
+WORKSPACE_ROOT = os.getenv('AIDERBOT_WORKSPACE_ROOT', os.getcwd())
+# Job workspaces, with their candidate worktrees, and batch clones
+WORKSPACE_PREFIXES = ('repo_', 'batch_')
+WORKSPACE_SWEEP_INTERVAL_SECONDS = 60 * 60
+
+# Failures that are likely to succeed if the stage is run again
+TRANSIENT_EXCEPTIONS = (
+    requests.exceptions.RequestException,
+    subprocess.CalledProcessError,
+    redis.exceptions.ConnectionError,
+)
+
+class TransientError(Exception):
+    """Raised by a stage for a failure that is worth retrying."""
+
+class StageFailed(Exception):
+    """Raised when a stage fails, recording which stage and whether to retry."""
+
+    def __init__(self, stage, original, transient):
+        super().__init__(f"Stage '{stage}' failed: {original}")
+        self.stage = stage
+        self.original = original
+        self.transient = transient
+
+def get_workspace_dir(job_id):
+    """Return the directory a job clones into, which survives between retries."""
+    return os.path.join(WORKSPACE_ROOT, f'repo_{job_id}')
+
+def remove_workspace_dir(job_id):
+    workspace_dir = get_workspace_dir(job_id)
+    if os.path.exists(workspace_dir):
+        shutil.rmtree(workspace_dir)
+        logger.info(f"Cleaned up workspace directory: {workspace_dir}")
+
+def sweep_workspaces(max_age_seconds=CHECKPOINT_TTL_SECONDS):
+    """ Remove workspaces that haven't been touched for max_age_seconds
+
+    A job that fails with a transient error keeps its workspace for the
+    retry, but the retry often runs on another node, which clones again.
+    Once the checkpoint has expired no retry can use the workspace, so by
+    default anything older than the checkpoint TTL is removed.
+    """
+    cutoff = time.time() - max_age_seconds
+    try:
+        names = os.listdir(WORKSPACE_ROOT)
+    except OSError as e:
+        logger.warning(f"Failed to list workspaces in {WORKSPACE_ROOT}: {e}")
+        return
+    for name in names:
+        path = os.path.join(WORKSPACE_ROOT, name)
+        if not name.startswith(WORKSPACE_PREFIXES) or not os.path.isdir(path):
+            continue
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Removed stale workspace directory: {path}")
+
+def start_workspace_sweeper():
+    """Sweep stale workspaces now and then every WORKSPACE_SWEEP_INTERVAL_SECONDS."""
+    def sweep_periodically():
+        while True:
+            sweep_workspaces()
+            time.sleep(WORKSPACE_SWEEP_INTERVAL_SECONDS)
+
+    threading.Thread(target=sweep_periodically, name='workspace-sweeper', daemon=True).start()
+
+def load_checkpoint(job_id):
+    """Return the checkpoint for a job, or an empty one if there is none."""
+    try:
+        checkpoint = get_redis_client().get(CHECKPOINT_KEY_PREFIX + job_id)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to load checkpoint for job {job_id}: {e}")
+        checkpoint = None
+    if not checkpoint:
+        return {'completed_stages': [], 'state': {}}
+    return json.loads(checkpoint)
+
+def has_checkpoint(job_id):
+    """Return True if a job has completed stages to resume from."""
+    return bool(job_id and load_checkpoint(job_id)['completed_stages'])
+
+def save_checkpoint(job_id, completed_stages, state):
+    try:
+        get_redis_client().set(
+            CHECKPOINT_KEY_PREFIX + job_id,
+            json.dumps({'completed_stages': completed_stages, 'state': state}),
+            ex=CHECKPOINT_TTL_SECONDS
+        )
+    except redis.exceptions.RedisError as e:
+        # The job can carry on, it just won't be able to resume from here
+        logger.warning(f"Failed to save checkpoint for job {job_id}: {e}")
+
+def clear_checkpoint(job_id):
+    try:
+        get_redis_client().delete(CHECKPOINT_KEY_PREFIX + job_id)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to clear checkpoint for job {job_id}: {e}")
+
+def run_pipeline(job_id, stages, context, initial_state, control=None, on_stage_start=None):
+    """ Run the stages of a job in order and return the final state
+
+    Stages recorded as completed in the job's checkpoint are skipped, and
+    their outputs are restored into the state. Any exception raised by a
+    stage is wrapped in StageFailed. If a JobControl is given, each stage is
+    started against its time budget and the job is checked for cancellation
+    between stages. on_stage_start is called with each stage's name before
+    it runs.
+    """
+    checkpoint = load_checkpoint(job_id)
+    completed_stages = checkpoint['completed_stages']
+    state = {**initial_state, **checkpoint['state']}
+    state.setdefault('timings', {})
+
+    if completed_stages:
+        logger.info(f"Resuming job {job_id} after stages: {', '.join(completed_stages)}")
+
+    for stage_name, stage in stages:
+        if stage_name in completed_stages:
+            continue
+
+        logger.info(f"Running stage '{stage_name}' for job {job_id}")
+        if on_stage_start:
+            on_stage_start(stage_name)
+        if control:
+            control.start_stage(stage_name)
+        stage_start_time = time.time()
+        try:
+            output = stage(context, state)
+        except (TransientError,) + TRANSIENT_EXCEPTIONS as e:
+            raise StageFailed(stage_name, e, transient=True) from e
+        except Exception as e:
+            raise StageFailed(stage_name, e, transient=False) from e
+
+        state.update(output or {})
+        state['timings'][stage_name] = time.time() - stage_start_time
+        completed_stages.append(stage_name)
+        save_checkpoint(job_id, completed_stages, state)
+
+    return state
@@ -0,0 +1,13 @@
+import os
+import redis
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+
+_redis_client = None
+
+def get_redis_client():
+    """Return a Redis client shared by the whole process, created on first use."""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _redis_client
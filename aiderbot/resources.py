@@ -0,0 +1,172 @@
+""" Measuring the disk and memory that jobs use
+
+JobResourceMonitor samples a running job's memory (the worker process and
+any child processes, such as aider candidates and check commands) and the
+size of its workspace, and keeps the peaks. When a job finishes, its peaks
+are recorded against its repository, so the next job for the repository
+can be admitted based on what it really needed, and folded into a moving
+average for the node, which the autoscaler uses to size the pool.
+
+Memory is read from /proc, so it's only measured on Linux.
+"""
+import os
+import time
+import shutil
+import logging
+import threading
+import redis
+from .redis_client import get_redis_client
+from .routing import NODE_NAME
+
+logger = logging.getLogger(__name__)
+
+# How often memory and the workspace size are sampled. Walking a large
+# workspace isn't free, so it's sampled less often.
+MEMORY_SAMPLE_SECONDS = 1
+DISK_SAMPLE_SECONDS = 10
+
+REPO_USAGE_KEY_PREFIX = 'aiderbot:repo_usage:'
+REPO_USAGE_TTL_SECONDS = 30 * 24 * 60 * 60
+NODE_USAGE_KEY_PREFIX = 'aiderbot:node_usage:'
+# Weight of the latest job in the node's moving average
+NODE_USAGE_SMOOTHING = 0.2
+
+def get_free_disk_bytes(path):
+    return shutil.disk_usage(path).free
+
+def _read_meminfo(field):
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def get_available_memory_bytes():
+    """Return MemAvailable from /proc/meminfo, or None if it can't be read."""
+    return _read_meminfo('MemAvailable')
+
+def get_total_memory_bytes():
+    """Return MemTotal from /proc/meminfo, or None if it can't be read."""
+    return _read_meminfo('MemTotal')
+
+def _get_rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def _get_child_pids(pid):
+    child_pids = []
+    try:
+        for thread_id in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{thread_id}/children') as children:
+                child_pids.extend(int(child_pid) for child_pid in children.read().split())
+    except OSError:
+        pass
+    return child_pids
+
+def get_process_tree_rss_bytes(pid=None):
+    """Return the combined RSS of a process and all of its descendants."""
+    pending = [pid or os.getpid()]
+    total = 0
+    while pending:
+        current_pid = pending.pop()
+        total += _get_rss_bytes(current_pid)
+        pending.extend(_get_child_pids(current_pid))
+    return total
+
+def get_directory_size_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+class JobResourceMonitor:
+    """ Samples a job's memory and workspace size in the background
+
+    The memory of other jobs sharing the process isn't separated out, so
+    with a threaded pool the peaks are an upper bound.
+    """
+
+    def __init__(self, workspace_dir):
+        self.workspace_dir = workspace_dir
+        self.peak_rss_bytes = 0
+        self.peak_disk_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='job-resource-monitor', daemon=True)
+
+    def _sample_disk(self):
+        if os.path.exists(self.workspace_dir):
+            self.peak_disk_bytes = max(self.peak_disk_bytes, get_directory_size_bytes(self.workspace_dir))
+
+    def _run(self):
+        last_disk_sample = 0
+        while not self._stop.is_set():
+            self.peak_rss_bytes = max(self.peak_rss_bytes, get_process_tree_rss_bytes())
+            if time.time() - last_disk_sample >= DISK_SAMPLE_SECONDS:
+                self._sample_disk()
+                last_disk_sample = time.time()
+            self._stop.wait(MEMORY_SAMPLE_SECONDS)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling, taking a last sample of the workspace before it's removed."""
+        self._stop.set()
+        self._thread.join()
+        self._sample_disk()
+
+def record_job_usage(repo, peak_rss_bytes, peak_disk_bytes):
+    """Record a finished job's peaks against its repository and this node."""
+    repo_key = REPO_USAGE_KEY_PREFIX + repo
+    node_key = NODE_USAGE_KEY_PREFIX + NODE_NAME
+    try:
+        client = get_redis_client()
+        node_usage = get_node_usage()
+        averages = {
+            'rss_bytes': peak_rss_bytes,
+            'disk_bytes': peak_disk_bytes,
+        }
+        if node_usage:
+            averages = {
+                name: int(node_usage[name] + NODE_USAGE_SMOOTHING * (value - node_usage[name]))
+                for name, value in averages.items()
+            }
+
+        pipe = client.pipeline()
+        pipe.hset(repo_key, mapping={'rss_bytes': peak_rss_bytes, 'disk_bytes': peak_disk_bytes})
+        pipe.expire(repo_key, REPO_USAGE_TTL_SECONDS)
+        pipe.hset(node_key, mapping=averages)
+        pipe.expire(node_key, REPO_USAGE_TTL_SECONDS)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to record resource usage for {repo}: {e}")
+
+def _get_usage(key):
+    try:
+        usage = get_redis_client().hgetall(key)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read resource usage from {key}: {e}")
+        return None
+    return {name: int(value) for name, value in usage.items()} if usage else None
+
+def get_repo_usage(repo):
+    """Return the peak rss_bytes and disk_bytes of the last job for repo, or None."""
+    return _get_usage(REPO_USAGE_KEY_PREFIX + repo)
+
+def get_node_usage():
+    """Return the moving averages of rss_bytes and disk_bytes per job on this node, or None."""
+    return _get_usage(NODE_USAGE_KEY_PREFIX + NODE_NAME)
@@ -0,0 +1,103 @@
+""" Content-addressed cache for aider results
+
+Each entry is keyed by the model name, the prompt and the hash of the
+repository tree that aider was given, and holds the commits aider made as a
+patch series together with the summary. When a task is retried, or the same
+request arrives twice, the patch is replayed locally instead of calling the
+model again.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import redis
+from . import git_commands
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.getenv('AIDER_CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_TTL_SECONDS = int(os.getenv('AIDER_CACHE_TTL_SECONDS', 7 * 24 * 60 * 60))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv('AIDER_CACHE_MAX_ENTRY_BYTES', 1024 * 1024))
+CACHE_MAX_ENTRIES = int(os.getenv('AIDER_CACHE_MAX_ENTRIES', 500))
+
+CACHE_KEY_PREFIX = 'aiderbot:result_cache:'
+CACHE_INDEX_KEY = 'aiderbot:result_cache_index'
+
+# Mentioning this marker in an issue or comment skips the cache for that request
+CACHE_OPT_OUT_MARKER = '--no-cache'
+
+def is_cache_opt_out(text):
+    return CACHE_OPT_OUT_MARKER in (text or '')
+
+def build_cache_key(model_name, prompt, repo_dir, files_list, conventions_file=None):
+    """ Build the cache key for a coding request
+
+    The tree hash covers the contents of every tracked file, including the
+    conventions file, so any change to the repository produces a new key.
+    """
+    key_hash = hashlib.sha256()
+    key_hash.update(model_name.encode('utf-8'))
+    key_hash.update(b'\0' + prompt.encode('utf-8'))
+    key_hash.update(b'\0' + git_commands.get_tree_hash(repo_dir).encode('utf-8'))
+    for file in sorted(str(file) for file in files_list):
+        key_hash.update(b'\0' + file.encode('utf-8'))
+    if conventions_file:
+        key_hash.update(b'\0' + os.path.relpath(conventions_file, repo_dir).encode('utf-8'))
+    return key_hash.hexdigest()
+
+def get_cached_result(cache_key):
+    """Return the cached result for cache_key, or None on a miss."""
+    try:
+        entry = get_redis_client().get(CACHE_KEY_PREFIX + cache_key)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read from result cache: {e}")
+        return None
+
+    if not entry:
+        logger.info(f"Result cache miss: {cache_key}")
+        return None
+
+    logger.info(f"Result cache hit: {cache_key}")
+    return json.loads(entry)
+
+def store_result(cache_key, patch, commit_message, summary):
+    """ Store the result of a coding request
+
+    Entries larger than CACHE_MAX_ENTRY_BYTES are not cached, and the oldest
+    entries are evicted once there are more than CACHE_MAX_ENTRIES.
+    """
+    entry = json.dumps({
+        'patch': patch,
+        'commit_message': commit_message,
+        'summary': summary,
+        'created_at': time.time()
+    })
+    if len(entry.encode('utf-8')) > CACHE_MAX_ENTRY_BYTES:
+        logger.info(f"Result too large to cache ({len(entry)} bytes): {cache_key}")
+        return False
+
+    try:
+        client = get_redis_client()
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.set(CACHE_KEY_PREFIX + cache_key, entry, ex=CACHE_TTL_SECONDS)
+        pipe.zadd(CACHE_INDEX_KEY, {cache_key: now})
+        pipe.zremrangebyscore(CACHE_INDEX_KEY, 0, now - CACHE_TTL_SECONDS)
+        pipe.execute()
+
+        excess = client.zcard(CACHE_INDEX_KEY) - CACHE_MAX_ENTRIES
+        if excess > 0:
+            evicted_keys = client.zrange(CACHE_INDEX_KEY, 0, excess - 1)
+            pipe = client.pipeline()
+            pipe.delete(*[CACHE_KEY_PREFIX + key for key in evicted_keys])
+            pipe.zrem(CACHE_INDEX_KEY, *evicted_keys)
+            pipe.execute()
+            logger.info(f"Evicted {len(evicted_keys)} entries from result cache")
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to write to result cache: {e}")
+        return False
+
+    logger.info(f"Stored result in cache: {cache_key}")
+    return True
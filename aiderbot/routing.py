@@ -0,0 +1,195 @@
+""" Routing jobs for the same repository to the same worker node
+
+With AIDERBOT_ROUTING_ENABLED=true, every worker node consumes its own
+queue as well as the shared one, and registers itself in Redis with a
+heartbeat. The webhook hashes owner/repo onto a consistent hash ring of the
+live nodes and publishes the job to that node's queue, so a repository's
+jobs land where its local state, such as a kept workspace, is warm. When
+nodes join or leave, only the repositories on the ring segments that moved
+change node.
+
+Load is kept even in two ways. The webhook publishes to the shared queue
+instead when the chosen node's queue is already deep. And each node's
+heartbeat thread moves the excess from any deep node queue, and everything
+from the queues of nodes that have stopped heartbeating, to the shared
+queue, which every node consumes. A node that has left is kept in a retired
+set, and its queue drained on every heartbeat, until well after the webhook
+could still be publishing to it from a cached ring.
+
+Queues are Redis lists on the broker, which is the same Redis as REDIS_URL.
+Only messages at the default priority are moved.
+"""
+import os
+import time
+import socket
+import bisect
+import hashlib
+import logging
+import threading
+import redis
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+ROUTING_ENABLED = os.getenv('AIDERBOT_ROUTING_ENABLED', 'false').lower() == 'true'
+NODE_NAME = os.getenv('AIDERBOT_NODE_NAME') or os.getenv('FLY_MACHINE_ID') or socket.gethostname()
+NODE_HEARTBEAT_SECONDS = int(os.getenv('AIDERBOT_NODE_HEARTBEAT_SECONDS', 15))
+# A node that hasn't sent a heartbeat for this long is treated as gone
+NODE_TTL_SECONDS = int(os.getenv('AIDERBOT_NODE_TTL_SECONDS', 60))
+# Jobs beyond this many waiting in a node's queue go to the shared queue
+NODE_QUEUE_MAX_DEPTH = int(os.getenv('AIDERBOT_NODE_QUEUE_MAX_DEPTH', 3))
+VIRTUAL_NODES = 64
+
+SHARED_QUEUE = 'celery'
+NODE_QUEUE_PREFIX = 'aiderbot.node.'
+NODES_KEY = 'aiderbot:nodes'
+RETIRED_NODES_KEY = 'aiderbot:retired_nodes'
+REBALANCE_LOCK_KEY = 'aiderbot:rebalance_lock'
+
+# How long the webhook reuses the list of live nodes before reading it again
+LIVE_NODES_CACHE_SECONDS = 5
+# How long the queue of a node that has left keeps being drained
+RETIRED_NODE_DRAIN_SECONDS = 12 * LIVE_NODES_CACHE_SECONDS
+
+_ring = None
+_ring_read_at = 0
+_ring_lock = threading.Lock()
+# Set when this node leaves, so a late heartbeat doesn't add it back
+_left = threading.Event()
+
+def get_node_queue(node_name):
+    return NODE_QUEUE_PREFIX + node_name
+
+def _hash(value):
+    return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """A consistent hash ring with VIRTUAL_NODES points per node."""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = frozenset(nodes)
+        points = sorted(
+            (_hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(virtual_nodes)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """Return the node that owns key, or None if the ring is empty."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+def get_live_nodes():
+    try:
+        return get_redis_client().zrangebyscore(NODES_KEY, time.time() - NODE_TTL_SECONDS, '+inf')
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read live worker nodes: {e}")
+        return []
+
+def _get_ring():
+    global _ring, _ring_read_at
+    with _ring_lock:
+        if not _ring or time.time() - _ring_read_at > LIVE_NODES_CACHE_SECONDS:
+            nodes = get_live_nodes()
+            if not _ring or _ring.nodes != frozenset(nodes):
+                _ring = HashRing(nodes)
+            _ring_read_at = time.time()
+        return _ring
+
+def get_queue_depth(queue_name):
+    try:
+        return get_redis_client().llen(queue_name)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read the depth of queue {queue_name}: {e}")
+        return 0
+
+def get_queue_for_repo(repo):
+    """ Return the queue to publish a job for repo ("owner/name") to
+
+    Returns None, meaning the shared queue, if routing is off, there are no
+    live nodes, or the repository's node already has a deep queue.
+    """
+    if not ROUTING_ENABLED:
+        return None
+
+    node = _get_ring().get_node(repo)
+    if not node:
+        return None
+
+    queue_name = get_node_queue(node)
+    if get_queue_depth(queue_name) >= NODE_QUEUE_MAX_DEPTH:
+        logger.info(f"Queue {queue_name} is deep, sending the job for {repo} to the shared queue")
+        return None
+    return queue_name
+
+def _move_jobs(from_queue, count):
+    """Move up to count of the oldest jobs from a queue to the shared queue."""
+    client = get_redis_client()
+    moved = 0
+    while moved < count and client.rpoplpush(from_queue, SHARED_QUEUE):
+        moved += 1
+    if moved:
+        logger.info(f"Moved {moved} jobs from {from_queue} to the shared queue")
+    return moved
+
+def _retire(client, node):
+    """Take node off the ring, and keep draining its queue for RETIRED_NODE_DRAIN_SECONDS."""
+    pipe = client.pipeline()
+    pipe.zadd(RETIRED_NODES_KEY, {node: time.time()})
+    pipe.zrem(NODES_KEY, node)
+    pipe.execute()
+    queue_name = get_node_queue(node)
+    _move_jobs(queue_name, client.llen(queue_name))
+
+def rebalance():
+    """ Move jobs off deep node queues and the queues of nodes that have gone
+
+    Runs on one node at a time, under a lock in Redis.
+    """
+    client = get_redis_client()
+    if not client.set(REBALANCE_LOCK_KEY, NODE_NAME, nx=True, ex=NODE_HEARTBEAT_SECONDS):
+        return
+
+    stale_before = time.time() - NODE_TTL_SECONDS
+    for node, last_heartbeat in client.zrange(NODES_KEY, 0, -1, withscores=True):
+        queue_name = get_node_queue(node)
+        if last_heartbeat < stale_before:
+            logger.info(f"Worker node {node} has gone, moving its jobs to the shared queue")
+            _retire(client, node)
+        else:
+            _move_jobs(queue_name, client.llen(queue_name) - NODE_QUEUE_MAX_DEPTH)
+
+    drained_before = time.time() - RETIRED_NODE_DRAIN_SECONDS
+    for node, retired_at in client.zrange(RETIRED_NODES_KEY, 0, -1, withscores=True):
+        queue_name = get_node_queue(node)
+        _move_jobs(queue_name, client.llen(queue_name))
+        if retired_at < drained_before and not client.llen(queue_name):
+            client.zrem(RETIRED_NODES_KEY, node)
+
+def join():
+    """Add this node to the ring and start sending heartbeats."""
+    client = get_redis_client()
+    client.zadd(NODES_KEY, {NODE_NAME: time.time()})
+    client.zrem(RETIRED_NODES_KEY, NODE_NAME)
+    logger.info(f"Worker node {NODE_NAME} joined, consuming {get_node_queue(NODE_NAME)}")
+    threading.Thread(target=_heartbeat, name='routing-heartbeat', daemon=True).start()
+
+def leave():
+    """Remove this node from the ring and hand its waiting jobs to the other nodes."""
+    _left.set()
+    try:
+        _retire(get_redis_client(), NODE_NAME)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to leave the ring cleanly, other nodes will take over: {e}")
+
+def _heartbeat():
+    while not _left.wait(NODE_HEARTBEAT_SECONDS):
+        try:
+            get_redis_client().zadd(NODES_KEY, {NODE_NAME: time.time()})
+            rebalance()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Worker node heartbeat failed: {e}")
@@ -0,0 +1,186 @@
+""" Incremental verification of aider's changes
+
+Runs the configured linters and tests against only the files that aider
+changed. AIDERBOT_VERIFY_COMMANDS is a JSON list of glob patterns and command
+templates, for example:
+
+    [{"pattern": "*.py", "command": "ruff check {files}"},
+     {"pattern": "*.py", "command": "pytest -q {tests}"}]
+
+{files} is replaced with the changed files matching the pattern and {tests}
+with the test files for them, found by naming convention. Passing results are
+cached by command and file contents, so later jobs don't check unchanged
+files again. Tests can depend on any file in the repository, so a {tests}
+command's result is cached by the whole tree instead.
+"""
+import os
+import json
+import time
+import shlex
+import signal
+import hashlib
+import logging
+import subprocess
+from fnmatch import fnmatch
+import redis
+from . import git_commands
+from .redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+VERIFY_COMMANDS = json.loads(os.getenv('AIDERBOT_VERIFY_COMMANDS', '[]'))
+VERIFY_TIME_BUDGET_SECONDS = int(os.getenv('AIDERBOT_VERIFY_TIME_BUDGET_SECONDS', 120))
+VERIFY_CACHE_TTL_SECONDS = int(os.getenv('AIDERBOT_VERIFY_CACHE_TTL_SECONDS', 7 * 24 * 60 * 60))
+VERIFY_CACHE_KEY_PREFIX = 'aiderbot:verify_cache:'
+
+TEST_DIRS = ['tests', 'test']
+
+# Only the end of a failing command's output is kept for the fix-up prompt
+MAX_OUTPUT_CHARS = 4000
+
+def is_enabled():
+    return bool(VERIFY_COMMANDS)
+
+def find_test_files(repo_dir, paths):
+    """Return the test files covering paths, which may include the paths themselves."""
+    test_files = set()
+    for path in paths:
+        directory, filename = os.path.split(path)
+        stem, extension = os.path.splitext(filename)
+        if stem.startswith('test_') or stem.endswith('_test'):
+            test_files.add(path)
+            continue
+
+        test_filename = f"test_{stem}{extension}"
+        candidate_paths = [os.path.join(directory, test_filename)]
+        for test_dir in TEST_DIRS:
+            candidate_paths.append(os.path.join(test_dir, test_filename))
+            candidate_paths.append(os.path.join(test_dir, directory, test_filename))
+        test_files.update(
+            candidate_path for candidate_path in candidate_paths
+            if os.path.isfile(os.path.join(repo_dir, candidate_path))
+        )
+    return sorted(test_files)
+
+def build_targets(repo_dir, changed_files):
+    """Return the commands to run for the changed files, with the files each one covers."""
+    targets = []
+    for verify_command in VERIFY_COMMANDS:
+        matching_files = [path for path in changed_files if fnmatch(path, verify_command['pattern'])]
+        if not matching_files:
+            continue
+
+        template = verify_command['command']
+        test_files = find_test_files(repo_dir, matching_files) if '{tests}' in template else []
+        if '{tests}' in template and not test_files:
+            logger.info(f"No test files found for: {matching_files}")
+            continue
+
+        targets.append({
+            'command': template.format(files=shlex.join(matching_files), tests=shlex.join(test_files)),
+            'files': sorted(set(matching_files + test_files)),
+            'uses_tree': '{tests}' in template
+        })
+    return targets
+
+def _get_cache_key(command, blob_hashes, tree_hash=None):
+    key_hash = hashlib.sha256(command.encode('utf-8'))
+    if tree_hash:
+        key_hash.update(f"\0tree\0{tree_hash}".encode('utf-8'))
+    for path in sorted(blob_hashes):
+        key_hash.update(f"\0{path}\0{blob_hashes[path]}".encode('utf-8'))
+    return VERIFY_CACHE_KEY_PREFIX + key_hash.hexdigest()
+
+def _is_cached_pass(cache_key):
+    try:
+        return bool(get_redis_client().exists(cache_key))
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to read verification cache: {e}")
+        return False
+
+def _cache_pass(cache_key):
+    try:
+        get_redis_client().set(cache_key, 1, ex=VERIFY_CACHE_TTL_SECONDS)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Failed to write verification cache: {e}")
+
+def _run_command(command, repo_dir, timeout):
+    """Run a shell command, killing it and its children if it runs past timeout."""
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        start_new_session=True
+    )
+    try:
+        output, _ = process.communicate(timeout=timeout)
+        return ('passed' if process.returncode == 0 else 'failed'), output
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = process.communicate()
+        return 'timed_out', output
+
+def verify_changes(repo_dir, since_commit, check_interrupt=None):
+    """ Verify the files changed after since_commit
+
+    Returns a result per command with its status: passed, failed, timed_out
+    or skipped once the time budget has run out. Commands that time out or
+    are skipped don't count as failures.
+    """
+    changed_files = git_commands.get_changed_files(repo_dir, since_commit)
+    targets = build_targets(repo_dir, changed_files)
+    logger.info(f"Verifying {len(changed_files)} changed files with {len(targets)} commands")
+
+    blob_hashes = git_commands.get_blob_hashes(
+        repo_dir,
+        sorted({path for target in targets for path in target['files']})
+    )
+    tree_hash = git_commands.get_tree_hash(repo_dir) if any(target['uses_tree'] for target in targets) else None
+    deadline = time.time() + VERIFY_TIME_BUDGET_SECONDS
+    results = []
+    for target in targets:
+        if check_interrupt:
+            check_interrupt()
+
+        command = target['command']
+        cache_key = _get_cache_key(
+            command,
+            {path: blob_hashes.get(path) for path in target['files']},
+            tree_hash=tree_hash if target['uses_tree'] else None
+        )
+        if _is_cached_pass(cache_key):
+            results.append({'command': command, 'status': 'passed', 'cached': True, 'output': ''})
+            continue
+
+        remaining_time = deadline - time.time()
+        if remaining_time <= 0:
+            results.append({'command': command, 'status': 'skipped', 'cached': False, 'output': ''})
+            continue
+
+        start_time = time.time()
+        status, output = _run_command(command, repo_dir, timeout=remaining_time)
+        logger.info(f"Verification command `{command}` {status} in {time.time() - start_time:.2f} seconds")
+        if status == 'passed':
+            _cache_pass(cache_key)
+        results.append({'command': command, 'status': status, 'cached': False, 'output': output[-MAX_OUTPUT_CHARS:]})
+
+    return results
+
+def get_failures(results):
+    return [result for result in results if result['status'] == 'failed']
+
+def get_unfinished(results):
+    """Return the checks that timed out or were skipped, which don't count as failures."""
+    return [result for result in results if result['status'] in ('timed_out', 'skipped')]
+
+def build_fix_prompt(failures):
+    prompt = "The following checks failed after your changes. Please fix the problems they report.\n"
+    for failure in failures:
+        prompt += f"\nCommand: {failure['command']}\nOutput:\n```\n{failure['output']}\n```\n"
+    return prompt
+
+def describe_results(results):
+    return "\n".join(f"- `{result['command']}`: {result['status']}" for result in results)
@@ -0,0 +1,157 @@
+""" Local stand-in for the GitHub endpoints used by aiderbot.github_api
+
+Responds to every endpoint the app calls with a plausible canned response,
+optionally after a fixed delay to simulate network latency, and counts the
+requests it serves per endpoint.
+"""
+import re
+import json
+import time
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# (method, path pattern, endpoint name, status code)
+ROUTES = [
+    ('POST', r'^/app/installations/\d+/access_tokens$', 'access_tokens', 201),
+    ('POST', r'^/repos/[^/]+/[^/]+/issues/\d+/reactions$', 'create_issue_reaction', 201),
+    ('DELETE', r'^/repos/[^/]+/[^/]+/issues/\d+/reactions/[^/]+$', 'delete_issue_reaction', 204),
+    ('POST', r'^/repos/[^/]+/[^/]+/issues/\d+/comments$', 'create_issue_comment', 201),
+    ('GET', r'^/repos/[^/]+/[^/]+/issues/\d+/comments$', 'list_issue_comments', 200),
+    ('GET', r'^/repos/[^/]+/[^/]+/issues/\d+$', 'get_issue', 200),
+    ('GET', r'^/repos/[^/]+/[^/]+/issues$', 'list_issues', 200),
+    ('POST', r'^/repos/[^/]+/[^/]+/pulls/comments/\d+/reactions$', 'create_pr_review_comment_reaction', 201),
+    ('DELETE', r'^/repos/[^/]+/[^/]+/pulls/comments/\d+/reactions/[^/]+$', 'delete_pr_review_comment_reaction', 204),
+    ('GET', r'^/repos/[^/]+/[^/]+/pulls/\d+/files$', 'get_pr_changed_files', 200),
+    ('POST', r'^/repos/[^/]+/[^/]+/pulls/\d+/comments$', 'reply_to_pr_review_comment', 201),
+    ('GET', r'^/repos/[^/]+/[^/]+/pulls/\d+/comments$', 'list_pr_review_comments', 200),
+    ('GET', r'^/repos/[^/]+/[^/]+/pulls/\d+$', 'get_pr_diff', 200),
+    ('GET', r'^/repos/[^/]+/[^/]+/pulls$', 'list_pull_requests', 200),
+    ('POST', r'^/repos/[^/]+/[^/]+/pulls$', 'create_pull_request', 201),
+    ('POST', r'^/repos/[^/]+/[^/]+/git/refs$', 'create_branch', 201),
+    ('GET', r'^/repos/[^/]+/[^/]+/installation$', 'get_installation', 200),
+    ('GET', r'^/repos/[^/]+/[^/]+$', 'get_repository', 200),
+]
+
+FAKE_DIFF = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -1 +1,2 @@
+ # Benchmark repository
++Updated by the stub model
+"""
+
+class FakeGitHub:
+    """A threaded HTTP server answering GitHub API requests with canned responses."""
+
+    def __init__(self, latency_seconds=0.0, repo_size_kb=1024, num_issues=0):
+        self.latency_seconds = latency_seconds
+        self.repo_size_kb = repo_size_kb
+        # Open issues returned when listing a repository's issues
+        self.num_issues = num_issues
+        self.request_counts = Counter()
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def _issue(self, number):
+        return {
+            'number': number,
+            'title': f"Benchmark issue {number}",
+            'body': "Please update the README.",
+            'labels': [{'name': 'aiderbot'}],
+            'author_association': 'OWNER',
+            'user': {'login': 'benchmark'}
+        }
+
+    def _respond(self, endpoint, path, query):
+        """Return the body for an endpoint, as a dict, list or string."""
+        if endpoint == 'access_tokens':
+            return {'token': 'fake-installation-token'}
+        if endpoint == 'get_repository':
+            return {'default_branch': 'main', 'size': self.repo_size_kb, 'full_name': path.split('/repos/')[1]}
+        if endpoint == 'get_installation':
+            return {'id': 1}
+        if endpoint == 'get_issue':
+            number = int(path.rsplit('/', 1)[1])
+            return self._issue(number)
+        if endpoint == 'list_issues':
+            return [self._issue(number) for number in range(1, self.num_issues + 1)]
+        if endpoint == 'get_pr_diff':
+            return FAKE_DIFF
+        if endpoint in ('get_pr_changed_files',):
+            return [{'filename': 'README.md'}]
+        if endpoint in ('list_pull_requests', 'list_issue_comments', 'list_pr_review_comments'):
+            return []
+        if endpoint == 'create_pull_request':
+            pr_id = self._new_id()
+            return {'id': pr_id, 'number': pr_id, 'html_url': f"{self.url}/pull/{pr_id}"}
+        return {'id': self._new_id()}
+
+    def _build_handler(self):
+        fake_github = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self, method):
+                path, _, query = self.path.partition('?')
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+
+                route = next((route for route in ROUTES if route[0] == method and re.match(route[1], path)), None)
+                if not route:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                _, _, endpoint, status = route
+                with fake_github._lock:
+                    fake_github.request_counts[endpoint] += 1
+                if fake_github.latency_seconds:
+                    time.sleep(fake_github.latency_seconds)
+
+                self.send_response(status)
+                if status == 204:
+                    self.end_headers()
+                    return
+                body = fake_github._respond(endpoint, path, query)
+                encoded = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+                self.send_header('Content-Type', 'text/plain' if isinstance(body, str) else 'application/json')
+                self.send_header('Content-Length', str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,155 @@
+""" Load test for the webhook endpoint
+
+Replays webhook deliveries, signed with GITHUB_WEBHOOK_SECRET, at a fixed
+rate and reports how long the app takes to acknowledge them. Requests are
+sent on schedule whether or not earlier ones have been answered, as GitHub
+does, so a slow endpoint shows up as growing latency rather than a lower
+send rate.
+
+Deliveries are read from a directory of JSON files, each with the event name
+and payload of one delivery, for example copied from the Recent Deliveries
+page of the GitHub App:
+
+    {"event": "issue_comment", "payload": {"action": "created", ...}}
+
+Without --payloads, synthetic issue, issue comment and review comment
+deliveries are sent. Note that handled deliveries schedule real tasks, so
+point the app at a broker with no workers, or workers using the stub model
+from the end-to-end benchmark.
+
+Usage:
+    python -m benchmarks.replay_webhooks --url http://localhost:8585/webhook --rps 50 --duration 30
+"""
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from .run_benchmark import TASK_TYPES, build_payload, summarize
+
+TASK_TYPE_EVENTS = {
+    'issue': ('issues', 'opened'),
+    'issue_comment': ('issue_comment', 'created'),
+    'pr_review_comment': ('pull_request_review_comment', 'created'),
+}
+
+def load_deliveries(payloads_dir):
+    deliveries = []
+    for filename in sorted(os.listdir(payloads_dir)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(payloads_dir, filename)) as delivery_file:
+            delivery = json.load(delivery_file)
+        deliveries.append((delivery['event'], delivery['payload']))
+    return deliveries
+
+def build_synthetic_deliveries(count):
+    deliveries = []
+    for index in range(count):
+        task_type = TASK_TYPES[index % len(TASK_TYPES)]
+        event, action = TASK_TYPE_EVENTS[task_type]
+        deliveries.append((event, {'action': action, **build_payload(task_type, index)}))
+    return deliveries
+
+def sign_payload(secret, body):
+    return "sha256=" + hmac.new(secret.encode('utf-8'), msg=body, digestmod=hashlib.sha256).hexdigest()
+
+class Replayer:
+    """Sends deliveries to the webhook at a fixed rate and records the responses."""
+
+    def __init__(self, url, secret, deliveries, timeout_seconds=10):
+        self.url = url
+        self.timeout_seconds = timeout_seconds
+        # Bodies are encoded and signed up front so that doesn't count towards the rate
+        self.requests = []
+        for event, payload in deliveries:
+            body = json.dumps(payload).encode('utf-8')
+            self.requests.append((event, body, sign_payload(secret, body)))
+        self.latencies = []
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _send(self, index):
+        event, body, signature = self.requests[index % len(self.requests)]
+        headers = {
+            'Content-Type': 'application/json',
+            'X-GitHub-Event': event,
+            'X-GitHub-Delivery': str(uuid.uuid4()),
+            'X-Hub-Signature-256': signature,
+        }
+        start_time = time.perf_counter()
+        try:
+            response = self._get_session().post(self.url, data=body, headers=headers, timeout=self.timeout_seconds)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        latency = time.perf_counter() - start_time
+        with self._lock:
+            self.statuses[status] += 1
+            if isinstance(status, int):
+                self.latencies.append(latency)
+
+    def run(self, rps, duration_seconds, max_in_flight):
+        total_requests = int(rps * duration_seconds)
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for index in range(total_requests):
+                delay = start_time + index / rps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self._send, index)
+            send_time = time.perf_counter() - start_time
+        wall_time = time.perf_counter() - start_time
+
+        return {
+            'url': self.url,
+            'target_rps': rps,
+            'achieved_rps': total_requests / send_time if send_time else None,
+            'requests': total_requests,
+            'wall_time_seconds': wall_time,
+            'statuses': {str(status): count for status, count in self.statuses.items()},
+            'ack_latency_ms': {
+                stat: value * 1000 if isinstance(value, float) else value
+                for stat, value in summarize(self.latencies).items()
+            },
+        }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8585/webhook', help="Webhook URL")
+    parser.add_argument('--secret', default=os.getenv('GITHUB_WEBHOOK_SECRET', 'your_webhook_secret_here'), help="Webhook secret to sign deliveries with")
+    parser.add_argument('--payloads', help="Directory of recorded deliveries, replayed in a loop")
+    parser.add_argument('--rps', type=float, default=20, help="Deliveries per second")
+    parser.add_argument('--duration', type=float, default=10, help="How long to send for, in seconds")
+    parser.add_argument('--max-in-flight', type=int, default=200, help="Maximum number of unanswered deliveries")
+    parser.add_argument('--timeout', type=float, default=10, help="Request timeout in seconds, GitHub's is 10")
+    parser.add_argument('--output', help="Write results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    deliveries = load_deliveries(args.payloads) if args.payloads else build_synthetic_deliveries(len(TASK_TYPES) * 10)
+    replayer = Replayer(args.url, args.secret, deliveries, timeout_seconds=args.timeout)
+    results = json.dumps(replayer.run(args.rps, args.duration, args.max_in_flight), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results + '\n')
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+""" Offline end-to-end benchmark for the Celery tasks
+
+Runs the three webhook tasks against a local stand-in for the GitHub API,
+local bare repositories and a deterministic stub in place of the model, so
+throughput and latency can be measured without network access or API costs.
+Redis is still used for checkpoints and job control, from REDIS_URL.
+
+Usage:
+    python -m benchmarks.run_benchmark --jobs 30 --concurrency 4 --output results.json
+
+The results are JSON: per-stage and end-to-end latency percentiles, jobs per
+minute, peak RSS and peak workspace disk usage, tagged with the current
+commit so runs can be compared across commits.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .fake_github import FakeGitHub
+
+OWNER = 'benchmark'
+REPO_NAME = 'repo'
+TASK_TYPES = ['issue', 'issue_comment', 'pr_review_comment']
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(percent / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None
+    }
+
+def _git(args, cwd):
+    subprocess.run(['git'] + args, cwd=cwd, check=True, capture_output=True)
+
+def create_bare_repository(root_dir, num_files, file_size_bytes, num_branches):
+    """ Create a bare repository of a given size to clone from
+
+    The repository has num_files files of file_size_bytes each on main, and
+    num_branches feature branches for the PR review comment jobs to push to.
+    """
+    bare_dir = os.path.join(root_dir, OWNER, f'{REPO_NAME}.git')
+    source_dir = os.path.join(root_dir, 'source')
+    _git(['init', '--bare', '-b', 'main', bare_dir], cwd=root_dir)
+    _git(['init', '-b', 'main', source_dir], cwd=root_dir)
+
+    with open(os.path.join(source_dir, 'README.md'), 'w') as readme:
+        readme.write("# Benchmark repository\n")
+    os.makedirs(os.path.join(source_dir, 'src'))
+    line = ('x' * 79 + '\n').encode('utf-8')
+    for index in range(num_files):
+        with open(os.path.join(source_dir, 'src', f'module_{index}.py'), 'wb') as source_file:
+            source_file.write(line * max(1, file_size_bytes // len(line)))
+
+    _git(['add', '.'], cwd=source_dir)
+    _git(['-c', 'user.name=Benchmark', '-c', 'user.email=benchmark@example.com', 'commit', '-q', '-m', 'Initial commit'], cwd=source_dir)
+    _git(['push', '-q', bare_dir, 'main'], cwd=source_dir)
+    for index in range(num_branches):
+        _git(['push', '-q', bare_dir, f'main:refs/heads/feature-{index}'], cwd=source_dir)
+
+    shutil.rmtree(source_dir)
+    return bare_dir
+
+def stub_coding_request(latency_seconds):
+    """ Return a deterministic stand-in for aider_coder.do_coding_request
+
+    It appends a line to the README and commits it, after sleeping for
+    latency_seconds to simulate the model.
+    """
+    def do_coding_request(prompt, files_list, root_folder_path, **kwargs):
+        time.sleep(latency_seconds)
+        with open(os.path.join(root_folder_path, 'README.md'), 'a') as readme:
+            readme.write(f"Updated by the stub model ({len(prompt)} character prompt)\n")
+        _git(['add', 'README.md'], cwd=root_folder_path)
+        _git(['-c', 'user.name=Stub Model', '-c', 'user.email=stub@example.com', 'commit', '-q', '-m', 'Update README'], cwd=root_folder_path)
+        return {'commit_message': 'Update README', 'summary': 'Updated the README.', 'cached': False}
+
+    return do_coding_request
+
+def build_payload(task_type, index):
+    repository = {'name': REPO_NAME, 'owner': {'login': OWNER}}
+    user = {'login': 'benchmark-user'}
+    issue = {
+        'number': index + 1,
+        'title': f"@aiderbot benchmark issue {index + 1}",
+        'body': "Please update the README.",
+        'author_association': 'OWNER',
+        'user': user
+    }
+    if task_type == 'issue':
+        return {'installation': {'id': 1}, 'repository': repository, 'issue': issue}
+    comment = {'id': index + 1, 'body': "@aiderbot please update the README", 'author_association': 'OWNER', 'user': user}
+    if task_type == 'issue_comment':
+        return {'installation': {'id': 1}, 'repository': repository, 'issue': issue, 'comment': comment}
+    pull_request = {'number': index + 1, 'title': f"Fix issue #{index + 1}: benchmark", 'head': {'ref': f'feature-{index}'}}
+    return {'installation': {'id': 1}, 'repository': repository, 'pull_request': pull_request, 'comment': comment}
+
+def get_directory_size(path):
+    total_size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total_size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total_size
+
+class DiskSampler:
+    """Samples the size of a directory in the background and keeps the peak."""
+
+    def __init__(self, path, interval_seconds=0.2):
+        self.path = path
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, get_directory_size(self.path))
+            self._stop.wait(self.interval_seconds)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def _configure_environment(args, work_dir, fake_github, bare_dir):
+    """Point the app at the fake GitHub and local repository before it's imported."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    os.environ.update({
+        'GITHUB_API_URL': fake_github.url,
+        'GITHUB_CLONE_URL_TEMPLATE': bare_dir.replace(f'{OWNER}/{REPO_NAME}.git', '{owner}/{repo}.git'),
+        'GITHUB_APP_ID': '1',
+        'GITHUB_PRIVATE_KEY_CONTENTS': private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()
+        ).decode('utf-8'),
+        'AIDERBOT_WORKSPACE_ROOT': os.path.join(work_dir, 'workspaces'),
+        'AIDERBOT_LOG_DIR': '',
+        'AIDERBOT_LOG_LEVEL': args.log_level,
+        'AIDER_CACHE_ENABLED': 'false',
+        'GIT_COMMITTER_NAME': 'Benchmark',
+        'GIT_COMMITTER_EMAIL': 'benchmark@example.com',
+    })
+    os.makedirs(os.environ['AIDERBOT_WORKSPACE_ROOT'])
+
+def _get_commit():
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True)
+    return commit.stdout.strip() or None
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='aiderbot_benchmark_')
+    fake_github = FakeGitHub(latency_seconds=args.github_latency_ms / 1000, repo_size_kb=args.files * args.file_size // 1024).start()
+    try:
+        bare_dir = create_bare_repository(work_dir, args.files, args.file_size, num_branches=args.jobs)
+        _configure_environment(args, work_dir, fake_github, bare_dir)
+
+        # Imported here so that the module-level configuration picks up the environment
+        from aiderbot import aider_coder, celery_tasks
+        aider_coder.do_coding_request = stub_coding_request(args.llm_latency_ms / 1000)
+        tasks = {
+            'issue': celery_tasks.task_create_pull_request_for_issue,
+            'issue_comment': celery_tasks.task_handle_issue_comment,
+            'pr_review_comment': celery_tasks.task_handle_pr_review_comment,
+        }
+        task_types = TASK_TYPES if args.task_type == 'all' else [args.task_type]
+
+        def run_job(index):
+            task_type = task_types[index % len(task_types)]
+            start_time = time.time()
+            result, status = tasks[task_type].apply(args=[build_payload(task_type, index)]).get()
+            return task_type, time.time() - start_time, result, status
+
+        disk_sampler = DiskSampler(os.environ['AIDERBOT_WORKSPACE_ROOT']).start()
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            job_results = list(executor.map(run_job, range(args.jobs)))
+        wall_time = time.time() - start_time
+        disk_sampler.stop()
+
+        stage_latencies = defaultdict(list)
+        job_latencies = defaultdict(list)
+        failures = 0
+        for task_type, latency, result, status in job_results:
+            job_latencies[task_type].append(latency)
+            job_latencies['all'].append(latency)
+            if status != 200:
+                failures += 1
+            for stage, stage_latency in result.get('timings', {}).items():
+                stage_latencies[stage].append(stage_latency)
+
+        return {
+            'commit': _get_commit(),
+            'config': vars(args),
+            'wall_time_seconds': wall_time,
+            'jobs_per_minute': len(job_results) / wall_time * 60,
+            'failures': failures,
+            'job_latency_seconds': {task_type: summarize(latencies) for task_type, latencies in job_latencies.items()},
+            'stage_latency_seconds': {stage: summarize(latencies) for stage, latencies in stage_latencies.items()},
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'peak_workspace_disk_bytes': disk_sampler.peak_bytes,
+            'github_requests': dict(fake_github.request_counts),
+        }
+    finally:
+        fake_github.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=30, help="Number of jobs to run")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of jobs to run at once")
+    parser.add_argument('--task-type', choices=['all'] + TASK_TYPES, default='all', help="Which task to run, 'all' cycles through them")
+    parser.add_argument('--files', type=int, default=100, help="Number of files in the benchmark repository")
+    parser.add_argument('--file-size', type=int, default=4096, help="Size of each file in bytes")
+    parser.add_argument('--llm-latency-ms', type=float, default=0, help="Simulated latency of the stub model")
+    parser.add_argument('--github-latency-ms', type=float, default=0, help="Simulated latency of the GitHub API")
+    parser.add_argument('--log-level', default='WARNING', help="Log level for the app while benchmarking")
+    parser.add_argument('--output', help="Write results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results + '\n')
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+""" Gunicorn settings for the webhook
+
+Threaded workers keep a slow broker publish or Redis call in one request
+from holding up the others. Gunicorn loads this file from the working
+directory automatically.
+"""
+import os
+
+bind = os.getenv('AIDERBOT_WEB_BIND', '0.0.0.0:8585')
+worker_class = 'gthread'
+workers = int(os.getenv('AIDERBOT_WEB_WORKERS', 2))
+threads = int(os.getenv('AIDERBOT_WEB_THREADS', 8))
+# GitHub waits up to 10 seconds for a response before giving up on a delivery
+timeout = 30
+keepalive = 5
+
+def worker_exit(server, worker):
+    # Publish any deliveries still buffered in buffered ingest mode
+    from aiderbot import ingest
+    ingest.flush()
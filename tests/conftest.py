@@ -0,0 +1,10 @@
+import fakeredis
+import pytest
+from aiderbot import redis_client
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Replace the shared Redis client with an in-memory one for the test."""
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_client, '_redis_client', client)
+    return client
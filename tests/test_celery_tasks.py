@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+import pytest
+
+# The task module imports aider, which is only installed with the full requirements
+pytest.importorskip('aider')
+
+from aiderbot import admission, celery_tasks, job_records, pipeline
+
+class RetryRequested(Exception):
+    pass
+
+class FakeTask:
+    """Stands in for a bound Celery task, recording retries and republishes."""
+
+    max_retries = 3
+
+    def __init__(self, retries=0, admission_delays=0):
+        self.request = SimpleNamespace(
+            id='job-1',
+            retries=retries,
+            delivery_info={'routing_key': 'aiderbot.node.a'},
+            args=[{'payload': True}],
+            kwargs={'generation': 4, 'admission_delays': admission_delays}
+        )
+        self.retried = []
+        self.published = []
+
+    def retry(self, exc, countdown):
+        self.retried.append((exc, countdown))
+        return RetryRequested()
+
+    def apply_async(self, **kwargs):
+        self.published.append(kwargs)
+
+def test_handler_is_told_whether_it_can_retry(fake_redis):
+    calls = []
+    def handler(**kwargs):
+        calls.append(kwargs)
+        return {"message": "done"}, 200
+
+    celery_tasks._run_task_with_retries(FakeTask(retries=2), handler)
+    celery_tasks._run_task_with_retries(FakeTask(retries=3), handler)
+    assert [call['can_retry'] for call in calls] == [True, False]
+    assert calls[0]['job_id'] == 'job-1'
+    assert calls[0]['queue'] == 'aiderbot.node.a'
+
+def test_failed_stage_is_retried_with_backoff(fake_redis):
+    error = pipeline.StageFailed('push', pipeline.TransientError("push rejected"), transient=True)
+    def handler(**kwargs):
+        raise error
+
+    task = FakeTask(retries=1)
+    with pytest.raises(RetryRequested):
+        celery_tasks._run_task_with_retries(task, handler)
+    assert task.retried == [(error, celery_tasks._retry_countdown(1))]
+    assert job_records.get_job('job-1').retries == 1
+
+def test_deferred_job_is_requeued_under_the_same_id(fake_redis):
+    def handler(**kwargs):
+        raise admission.JobDeferred("not enough disk")
+
+    task = FakeTask(admission_delays=2)
+    response, status_code = celery_tasks._run_task_with_retries(task, handler, admission_delays=2)
+    assert status_code == 200
+    assert task.retried == []
+    assert task.published == [{
+        'args': [{'payload': True}],
+        'kwargs': {'generation': 4, 'admission_delays': 3},
+        'task_id': 'job-1',
+        'queue': 'aiderbot.node.a',
+        'countdown': admission.ADMISSION_DELAY_SECONDS,
+    }]
+
+def test_big_repository_is_sent_to_its_queue_without_a_delay(fake_redis):
+    def handler(**kwargs):
+        raise admission.JobDeferred("too big", queue='aiderbot.big_repos')
+
+    task = FakeTask()
+    celery_tasks._run_task_with_retries(task, handler)
+    assert task.published[0]['queue'] == 'aiderbot.big_repos'
+    assert task.published[0]['countdown'] == 0
+    assert task.published[0]['kwargs']['admission_delays'] == 0
+
+def test_admission_is_skipped_after_too_many_delays(fake_redis):
+    calls = []
+    def handler(**kwargs):
+        calls.append(kwargs)
+        return {"message": "done"}, 200
+
+    celery_tasks._run_task_with_retries(FakeTask(), handler, admission_delays=admission.MAX_ADMISSION_DELAYS)
+    assert calls[0]['check_admission'] is False
+
+def test_job_that_never_started_is_marked_ignored(fake_redis):
+    job_records.save_job('job-1', status=job_records.QUEUED)
+    celery_tasks._run_task_with_retries(FakeTask(), lambda **kwargs: ({"message": "ignored"}, 200))
+    assert job_records.get_job('job-1').status == job_records.IGNORED
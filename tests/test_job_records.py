@@ -0,0 +1,51 @@
+import dataclasses
+import pytest
+from aiderbot import job_records
+from aiderbot.job_records import JobRecord
+
+def _round_trip(record):
+    record_hash = {
+        name: job_records._serialize(name, value)
+        for name, value in dataclasses.asdict(record).items()
+        if value is not None
+    }
+    return job_records._parse(record_hash)
+
+def test_round_trip_of_a_full_record():
+    record = JobRecord(
+        job_id='job-1',
+        repo='owner/repo',
+        target='owner/repo#1',
+        kind='aiderbot.celery_tasks.task_create_pull_request_for_issue',
+        status=job_records.SUCCEEDED,
+        phase='publish',
+        created_at=1700000000.5,
+        updated_at=1700000100.25,
+        retries=2,
+        timings={'prepare': 1.5, 'edit': 30.0},
+        pull_request_url='https://github.com/owner/repo/pull/2',
+        tokens_sent=1200,
+        tokens_received=300,
+        cost=0.0125,
+        peak_rss_bytes=512 * 1024 ** 2,
+        peak_disk_bytes=64 * 1024 ** 2,
+        coding_peak_rss_bytes=300 * 1024 ** 2,
+        model_route='fast',
+        escalated=True,
+        error='Something went wrong',
+    )
+    assert _round_trip(record) == record
+
+def test_round_trip_of_a_new_record():
+    record = JobRecord(job_id='job-2', status=job_records.QUEUED)
+    assert _round_trip(record) == record
+
+def test_long_errors_are_truncated():
+    assert len(job_records._serialize('error', 'x' * 1000)) == job_records.MAX_ERROR_CHARS
+
+def test_fields_not_in_the_record_are_ignored():
+    assert _round_trip(JobRecord(job_id='job-3')) == job_records._parse({'job_id': 'job-3', 'removed_field': '1'})
+
+def test_unknown_fields_are_refused():
+    with pytest.raises(ValueError):
+        job_records.save_job('job-4', unknown='value')
@@ -0,0 +1,38 @@
+import pytest
+from aiderbot import model_routing
+
+@pytest.fixture
+def fast_model(monkeypatch):
+    monkeypatch.setattr(model_routing, 'FAST_MODEL', 'fast-model')
+    monkeypatch.setattr(model_routing, 'FAST_MAX_REQUEST_CHARS', 100)
+    monkeypatch.setattr(model_routing, 'FAST_MAX_FILES', 2)
+    monkeypatch.setattr(model_routing, 'FAST_MAX_DIFF_LINES', 50)
+
+def test_estimate_request_size():
+    size = model_routing.estimate_request_size('fix it', ['a.py', 'b.py'], diff_lines=12)
+    assert size == {'request_chars': 6, 'files': 2, 'diff_lines': 12}
+
+def test_estimate_request_size_handles_missing_values():
+    assert model_routing.estimate_request_size(None, None) == {'request_chars': 0, 'files': 0, 'diff_lines': 0}
+
+def test_everything_goes_to_the_strong_model_without_a_fast_model(monkeypatch):
+    monkeypatch.setattr(model_routing, 'FAST_MODEL', '')
+    size = model_routing.estimate_request_size('fix it', [])
+    assert model_routing.choose_route(size) == model_routing.STRONG
+
+def test_request_at_the_thresholds_goes_to_the_fast_model(fast_model):
+    size = model_routing.estimate_request_size('x' * 100, ['a.py', 'b.py'], diff_lines=50)
+    assert model_routing.choose_route(size) == model_routing.FAST
+
+@pytest.mark.parametrize('request_text, files_list, diff_lines', [
+    ('x' * 101, [], 0),
+    ('fix it', ['a.py', 'b.py', 'c.py'], 0),
+    ('fix it', [], 51),
+])
+def test_request_over_any_threshold_goes_to_the_strong_model(fast_model, request_text, files_list, diff_lines):
+    size = model_routing.estimate_request_size(request_text, files_list, diff_lines)
+    assert model_routing.choose_route(size) == model_routing.STRONG
+
+def test_model_names(fast_model):
+    assert model_routing.get_model_name(model_routing.FAST) == 'fast-model'
+    assert model_routing.get_model_name(model_routing.STRONG) is None
@@ -0,0 +1,112 @@
+import subprocess
+import pytest
+import redis
+import requests
+from aiderbot import pipeline
+from aiderbot.job_control import JobCancelled
+
+class Stages:
+    """Stages that record each run, with a failure to raise from one of them."""
+
+    def __init__(self, fail_stage=None, error=None):
+        self.runs = []
+        self.fail_stage = fail_stage
+        self.error = error
+
+    def _stage(self, name):
+        def stage(context, state):
+            self.runs.append(name)
+            if name == self.fail_stage:
+                raise self.error
+            return {f'{name}_output': f'{name} done', 'seen_before_' + name: sorted(state)}
+        return stage
+
+    def get(self, names=('prepare', 'edit', 'push', 'publish')):
+        return [(name, self._stage(name)) for name in names]
+
+def test_runs_every_stage_and_checkpoints_after_each(fake_redis):
+    stages = Stages()
+    state = pipeline.run_pipeline('job-1', stages.get(), {}, {'start_time': 1.0})
+    assert stages.runs == ['prepare', 'edit', 'push', 'publish']
+    assert state['publish_output'] == 'publish done'
+    assert set(state['timings']) == {'prepare', 'edit', 'push', 'publish'}
+    assert pipeline.load_checkpoint('job-1')['completed_stages'] == ['prepare', 'edit', 'push', 'publish']
+
+def test_resumes_at_the_failed_stage(fake_redis):
+    failing = Stages(fail_stage='push', error=pipeline.TransientError("push rejected"))
+    with pytest.raises(pipeline.StageFailed) as excinfo:
+        pipeline.run_pipeline('job-1', failing.get(), {}, {'start_time': 1.0})
+    assert excinfo.value.stage == 'push'
+    assert failing.runs == ['prepare', 'edit', 'push']
+    assert pipeline.has_checkpoint('job-1')
+    assert pipeline.load_checkpoint('job-1')['completed_stages'] == ['prepare', 'edit']
+
+    retried = Stages()
+    state = pipeline.run_pipeline('job-1', retried.get(), {}, {'start_time': 2.0})
+    assert retried.runs == ['push', 'publish']
+    # The outputs of the stages that aren't run again are restored from the checkpoint
+    assert state['edit_output'] == 'edit done'
+    assert 'edit_output' in state['seen_before_push']
+    assert state['start_time'] == 1.0
+
+def test_a_new_job_does_not_resume_from_another_jobs_checkpoint(fake_redis):
+    with pytest.raises(pipeline.StageFailed):
+        pipeline.run_pipeline('job-1', Stages(fail_stage='edit', error=pipeline.TransientError()).get(), {}, {})
+    stages = Stages()
+    pipeline.run_pipeline('job-2', stages.get(), {}, {})
+    assert stages.runs == ['prepare', 'edit', 'push', 'publish']
+
+def test_cleared_checkpoint_starts_from_the_beginning(fake_redis):
+    with pytest.raises(pipeline.StageFailed):
+        pipeline.run_pipeline('job-1', Stages(fail_stage='push', error=ValueError()).get(), {}, {})
+    pipeline.clear_checkpoint('job-1')
+    assert not pipeline.has_checkpoint('job-1')
+    stages = Stages()
+    pipeline.run_pipeline('job-1', stages.get(), {}, {})
+    assert stages.runs == ['prepare', 'edit', 'push', 'publish']
+
+@pytest.mark.parametrize('error, transient', [
+    (pipeline.TransientError("GitHub returned 502"), True),
+    (requests.exceptions.ConnectionError("connection reset"), True),
+    (requests.exceptions.HTTPError("502 Server Error"), True),
+    (subprocess.CalledProcessError(1, 'git push'), True),
+    (redis.exceptions.ConnectionError("Redis went away"), True),
+    (ValueError("bad payload"), False),
+    (RuntimeError("Failed to replay the edit"), False),
+    (KeyError('summary'), False),
+])
+def test_failures_are_classified(fake_redis, error, transient):
+    with pytest.raises(pipeline.StageFailed) as excinfo:
+        pipeline.run_pipeline('job-1', Stages(fail_stage='edit', error=error).get(), {}, {})
+    assert excinfo.value.stage == 'edit'
+    assert excinfo.value.transient is transient
+    assert excinfo.value.original is error
+
+def test_interruptions_are_not_wrapped(fake_redis):
+    stages = Stages(fail_stage='edit', error=JobCancelled("superseded"))
+    with pytest.raises(JobCancelled):
+        pipeline.run_pipeline('job-1', stages.get(), {}, {})
+    assert pipeline.load_checkpoint('job-1')['completed_stages'] == ['prepare']
+
+def test_stages_are_started_against_their_budgets(fake_redis):
+    class Control:
+        def __init__(self):
+            self.started = []
+
+        def start_stage(self, stage):
+            self.started.append(stage)
+
+    with pytest.raises(pipeline.StageFailed):
+        pipeline.run_pipeline('job-1', Stages(fail_stage='push', error=pipeline.TransientError()).get(), {}, {})
+    control = Control()
+    pipeline.run_pipeline('job-1', Stages().get(), {}, {}, control=control)
+    assert control.started == ['push', 'publish']
+
+def test_runs_without_redis(monkeypatch):
+    # Without Redis the job still runs, it just can't resume
+    from aiderbot import redis_client
+    monkeypatch.setattr(redis_client, '_redis_client', redis.Redis(host='localhost', port=1, socket_connect_timeout=0.1))
+    stages = Stages()
+    pipeline.run_pipeline('job-1', stages.get(), {}, {})
+    assert stages.runs == ['prepare', 'edit', 'push', 'publish']
+    assert not pipeline.has_checkpoint('job-1')
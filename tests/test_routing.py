@@ -0,0 +1,34 @@
+from aiderbot.routing import HashRing
+
+REPOS = [f"owner{index % 7}/repo{index}" for index in range(500)]
+
+def _assignments(ring):
+    return {repo: ring.get_node(repo) for repo in REPOS}
+
+def test_empty_ring_has_no_node():
+    assert HashRing([]).get_node('owner/repo') is None
+
+def test_assignment_does_not_depend_on_node_order():
+    assert _assignments(HashRing(['a', 'b', 'c'])) == _assignments(HashRing(['c', 'a', 'b']))
+
+def test_every_node_gets_some_repositories():
+    assignments = _assignments(HashRing(['a', 'b', 'c', 'd']))
+    assert set(assignments.values()) == {'a', 'b', 'c', 'd'}
+
+def test_adding_a_node_only_moves_repositories_to_it():
+    before = _assignments(HashRing(['a', 'b', 'c']))
+    after = _assignments(HashRing(['a', 'b', 'c', 'd']))
+    moved = [repo for repo in REPOS if before[repo] != after[repo]]
+    assert moved
+    assert all(after[repo] == 'd' for repo in moved)
+    # Roughly a quarter of the repositories should move, not most of them
+    assert len(moved) < len(REPOS) / 2
+
+def test_removing_a_node_only_moves_its_repositories():
+    before = _assignments(HashRing(['a', 'b', 'c', 'd']))
+    after = _assignments(HashRing(['a', 'b', 'c']))
+    for repo in REPOS:
+        if before[repo] != 'd':
+            assert after[repo] == before[repo]
+        else:
+            assert after[repo] in {'a', 'b', 'c'}
@@ -0,0 +1,59 @@
+import pytest
+from aiderbot import verification
+
+@pytest.fixture
+def repo_dir(tmp_path):
+    for path in ['pkg/mod.py', 'pkg/other.py', 'pkg/test_mod.py', 'tests/test_mod.py', 'tests/pkg/test_mod.py', 'README.md']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+    return str(tmp_path)
+
+def test_finds_tests_next_to_the_file_and_in_test_dirs(repo_dir):
+    assert verification.find_test_files(repo_dir, ['pkg/mod.py']) == [
+        'pkg/test_mod.py',
+        'tests/pkg/test_mod.py',
+        'tests/test_mod.py',
+    ]
+
+def test_test_files_cover_themselves(repo_dir):
+    assert verification.find_test_files(repo_dir, ['tests/test_mod.py']) == ['tests/test_mod.py']
+
+def test_files_without_tests_have_none(repo_dir):
+    assert verification.find_test_files(repo_dir, ['pkg/other.py']) == []
+
+def test_build_targets(repo_dir, monkeypatch):
+    monkeypatch.setattr(verification, 'VERIFY_COMMANDS', [
+        {'pattern': '*.py', 'command': 'ruff check {files}'},
+        {'pattern': '*.py', 'command': 'pytest -q {tests}'},
+        {'pattern': '*.js', 'command': 'eslint {files}'},
+    ])
+    targets = verification.build_targets(repo_dir, ['pkg/mod.py', 'README.md'])
+    assert targets == [
+        {'command': 'ruff check pkg/mod.py', 'files': ['pkg/mod.py'], 'uses_tree': False},
+        {
+            'command': 'pytest -q pkg/test_mod.py tests/pkg/test_mod.py tests/test_mod.py',
+            'files': ['pkg/mod.py', 'pkg/test_mod.py', 'tests/pkg/test_mod.py', 'tests/test_mod.py'],
+            'uses_tree': True,
+        },
+    ]
+
+def test_test_commands_are_left_out_when_there_are_no_tests(repo_dir, monkeypatch):
+    monkeypatch.setattr(verification, 'VERIFY_COMMANDS', [{'pattern': '*.py', 'command': 'pytest -q {tests}'}])
+    assert verification.build_targets(repo_dir, ['pkg/other.py']) == []
+
+def test_test_commands_are_cached_by_tree():
+    blob_hashes = {'pkg/mod.py': 'abc'}
+    key = verification._get_cache_key('pytest -q tests/test_mod.py', blob_hashes, tree_hash='tree1')
+    assert key == verification._get_cache_key('pytest -q tests/test_mod.py', blob_hashes, tree_hash='tree1')
+    assert key != verification._get_cache_key('pytest -q tests/test_mod.py', blob_hashes, tree_hash='tree2')
+    assert key != verification._get_cache_key('pytest -q tests/test_mod.py', blob_hashes)
+
+def test_unfinished_checks():
+    results = [
+        {'command': 'a', 'status': 'passed'},
+        {'command': 'b', 'status': 'failed'},
+        {'command': 'c', 'status': 'timed_out'},
+        {'command': 'd', 'status': 'skipped'},
+    ]
+    assert [result['command'] for result in verification.get_failures(results)] == ['b']
+    assert [result['command'] for result in verification.get_unfinished(results)] == ['c', 'd']